@@ -0,0 +1,155 @@
+import json
+import mmap
+import struct
+
+import numpy as np
+
+from TaxiFareModel import cache
+from TaxiFareModel.compiled import (
+    CompiledPipeline,
+    block_state,
+    build_block,
+    pipeline_parts,
+)
+
+# single file layout: MAGIC | header length (uint64) | json header | sections,
+# every section aligned on ALIGN bytes so that arrays map straight from disk
+MAGIC = b"TAXIFARE"
+FORMAT_VERSION = 1
+ALIGN = 64
+
+
+class _Linear(object):
+    """What CompiledPipeline needs from a fitted linear model"""
+
+    def __init__(self, coef, intercept):
+        self.coef_ = coef
+        self.intercept_ = intercept
+
+
+def _regressor_state(regressor):
+    if hasattr(regressor, "get_booster"):
+        booster = regressor.get_booster()
+        try:
+            raw = booster.save_raw(raw_format="ubj")
+        except TypeError:  # xgboost < 1.6
+            raw = booster.save_raw()
+        try:
+            best_iteration = int(regressor.best_iteration)
+        except (AttributeError, TypeError, ValueError):
+            best_iteration = None
+        spec = dict(kind="xgboost", best_iteration=best_iteration)
+        return spec, {"booster": np.frombuffer(bytes(raw), dtype=np.uint8)}
+    if hasattr(regressor, "coef_") and hasattr(regressor, "intercept_"):
+        arrays = {
+            "coef": np.ravel(regressor.coef_).astype(float),
+            "intercept": np.asarray(regressor.intercept_, dtype=float),
+        }
+        return dict(kind="linear"), arrays
+    raise NotImplementedError(
+        f"cannot store regressor {regressor.__class__.__name__} as an artifact"
+    )
+
+
+def _build_regressor(spec, arrays):
+    if spec["kind"] == "linear":
+        return _Linear(arrays["coef"], arrays["intercept"])
+    import xgboost
+
+    # xgboost copies the model into its own trees: one copy per process
+    booster = xgboost.Booster(model_file=bytearray(arrays["booster"]))
+    if spec["best_iteration"] is not None:
+        booster.best_iteration = spec["best_iteration"]
+    return booster
+
+
+def save_artifact(pipeline, path):
+    """Store a fitted Trainer.pipeline in the compact format: native xgboost
+    model (or linear coefficients) and the block state as json plus raw
+    arrays. Raises NotImplementedError if the pipeline cannot be compiled"""
+    blocks, regressor, zeros_missing = pipeline_parts(pipeline)
+    sections, header = [], dict(format=FORMAT_VERSION, zeros_missing=zeros_missing)
+    header["blocks"] = []
+    for i, (name, pipe) in enumerate(blocks):
+        spec, arrays = block_state(name, pipe)
+        header["blocks"].append(spec)
+        sections += [(f"blocks/{i}/{k}", v) for k, v in arrays.items()]
+    header["regressor"], arrays = _regressor_state(regressor)
+    sections += [(f"regressor/{k}", v) for k, v in arrays.items()]
+
+    header["sections"], offset = {}, 0
+    for key, array in sections:
+        array = np.ascontiguousarray(array)
+        if array.dtype.hasobject:
+            raise NotImplementedError(f"cannot store object array {key}")
+        header["sections"][key] = dict(
+            offset=offset, dtype=array.dtype.str, shape=list(array.shape)
+        )
+        offset += -(-array.nbytes // ALIGN) * ALIGN
+    payload = json.dumps(header).encode()
+    start = -(-(len(MAGIC) + 8 + len(payload)) // ALIGN) * ALIGN
+
+    def write(tmp):
+        with open(tmp, "wb") as f:
+            f.write(MAGIC + struct.pack("<Q", len(payload)) + payload)
+            for key, array in sections:
+                f.seek(start + header["sections"][key]["offset"])
+                f.write(np.ascontiguousarray(array).tobytes())
+
+    # replaced in one go: a server mapping the previous file keeps its pages
+    cache.atomic_write(path, write)
+    return path
+
+
+def is_artifact(path):
+    with open(path, "rb") as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def load_artifact(path):
+    """CompiledPipeline from a compact artifact. The block arrays and linear
+    coefficients are read-only views of a shared memory map of the file, so
+    processes loading the same file share their pages. An xgboost booster
+    is parsed into memory of its own in every process, xgboost cannot
+    predict from the mapped bytes"""
+    with open(path, "rb") as f:
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if buffer[: len(MAGIC)] != MAGIC:
+        raise ValueError(f"{path} is not a model artifact")
+    (length,) = struct.unpack("<Q", buffer[len(MAGIC) : len(MAGIC) + 8])
+    header = json.loads(buffer[len(MAGIC) + 8 : len(MAGIC) + 8 + length])
+    if header["format"] > FORMAT_VERSION:
+        raise ValueError(f"artifact format {header['format']} is too recent")
+    start = -(-(len(MAGIC) + 8 + length) // ALIGN) * ALIGN
+
+    def arrays(prefix):
+        out = {}
+        for key, section in header["sections"].items():
+            if key.startswith(prefix):
+                dtype = np.dtype(section["dtype"])
+                count = int(np.prod(section["shape"], dtype=np.int64))
+                if count == 0:
+                    out[key[len(prefix) :]] = np.empty(section["shape"], dtype)
+                    continue
+                array = np.frombuffer(
+                    buffer, dtype, count=count, offset=start + section["offset"]
+                )
+                out[key[len(prefix) :]] = array.reshape(section["shape"])
+        return out
+
+    blocks = [
+        build_block(spec, arrays(f"blocks/{i}/"))
+        for i, spec in enumerate(header["blocks"])
+    ]
+    regressor = _build_regressor(header["regressor"], arrays("regressor/"))
+    return CompiledPipeline(blocks, regressor, zeros_missing=header["zeros_missing"])
+
+
+def load_model(path):
+    """Model with a predict method from a compact artifact, or the pickled
+    pipeline of an older model.joblib"""
+    if is_artifact(path):
+        return load_artifact(path)
+    import joblib
+
+    return joblib.load(path)
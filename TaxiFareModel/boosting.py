@@ -0,0 +1,107 @@
+import os
+
+import joblib
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from sklearn.pipeline import Pipeline
+
+from TaxiFareModel import cache
+from TaxiFareModel.encoders import _code_fingerprint, data_fingerprint
+
+DEFAULT_MAX_BIN = 256
+
+
+def is_xgboost(model):
+    """Without importing xgboost: whether model is one of its estimators"""
+    return type(model).__module__.split(".")[0] == "xgboost"
+
+
+def as_float32(X):
+    """Features as xgboost reads them without a copy: float32 CSR or array"""
+    if sparse.issparse(X):
+        return X.tocsr().astype(np.float32, copy=False)
+    if isinstance(X, pd.DataFrame):
+        return X.to_numpy(dtype=np.float32)
+    return np.asarray(X, dtype=np.float32)
+
+
+def booster_params(model, n_jobs=None):
+    """Native training params of an XGBRegressor, histogram method by default"""
+    params = model.get_xgb_params()
+    if params.get("tree_method") in (None, "auto", "exact"):
+        params["tree_method"] = "hist"
+    params["max_bin"] = params.get("max_bin") or DEFAULT_MAX_BIN
+    if n_jobs is not None:
+        params.pop("n_jobs", None)
+        params["nthread"] = n_jobs
+    return params
+
+
+def train_matrix(X, y, max_bin=DEFAULT_MAX_BIN, ref=None):
+    """Quantized matrix (hist bins only, no float copy of the features);
+    pass the training matrix as ref to bin a validation set the same way"""
+    import xgboost
+
+    X, y = as_float32(X), np.asarray(y, dtype=np.float32)
+    if hasattr(xgboost, "QuantileDMatrix"):
+        return xgboost.QuantileDMatrix(X, y, max_bin=max_bin, ref=ref)
+    return xgboost.DMatrix(X, y)
+
+
+def train_booster(model, dtrain, evals=(), early_stopping_rounds=None, n_jobs=None):
+    """Boost with the native api on an already built matrix, then attach the
+    booster to the XGBRegressor so that it predicts like a fitted one"""
+    import xgboost
+
+    booster = xgboost.train(
+        booster_params(model, n_jobs),
+        dtrain,
+        num_boost_round=model.get_params()["n_estimators"] or 100,
+        evals=list(evals),
+        early_stopping_rounds=early_stopping_rounds,
+        verbose_eval=False,
+    )
+    model._Booster = booster
+    return model
+
+
+def cached_train_matrix(steps, X, y, cache_dir=None, max_bytes=None):
+    """Fit the feature steps and build the training matrix, or load both from
+    the cache when the same steps were fitted on the same data before.
+    xgboost cannot save a QuantileDMatrix, so the entry is a plain DMatrix of
+    the float32 features (save_binary): a hit saves the feature computation,
+    the hist method still bins the features at every training. The xgboost
+    cache folder is trimmed back to max_bytes. Returns the fitted steps and
+    the matrix"""
+    import xgboost
+
+    key = cache.fingerprint(
+        _code_fingerprint(Pipeline([(str(i), s) for i, s in enumerate(steps)])),
+        data_fingerprint(X),
+        data_fingerprint(y),
+        xgboost.__version__,
+    )
+    steps_path = cache.cache_file("xgboost", key, "joblib", cache_dir=cache_dir)
+    matrix_path = cache.cache_file("xgboost", key, "buffer", cache_dir=cache_dir)
+    if os.path.exists(steps_path) and os.path.exists(matrix_path):
+        try:
+            fitted, dtrain = joblib.load(steps_path), xgboost.DMatrix(matrix_path)
+            cache.touch(steps_path)
+            cache.touch(matrix_path)
+            print("-> xgboost matrix cache hit")
+            return fitted, dtrain
+        except Exception:  # corrupted or incompatible entry, rebuild it
+            pass
+    F = X
+    for step in steps:
+        F = step.fit_transform(F, y)
+    dtrain = xgboost.DMatrix(as_float32(F), np.asarray(y, dtype=np.float32))
+    cache.atomic_write(matrix_path, dtrain.save_binary)
+    cache.atomic_write(steps_path, lambda tmp: joblib.dump(steps, tmp))
+    cache.evict(
+        max_bytes,
+        cache_dir=cache.namespace_dir("xgboost", cache_dir),
+        keep=(steps_path, matrix_path),
+    )
+    return steps, dtrain
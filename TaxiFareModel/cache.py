@@ -0,0 +1,118 @@
+import hashlib
+import json
+import os
+import tempfile
+
+CACHE_DIR = os.environ.get(
+    "TAXIFARE_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "taxifare")
+)
+# the whole cache directory is trimmed back under this size after each write
+CACHE_MAX_BYTES = int(os.environ.get("TAXIFARE_CACHE_MAX_BYTES", 10 * 1024**3))
+
+
+def fingerprint(*parts):
+    """Stable sha256 of json-able parts (anything else goes through str)"""
+    payload = json.dumps(parts, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def source_identity(path):
+    """What identifies the content of a local or remote (gs://, s3://) file
+    without reading it: size plus mtime / etag as reported by the filesystem"""
+    if "://" not in path:
+        stat = os.stat(path)
+        return {
+            "path": os.path.abspath(path),
+            "size": stat.st_size,
+            "mtime": stat.st_mtime_ns,
+        }
+    import fsspec
+
+    fs, _, paths = fsspec.core.get_fs_token_paths(path)
+    info = fs.info(paths[0])
+    keys = [
+        "size",
+        "ETag",
+        "etag",
+        "md5Hash",
+        "crc32c",
+        "generation",
+        "updated",
+        "LastModified",
+        "mtime",
+    ]
+    return {"path": path, **{k: info[k] for k in keys if k in info}}
+
+
+def namespace_dir(namespace, cache_dir=None):
+    """Folder of a namespace ("clean_data", "features"...), what evict() is
+    given so that an entry never pushes out the entries of another kind"""
+    return os.path.join(cache_dir or CACHE_DIR, namespace)
+
+
+def cache_file(namespace, key, ext, cache_dir=None):
+    folder = namespace_dir(namespace, cache_dir)
+    os.makedirs(folder, exist_ok=True)
+    return os.path.join(folder, f"{key}.{ext}")
+
+
+def touch(path):
+    """Mark a cache entry as recently used (eviction is LRU on mtime)"""
+    os.utime(path, None)
+
+
+def atomic_write(path, write_fn):
+    """Call write_fn(tmp_path) then move the result in place, so that readers
+    never see a half written entry"""
+    folder = os.path.dirname(path)
+    fd, tmp = tempfile.mkstemp(dir=folder, suffix=".tmp")
+    os.close(fd)
+    try:
+        write_fn(tmp)
+        # mkstemp creates the file 0600, give it the mode open() would:
+        # readers (the api) may run as another user
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(tmp, 0o666 & ~umask)
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def cache_size(cache_dir=None):
+    return sum(size for _, size, _ in _entries(cache_dir or CACHE_DIR))
+
+
+def _entries(cache_dir):
+    for root, _, files in os.walk(cache_dir):
+        for name in files:
+            if name.endswith(".tmp"):
+                continue
+            path = os.path.join(root, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            yield path, stat.st_size, stat.st_mtime
+
+
+def evict(max_bytes=None, cache_dir=None, keep=()):
+    """Remove least recently used entries under cache_dir (usually a
+    namespace_dir) until it fits in max_bytes. Returns the removed files"""
+    max_bytes = CACHE_MAX_BYTES if max_bytes is None else max_bytes
+    entries = sorted(_entries(cache_dir or CACHE_DIR), key=lambda e: e[2])
+    total = sum(size for _, size, _ in entries)
+    removed = []
+    for path, size, _ in entries:
+        if total <= max_bytes:
+            break
+        if path in keep:
+            continue
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+        removed.append(path)
+    return removed
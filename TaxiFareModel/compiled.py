@@ -0,0 +1,441 @@
+import threading
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+from dateutil import tz
+from TaxiFareModel.data import DIST_ARGS
+from TaxiFareModel.utils import (
+    NYC_CENTER,
+    calculate_direction,
+    geo_feature_names,
+    geo_features,
+    geohash_columns,
+    geohash_vectorized,
+    haversine_distance,
+    minkowski_arrays,
+    time_features_vectorized,
+)
+
+# scoring only needs numpy, sklearn and the encoders are imported by the
+# functions reading a fitted pipeline (block_state, pipeline_parts)
+COORD_COLUMNS = list(DIST_ARGS.values())
+TIME_COLUMN = "pickup_datetime"
+
+
+def parse_pickup_datetime(values, time_zone_name="America/New_York"):
+    """Return dow, hour, month, year arrays in local time.
+    A single "YYYY-mm-dd HH:MM:SS UTC" string takes a plain python path,
+    arrays go through pandas"""
+    if isinstance(values, str):
+        try:
+            dt = datetime.strptime(values[:19], "%Y-%m-%d %H:%M:%S")
+        except ValueError:
+            dt = pd.Timestamp(values).to_pydatetime().replace(tzinfo=None)
+        dt = dt.replace(tzinfo=tz.UTC).astimezone(tz.gettz(time_zone_name))
+        return (
+            np.array([dt.weekday()]),
+            np.array([dt.hour]),
+            np.array([dt.month]),
+            np.array([dt.year]),
+        )
+    return time_features_vectorized(pd.Series(values), time_zone_name)
+
+
+def _scaler_casts_params(scaler, mean, scale):
+    """Whether StandardScaler casts mean_ / scale_ to a float32 input dtype
+    before centering (recent sklearn) or not (older versions). A float32
+    feature rounded differently can flip a tree split, so mimic it exactly"""
+    probe = mean + scale * np.linspace(-3, 3, 1001)[:, None]
+    probe = probe.astype(np.float32)
+    expected = scaler.transform(probe)
+    casted = (probe - mean.astype(np.float32)) / scale.astype(np.float32)
+    return bool(np.array_equal(expected, casted))
+
+
+class _Block(object):
+    """One ColumnTransformer block: raw features followed by the fitted
+    StandardScaler or one-hot steps, reduced to plain arrays.
+    scaler: (mean, scale, casts) and categories: list of sorted arrays"""
+
+    def __init__(self, name, raw_fn, n_raw, scaler=None, categories=None):
+        self.name = name
+        self.raw_fn = raw_fn
+        self.scaler = None
+        self.categories = categories
+        if scaler is not None:
+            mean, scale, self.scaler_casts = scaler
+            self.scaler = (np.asarray(mean, float), np.asarray(scale, float))
+        if self.categories is not None:
+            self.offsets = np.cumsum([0] + [len(c) for c in self.categories])
+            self.n_features = int(self.offsets[-1])
+        else:
+            self.n_features = n_raw
+
+    def fill(self, cols, out):
+        """write the block features into `out` (a slice of the feature buffer)"""
+        raw = self.raw_fn(cols)
+        if self.categories is not None:
+            rows = np.arange(out.shape[0])
+            for j, (cats, values) in enumerate(zip(self.categories, raw)):
+                pos = np.searchsorted(cats, values)
+                pos = np.minimum(pos, len(cats) - 1)
+                known = cats[pos] == values  # unknown categories stay all zeros
+                out[rows[known], self.offsets[j] + pos[known]] = 1.0
+            return
+        for j, values in enumerate(raw):
+            if self.scaler is not None:
+                # in place, in the input dtype, like StandardScaler.transform
+                values = np.array(values, copy=True)
+                mean, scale = self.scaler[0][j], self.scaler[1][j]
+                if self.scaler_casts:
+                    mean, scale = values.dtype.type(mean), values.dtype.type(scale)
+                values -= mean
+                values /= scale
+            out[:, j] = values
+
+
+class _GeohashBlock(object):
+    """Sparse geohash block, only the columns of known cells are set"""
+
+    def __init__(self, name, precision, hash_bits=None, categories=None):
+        self.name = name
+        self.precision = precision
+        self.hash_bits = hash_bits
+        self.categories = categories
+        if hash_bits is not None:
+            self.n_features = 2 << hash_bits
+        else:
+            self.n_features = sum(len(c) for c in categories)
+
+    def fill(self, cols, out):
+        rows = np.arange(out.shape[0])
+        offset = 0
+        for j, point in enumerate(["pickup", "dropoff"]):
+            cells = geohash_vectorized(
+                cols[f"{point}_latitude"], cols[f"{point}_longitude"], self.precision
+            )
+            categories = None if self.categories is None else self.categories[j]
+            pos, known, n_features = geohash_columns(cells, self.hash_bits, categories)
+            out[rows[known], offset + pos[known]] = 1.0
+            offset += n_features
+
+
+# block heads that can be rebuilt from their parameters and fitted arrays
+HEADS = [
+    "DistanceTransformer",
+    "TimeFeaturesEncoder",
+    "TimeFeaturesOneHot",
+    "Direction",
+    "GeoFeatures",
+    "DistanceToCenter",
+    "GeohashEncoder",
+]
+
+
+def _json_params(estimator):
+    return {
+        k: list(v) if isinstance(v, tuple) else v
+        for k, v in estimator.get_params(deep=False).items()
+    }
+
+
+def block_state(name, pipe):
+    """Reduce a fitted ColumnTransformer block to a json-able spec and a dict
+    of numpy arrays (fitted head state, scaler statistics, categories)"""
+    from sklearn.pipeline import Pipeline
+    from sklearn.preprocessing import OneHotEncoder, StandardScaler
+
+    from TaxiFareModel.encoders import (
+        CachedTransformer,
+        GeohashEncoder,
+        RowParallel,
+        TimeFeaturesOneHot,
+    )
+
+    if isinstance(pipe, CachedTransformer):
+        pipe = pipe.transformer_
+    if isinstance(pipe, Pipeline):
+        steps = [step for _, step in pipe.steps if step not in (None, "passthrough")]
+    else:
+        steps = [pipe]
+    head, post_steps = steps[0], steps[1:]
+    if isinstance(head, RowParallel):
+        head = head.transformer_
+    if type(head).__name__ not in HEADS:
+        raise NotImplementedError(
+            f"cannot compile transformer {head.__class__.__name__} in block {name}"
+        )
+    spec = dict(name=name, head=type(head).__name__, params=_json_params(head))
+    arrays = {}
+    if isinstance(head, TimeFeaturesOneHot):
+        arrays["years"] = np.asarray(head.years_)
+    if isinstance(head, GeohashEncoder) and head.hash_bits is None:
+        for j, cats in enumerate(head.categories_):
+            arrays[f"cells_{j}"] = np.asarray(cats)
+    if post_steps and isinstance(head, (TimeFeaturesOneHot, GeohashEncoder)):
+        raise NotImplementedError(f"cannot compile steps after {type(head).__name__}")
+    n_categories = None
+    for step in post_steps:
+        if isinstance(step, StandardScaler) and "mean" not in arrays:
+            n_raw = step.n_features_in_
+            mean = step.mean_ if step.with_mean else np.zeros(n_raw)
+            scale = step.scale_ if step.with_std else np.ones(n_raw)
+            arrays["mean"] = np.asarray(mean, float)
+            arrays["scale"] = np.asarray(scale, float)
+            spec["scaler_casts"] = _scaler_casts_params(
+                step, arrays["mean"], arrays["scale"]
+            )
+        elif isinstance(step, OneHotEncoder) and n_categories is None:
+            if getattr(step, "drop_idx_", None) is not None:
+                raise NotImplementedError("OneHotEncoder with drop is not supported")
+            n_categories = len(step.categories_)
+            for j, cats in enumerate(step.categories_):
+                arrays[f"categories_{j}"] = np.asarray(cats)
+        else:
+            raise NotImplementedError(
+                f"cannot compile step {step.__class__.__name__} in block {name}"
+            )
+    spec["n_categories"] = n_categories
+    return spec, arrays
+
+
+def build_block(spec, arrays):
+    """Scoring block from block_state output, fitted sklearn objects not needed"""
+    name, head, params = spec["name"], spec["head"], spec["params"]
+    scaler = None
+    if "mean" in arrays:
+        scaler = (arrays["mean"], arrays["scale"], spec["scaler_casts"])
+    categories = None
+    if spec.get("n_categories") is not None:
+        categories = [arrays[f"categories_{j}"] for j in range(spec["n_categories"])]
+
+    if head == "GeohashEncoder":
+        cells = None
+        if params["hash_bits"] is None:
+            cells = [arrays["cells_0"], arrays["cells_1"]]
+        return _GeohashBlock(name, params["precision"], params["hash_bits"], cells)
+
+    if head == "DistanceTransformer":
+        distance_type = params["distance_type"]
+        if distance_type not in ("haversine", "euclidian", "manhattan"):
+            raise NotImplementedError(f"unknown distance_type {distance_type}")
+
+        def raw_fn(cols):
+            args = (
+                cols[DIST_ARGS["start_lat"]],
+                cols[DIST_ARGS["start_lon"]],
+                cols[DIST_ARGS["end_lat"]],
+                cols[DIST_ARGS["end_lon"]],
+            )
+            if distance_type == "haversine":
+                return [haversine_distance(*args)]
+            return [minkowski_arrays(*args, p=2 if distance_type == "euclidian" else 1)]
+
+        return _Block(name, raw_fn, 1, scaler, categories)
+
+    if head in ("TimeFeaturesEncoder", "TimeFeaturesOneHot"):
+        time_column, time_zone_name = params["time_column"], params["time_zone_name"]
+
+        def raw_fn(cols):
+            return parse_pickup_datetime(cols[time_column], time_zone_name)
+
+        if head == "TimeFeaturesOneHot":
+            categories = [
+                np.arange(7),
+                np.arange(24),
+                np.arange(1, 13),
+                arrays["years"],
+            ]
+        return _Block(name, raw_fn, 4, scaler, categories)
+
+    if head == "Direction":
+        start_lat, start_lon = params["start_lat"], params["start_lon"]
+        end_lat, end_lon = params["end_lat"], params["end_lon"]
+
+        def raw_fn(cols):
+            delta_lon = cols[start_lon] - cols[end_lon]
+            delta_lat = cols[start_lat] - cols[end_lat]
+            return [delta_lon, delta_lat, calculate_direction(delta_lon, delta_lat)]
+
+        return _Block(name, raw_fn, 3, scaler, categories)
+
+    if head == "GeoFeatures":
+        distance_type, features = params["distance_type"], params["features"]
+        n_raw = len(geo_feature_names(features))
+
+        def raw_fn(cols):
+            out = np.empty((len(cols[COORD_COLUMNS[0]]), n_raw))
+            geo_features(
+                cols[DIST_ARGS["start_lat"]],
+                cols[DIST_ARGS["start_lon"]],
+                cols[DIST_ARGS["end_lat"]],
+                cols[DIST_ARGS["end_lon"]],
+                out,
+                distance_type,
+                features,
+            )
+            # the fitted scaler saw float32 features
+            return list(out.astype(np.float32).T)
+
+        return _Block(name, raw_fn, n_raw, scaler, categories)
+
+    if head == "DistanceToCenter":
+
+        def raw_fn(cols):
+            lat, lon = NYC_CENTER
+            return [
+                haversine_distance(
+                    lat, lon, cols["pickup_latitude"], cols["pickup_longitude"]
+                ),
+                haversine_distance(
+                    lat, lon, cols["dropoff_latitude"], cols["dropoff_longitude"]
+                ),
+            ]
+
+        return _Block(name, raw_fn, 2, scaler, categories)
+
+    raise NotImplementedError(f"unknown block head {head}")
+
+
+def _compile_block(name, pipe):
+    return build_block(*block_state(name, pipe))
+
+
+class CompiledPipeline(object):
+    """Flat scoring function equivalent to a fitted Trainer.pipeline.
+
+    Features are computed from plain arrays into a preallocated float32
+    matrix (what DataframeCleaner hands to the regressor) and the regressor
+    is called directly: the xgboost booster through inplace_predict, linear
+    models through their coefficients.
+    """
+
+    def __init__(self, blocks, regressor, zeros_missing=False):
+        self.blocks = blocks
+        self.n_features = sum(block.n_features for block in blocks)
+        self.regressor = regressor
+        # a booster trained on CSR features sees zeros as missing values
+        self.zeros_missing = zeros_missing
+        self._local = threading.local()
+        self._predict_fn = self._regressor_fn(regressor, zeros_missing)
+
+    @staticmethod
+    def _regressor_fn(regressor, zeros_missing=False):
+        # a fitted XGBRegressor or a bare xgboost Booster
+        if hasattr(regressor, "get_booster"):
+            booster = regressor.get_booster()
+        else:
+            booster = regressor
+        if hasattr(booster, "inplace_predict"):
+            try:
+                iteration_range = (0, int(regressor.best_iteration) + 1)
+            except (AttributeError, TypeError, ValueError):
+                iteration_range = (0, 0)
+
+            def predict(X):
+                if zeros_missing:
+                    X = np.where(X == 0, np.float32(np.nan), X)
+                return booster.inplace_predict(X, iteration_range=iteration_range)
+
+            return predict
+        if hasattr(regressor, "coef_") and hasattr(regressor, "intercept_"):
+            coef = np.ravel(regressor.coef_)
+            intercept = regressor.intercept_
+            return lambda X: X @ coef + intercept
+        return regressor.predict
+
+    def _buffers(self, n):
+        buffers = getattr(self._local, "buffers", None)
+        if buffers is None or buffers[0].shape[0] != n:
+            buffers = (
+                np.zeros((n, self.n_features), dtype=np.float64),
+                np.zeros((n, self.n_features), dtype=np.float32),
+            )
+            if n == 1:  # keep the single row buffers around for the next call
+                self._local.buffers = buffers
+        return buffers
+
+    def features(self, cols):
+        """cols: mapping column name -> array (or a DataFrame)"""
+        arrays = {c: np.asarray(cols[c], dtype=np.float64) for c in COORD_COLUMNS}
+        arrays[TIME_COLUMN] = cols[TIME_COLUMN]
+        cols = arrays
+        n = len(cols[COORD_COLUMNS[0]])
+        out64, out32 = self._buffers(n)
+        out64[:] = 0.0
+        offset = 0
+        for block in self.blocks:
+            block.fill(cols, out64[:, offset : offset + block.n_features])
+            offset += block.n_features
+        np.copyto(out32, out64, casting="same_kind")
+        return out32
+
+    def predict(self, X):
+        """X: DataFrame or mapping of columns, same input as pipeline.predict"""
+        return np.asarray(self._predict_fn(self.features(X)))
+
+    def predict_one(
+        self,
+        pickup_datetime,
+        pickup_longitude,
+        pickup_latitude,
+        dropoff_longitude,
+        dropoff_latitude,
+    ):
+        """Score a single trip given as plain floats and a datetime string"""
+        cols = {
+            TIME_COLUMN: pickup_datetime,
+            "pickup_longitude": np.array([pickup_longitude], dtype=np.float64),
+            "pickup_latitude": np.array([pickup_latitude], dtype=np.float64),
+            "dropoff_longitude": np.array([dropoff_longitude], dtype=np.float64),
+            "dropoff_latitude": np.array([dropoff_latitude], dtype=np.float64),
+        }
+        return float(self.predict(cols)[0])
+
+    def check(self, pipeline, X, rtol=1e-5, atol=1e-4):
+        """Raise if the compiled predictions drift from pipeline.predict"""
+        expected = np.asarray(pipeline.predict(X), dtype=np.float64)
+        got = self.predict(X).astype(np.float64)
+        if not np.allclose(got, expected, rtol=rtol, atol=atol):
+            diff = np.max(np.abs(got - expected))
+            raise ValueError(f"compiled pipeline differs from pipeline by {diff}")
+        return float(np.max(np.abs(got - expected))) if len(got) else 0.0
+
+
+def pipeline_parts(pipeline):
+    """Fitted blocks, regressor and zeros_missing flag of a Trainer.pipeline.
+    Raises NotImplementedError for a layout without a compiled equivalent"""
+    from sklearn.compose import ColumnTransformer
+
+    from TaxiFareModel.encoders import DataframeCleaner
+
+    fitted = getattr(pipeline, "best_estimator_", pipeline)
+    steps = [step for _, step in fitted.steps]
+    features, regressor = steps[0], steps[-1]
+    if not isinstance(features, ColumnTransformer):
+        raise NotImplementedError("first pipeline step must be a ColumnTransformer")
+    zeros_missing = False
+    for step in steps[1:-1]:
+        if not isinstance(step, DataframeCleaner):
+            raise NotImplementedError(f"cannot compile step {step.__class__.__name__}")
+        zeros_missing = getattr(step, "keep_sparse", False)
+    blocks = [
+        (name, pipe)
+        for name, pipe, _ in features.transformers_
+        if name != "remainder" and not (isinstance(pipe, str) and pipe == "drop")
+    ]
+    return blocks, regressor, zeros_missing
+
+
+def compile_pipeline(pipeline, X_check=None):
+    """Compile a fitted Trainer.pipeline into a CompiledPipeline.
+    Raises NotImplementedError for steps without a compiled equivalent.
+    If X_check is given the compiled predictions are checked against
+    pipeline.predict(X_check)"""
+    blocks, regressor, zeros_missing = pipeline_parts(pipeline)
+    blocks = [_compile_block(name, pipe) for name, pipe in blocks]
+    compiled = CompiledPipeline(blocks, regressor, zeros_missing=zeros_missing)
+    if X_check is not None:
+        compiled.check(pipeline, X_check)
+    return compiled
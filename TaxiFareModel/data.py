@@ -1,5 +1,11 @@
+import inspect
+import io
+import mmap
+import os
+
 import pandas as pd
-from TaxiFareModel.utils import simple_time_tracker
+from TaxiFareModel import cache
+from TaxiFareModel.instrument import timed
 import numpy as np
 
 AWS_BUCKET_PATH = "s3://wagon-public-datasets/taxi-fare-train.csv"
@@ -16,46 +22,324 @@ DIST_ARGS = dict(
 )
 
 
-@simple_time_tracker
-def get_data(nrows=10000, **kwargs):
-    """method to get the training data (or a portion of it) from google cloud bucket"""
-    # Add Client() here
-    data_origin = kwargs["data_origin"]
+# explicit schema for the raw Kaggle file, passenger_count is read as float32
+# so that NaNs don't break the parse and cast to uint8 once the chunk is clean
+TRAIN_DTYPES = {
+    "key": "object",
+    "fare_amount": "float32",
+    "pickup_datetime": "object",
+    "pickup_longitude": "float32",
+    "pickup_latitude": "float32",
+    "dropoff_longitude": "float32",
+    "dropoff_latitude": "float32",
+    "passenger_count": "float32",
+}
+DATETIME_FORMAT = "%Y-%m-%d %H:%M:%S UTC"
+
+
+def get_data_path(data_origin):
     if data_origin == "local":
         print(f"-> loading from local folder")
-        path = LOCAL_PATH
-        df = pd.read_csv(path, nrows=nrows)
+        return LOCAL_PATH
     elif data_origin == "aws":
         print(f"-> loading from aws")
-        path = AWS_BUCKET_PATH
-        df = pd.read_csv(path, nrows=nrows)
+        return AWS_BUCKET_PATH
     elif data_origin == "gcp":
         print(f"-> loading from gcp")
-        path = f"gs://{GCP_BUCKET_NAME}/{GCP_BUCKET_TRAIN_DATA_PATH}"
-        df = pd.read_csv(path, nrows=nrows)
+        return f"gs://{GCP_BUCKET_NAME}/{GCP_BUCKET_TRAIN_DATA_PATH}"
+    raise ValueError(f"unknown data_origin {data_origin}")
+
+
+def _clean_chunk(chunk, parse_dates=True):
+    chunk = clean_df(chunk, verbose=False)
+    if "passenger_count" in chunk:
+        chunk["passenger_count"] = chunk["passenger_count"].astype("uint8")
+    if parse_dates and "pickup_datetime" in chunk:
+        chunk["pickup_datetime"] = pd.to_datetime(
+            chunk["pickup_datetime"], format=DATETIME_FORMAT, utc=True
+        )
+    return chunk
+
+
+def _schema(usecols=None):
+    return {k: v for k, v in TRAIN_DTYPES.items() if usecols is None or k in usecols}
+
+
+def iter_csv_chunks(
+    path, nrows=None, chunksize=1000000, usecols=None, parse_dates=True, skiprows=0
+):
+    """Generator of the cleaned chunks of a train/test csv, typed with the
+    explicit schema. `skiprows` data rows after the header are skipped, e.g.
+    the ones already held out for evaluation"""
+    dtypes = _schema(usecols)
+    reader = pd.read_csv(
+        path,
+        nrows=nrows,
+        chunksize=chunksize,
+        usecols=usecols,
+        dtype=dtypes,
+        skiprows=range(1, skiprows + 1) if skiprows else None,
+    )
+    for chunk in reader:
+        yield _clean_chunk(chunk, parse_dates)
+
+
+def read_csv_chunks(path, nrows=None, chunksize=1000000, usecols=None, parse_dates=True):
+    """Stream a train/test csv with the explicit schema, cleaning each chunk
+    and keeping only its surviving rows, so that peak memory is bounded by
+    one raw chunk plus the cleaned output"""
+    dtypes = _schema(usecols)
+    reader = pd.read_csv(
+        path, nrows=nrows, chunksize=chunksize, usecols=usecols, dtype=dtypes
+    )
+    chunks = []
+    n_read = 0
+    for chunk in reader:
+        n_read += len(chunk)
+        chunks.append(_clean_chunk(chunk, parse_dates))
+    if not chunks:
+        return pd.DataFrame(columns=list(dtypes)).astype(dtypes)
+    df = pd.concat(chunks)
+    print(f"-> kept {len(df)} of {n_read} rows")
+    return df
+
+
+def stream_data(nrows=None, **kwargs):
+    """Cleaned chunks of the training data for out of core training, same
+    kwargs as get_data plus `skiprows`. Every call starts a new pass over
+    the file"""
+    path = kwargs.get("path") or get_data_path(kwargs["data_origin"])
+    return iter_csv_chunks(
+        path,
+        nrows=nrows,
+        chunksize=kwargs.get("chunksize") or 1000000,
+        usecols=kwargs.get("usecols"),
+        parse_dates=kwargs.get("parse_dates", True),
+        skiprows=kwargs.get("skiprows", 0),
+    )
+
+
+# in-memory footprint of a training row relative to its raw DataFrame row:
+# the features, the train/val split and the estimator's own copies
+TRAINING_MEMORY_FACTOR = 10
+
+
+def rows_for_memory(path, memory_fraction=0.5, factor=TRAINING_MEMORY_FACTOR):
+    """Number of rows whose training fits in memory_fraction of the memory
+    available now, from the size of the first rows of the file"""
+    import psutil
+
+    pilot = pd.read_csv(path, nrows=10000)
+    row_bytes = pilot.memory_usage(index=True, deep=True).sum() / max(len(pilot), 1)
+    available = psutil.virtual_memory().available
+    nrows = int(available * memory_fraction / (row_bytes * factor))
+    print(
+        f"-> {nrows} rows fit in {memory_fraction * 100:g}% of the "
+        f"{available / 1024**3:.1f}GB available"
+    )
+    return nrows
+
+
+def _seek_sample(path, nrows, seed=None, pilot_rows=1000):
+    """Uniform sample of the lines of a local file without parsing it: random
+    byte offsets are drawn in a memory map and each picks the line around
+    it. A line is hit in proportion to its length, so it is kept with
+    probability min_len / len (rejection sampling) where min_len is the
+    shortest line seen, starting from the first pilot_rows lines. When a
+    shorter line turns up the lines kept so far are thinned to the new bound.
+    Returns the header and the lines in file order, or None when the sample
+    is too large a share of the file for seeking to pay off"""
+    rng = np.random.default_rng(seed)
+    if os.path.getsize(path) == 0:  # cannot be mapped
+        return None
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+        size = len(buf)
+        start = buf.find(b"\n") + 1
+        if start == 0 or start >= size:
+            return None
+        pilot_end = buf.find(b"\n", min(size, start + 200 * pilot_rows))
+        pilot = buf[start : size if pilot_end < 0 else pilot_end]
+        lengths = [len(line) + 1 for line in pilot.split(b"\n")[:pilot_rows] if line]
+        if not lengths:
+            return None
+        min_len, mean_len = min(lengths), sum(lengths) / len(lengths)
+        if nrows >= 0.5 * (size - start) / mean_len:
+            return None
+        picked = {}  # line start: (u * len, line)
+        while len(picked) < nrows:
+            draws = 2 * (nrows - len(picked)) + 64
+            offsets = rng.integers(start, size, draws).tolist()
+            uniforms = rng.random(draws).tolist()
+            for offset, u in zip(offsets, uniforms):
+                begin = buf.rfind(b"\n", start - 1, offset) + 1
+                end = buf.find(b"\n", offset)
+                end = size if end < 0 else end + 1
+                if end - begin < min_len:
+                    # the lines kept so far passed u * len <= the old bound:
+                    # keep those passing the new one, probability new / old
+                    min_len = end - begin
+                    picked = {b: v for b, v in picked.items() if v[0] <= min_len}
+                if begin in picked or u * (end - begin) > min_len:
+                    continue
+                line = buf[begin:end].rstrip(b"\r\n") + b"\n"
+                picked[begin] = (u * (end - begin), line)
+                if len(picked) == nrows:
+                    break
+        return buf[:start], [picked[begin][1] for begin in sorted(picked)]
+
+
+def _reservoir_sample(path, nrows, seed=None, dtype=None, usecols=None, chunksize=1000000):
+    """Uniform sample in a single pass over any (remote) csv: every row gets
+    a random key and the nrows smallest keys are kept (bottom-k sampling),
+    so memory holds the sample plus one chunk. An empty file gives an empty
+    frame with the schema columns"""
+    rng = np.random.default_rng(seed)
+    try:
+        reader = pd.read_csv(path, chunksize=chunksize, dtype=dtype, usecols=usecols)
+    except pd.errors.EmptyDataError:  # not even a header
+        return pd.DataFrame(
+            {col: pd.Series(dtype=kind) for col, kind in _schema(usecols).items()}
+        )
+    kept, kept_keys = None, None
+    for chunk in reader:
+        keys = rng.random(len(chunk))
+        if kept is not None:
+            chunk = pd.concat([kept, chunk])
+            keys = np.concatenate([kept_keys, keys])
+        if len(chunk) > nrows:
+            keep = np.sort(np.argpartition(keys, nrows)[:nrows])  # file order
+            chunk, keys = chunk.iloc[keep], keys[keep]
+        kept, kept_keys = chunk, keys
+    if kept is None:  # header only
+        return pd.read_csv(path, nrows=0, dtype=dtype, usecols=usecols)
+    return kept.reset_index(drop=True)
+
+
+def sample_csv(path, nrows, seed=None, method=None, dtype=None, usecols=None):
+    """Uniform random sample of nrows rows of a csv (in file order), the
+    same for the same seed. method "seek" samples byte offsets of a local
+    file, "reservoir" reads the whole file once (default for remote paths
+    and for samples close to the size of the file)"""
+    if method is None:
+        method = "reservoir" if "://" in path else "seek"
+    if method == "seek":
+        sample = _seek_sample(path, nrows, seed)
+        if sample is not None:
+            header, lines = sample
+            return pd.read_csv(
+                io.BytesIO(header + b"".join(lines)), dtype=dtype, usecols=usecols
+            )
+    return _reservoir_sample(path, nrows, seed, dtype=dtype, usecols=usecols)
+
+
+@timed("load", verbose=True)
+def get_data(nrows=10000, **kwargs):
+    """method to get the training data (or a portion of it) from google cloud bucket
+    Set `chunksize` to stream the file in typed chunks that are cleaned on the
+    fly (see read_csv_chunks), `path` overrides the location of data_origin.
+    `sample=True` draws nrows rows uniformly from the whole file (sample_seed
+    for a reproducible sample) instead of its first rows, `memory_fraction`
+    picks nrows from the memory available"""
+    # Add Client() here
+    data_origin = kwargs["data_origin"]
+    path = kwargs.get("path") or get_data_path(data_origin)
+    chunksize = kwargs.get("chunksize")
+    if kwargs.get("memory_fraction"):
+        nrows = rows_for_memory(path, kwargs["memory_fraction"])
+    if kwargs.get("sample") and nrows:
+        usecols = kwargs.get("usecols")
+        df = sample_csv(
+            path,
+            nrows,
+            seed=kwargs.get("sample_seed"),
+            dtype=_schema(usecols) if chunksize else None,
+            usecols=usecols,
+        )
+        if chunksize:  # same typed and cleaned frame as the chunked read
+            df = _clean_chunk(df, kwargs.get("parse_dates", True))
+        return df
+    if chunksize:
+        return read_csv_chunks(
+            path,
+            nrows=nrows,
+            chunksize=chunksize,
+            usecols=kwargs.get("usecols"),
+            parse_dates=kwargs.get("parse_dates", True),
+        )
+    df = pd.read_csv(path, nrows=nrows)
     return df
 
 
-def clean_df(df, test=False):
-    print(df)
-    df = df.dropna(how="any", axis="rows")
-    df = df[(df.dropoff_latitude != 0) | (df.dropoff_longitude != 0)]
-    df = df[(df.pickup_latitude != 0) | (df.pickup_longitude != 0)]
-    if "fare_amount" in list(df):
-        df = df[df.fare_amount.between(0, 4000)]
-    df = df[df.passenger_count < 8]
-    df = df[df.passenger_count >= 0]
-    print(df)
-
-    df = df[df["pickup_latitude"].between(left=40, right=42)]
-    df = df[df["pickup_longitude"].between(left=-74.3, right=-72.9)]
-    print(df)
-
-    df = df[df["dropoff_latitude"].between(left=40, right=42)]
-    df = df[df["dropoff_longitude"].between(left=-74, right=-72.9)]
-    print(df)
+# declarative cleaning rules, evaluated in order into a single boolean mask
+# (name, kind, columns, bounds): "notna" rejects any missing value,
+# "nonzero_pair" rejects rows where both columns are 0, "between" keeps
+# low <= x <= high and "range" keeps low <= x < high. A rule whose columns
+# are absent (e.g. fare_amount in the test set) is skipped.
+CLEANING_RULES = [
+    ("missing_values", "notna", None, None),
+    ("zero_dropoff", "nonzero_pair", ["dropoff_latitude", "dropoff_longitude"], None),
+    ("zero_pickup", "nonzero_pair", ["pickup_latitude", "pickup_longitude"], None),
+    ("fare_amount", "between", ["fare_amount"], (0, 4000)),
+    ("passenger_count", "range", ["passenger_count"], (0, 8)),
+    ("pickup_latitude", "between", ["pickup_latitude"], (40, 42)),
+    ("pickup_longitude", "between", ["pickup_longitude"], (-74.3, -72.9)),
+    ("dropoff_latitude", "between", ["dropoff_latitude"], (40, 42)),
+    ("dropoff_longitude", "between", ["dropoff_longitude"], (-74, -72.9)),
+]
+
+
+def _rule_mask(df, kind, columns, bounds):
+    if kind == "notna":
+        mask = np.ones(len(df), dtype=bool)
+        for col in df.columns:
+            mask &= df[col].notna().to_numpy()
+        return mask
+    values = [df[col].to_numpy() for col in columns]
+    if kind == "nonzero_pair":
+        return (values[0] != 0) | (values[1] != 0)
+    low, high = bounds
+    if kind == "between":
+        return (values[0] >= low) & (values[0] <= high)
+    if kind == "range":
+        return (values[0] >= low) & (values[0] < high)
+    raise ValueError(f"unknown cleaning rule kind {kind}")
+
+
+def cleaning_mask(df, rules=None):
+    """Evaluate the cleaning rules into one boolean mask.
+    Returns the mask and a report {rule name: rows rejected}, a row being
+    attributed to the first rule it fails (same counts as filtering in order)"""
+    rules = CLEANING_RULES if rules is None else rules
+    keep = np.ones(len(df), dtype=bool)
+    rejected = {}
+    for name, kind, columns, bounds in rules:
+        if columns is not None and not all(col in df.columns for col in columns):
+            continue
+        mask = _rule_mask(df, kind, columns, bounds)
+        rejected[name] = int(np.count_nonzero(keep & ~mask))
+        keep &= mask
+    return keep, rejected
+
+
+@timed("clean")
+def clean_df(df, test=False, verbose=True, report=False):
+    """Drop rows failing any of CLEANING_RULES with a single take.
+    If report is True, return (df, report) where report holds rows_in,
+    rows_out and the rows rejected by each rule"""
+    keep, rejected = cleaning_mask(df)
+    rows_in = len(df)
+    df = df.take(np.flatnonzero(keep))
+    summary = dict(rows_in=rows_in, rows_out=len(df), rejected=rejected)
+    if verbose:
+        print(f"-> clean_df kept {len(df)} of {rows_in} rows")
+        for name, count in rejected.items():
+            if count:
+                print(f"   {name}: {count} rejected")
+    if report:
+        return df, summary
     return df
 
+@timed("optimize")
 def df_optimized(df, verbose=True, **kwargs):
     """
     Reduces size of dataframe by downcasting numeircal columns
@@ -79,9 +363,80 @@ def df_optimized(df, verbose=True, **kwargs):
         print("optimized size by {} % | {} GB".format(ratio, GB))
     return df
 
+def cleaning_rules_version():
+    """Changes whenever the schema, the cleaning or the downcasting code does,
+    which invalidates the cached clean data"""
+    sources = [
+        inspect.getsource(f)
+        for f in (
+            _schema,
+            _clean_chunk,
+            iter_csv_chunks,
+            read_csv_chunks,
+            _seek_sample,
+            _reservoir_sample,
+            sample_csv,
+            _rule_mask,
+            cleaning_mask,
+            clean_df,
+            df_optimized,
+        )
+    ]
+    return cache.fingerprint(TRAIN_DTYPES, DATETIME_FORMAT, CLEANING_RULES, sources)
+
+
+@timed("data")
+def get_clean_data(nrows=10000, **kwargs):
+    """get_data + clean_df + df_optimized, served from a parquet cache keyed by
+    data origin, source file identity, nrows, reading options and cleaning
+    rules. Set use_cache=False to bypass it, samples without a sample_seed
+    are never cached"""
+    data_origin = kwargs["data_origin"]
+    path = kwargs.get("path") or get_data_path(data_origin)
+    if kwargs.get("memory_fraction"):
+        # keyed on the rows that fit on this machine, not on the fraction
+        nrows = rows_for_memory(path, kwargs.pop("memory_fraction"))
+    unseeded = kwargs.get("sample") and kwargs.get("sample_seed") is None
+    if not kwargs.get("use_cache", True) or unseeded:
+        df = get_data(nrows=nrows, **kwargs)
+        if not kwargs.get("chunksize"):
+            df = clean_df(df)
+        return df_optimized(df)
+    key = cache.fingerprint(
+        data_origin,
+        cache.source_identity(path),
+        nrows,
+        bool(kwargs.get("chunksize")),
+        kwargs.get("usecols"),
+        kwargs.get("parse_dates", True),
+        kwargs.get("sample", False),
+        kwargs.get("sample_seed"),
+        cleaning_rules_version(),
+    )
+    cache_dir = kwargs.get("cache_dir")
+    cache_path = cache.cache_file("clean_data", key, "parquet", cache_dir=cache_dir)
+    if os.path.exists(cache_path):
+        print(f"-> loading clean data from cache {cache_path}")
+        cache.touch(cache_path)
+        return pd.read_parquet(cache_path)
+    df = get_data(nrows=nrows, **kwargs)
+    if not kwargs.get("chunksize"):  # chunks are already cleaned while streaming
+        df = clean_df(df)
+    df = df_optimized(df)
+    cache.atomic_write(cache_path, lambda tmp: df.to_parquet(tmp))
+    cache.evict(
+        kwargs.get("cache_max_bytes"),
+        cache_dir=cache.namespace_dir("clean_data", cache_dir),
+        keep=(cache_path,),
+    )
+    print(f"-> clean data cached under {cache_path}")
+    return df
+
+
 if __name__ == "__main__":
     params = dict(
         nrows=1000,
-        local=True,  # set to False to get data from GCP (Storage or BigQuery)
+        data_origin="local",  # "local", "gcp" or "aws"
+        chunksize=None,  # set to stream the file in cleaned chunks
     )
     df = get_data(**params)
@@ -1,15 +1,36 @@
+import hashlib
+import inspect
+import os
+
+import joblib
 import pandas as pd
-import pygeohash as gh
 import numpy as np
-from sklearn.base import BaseEstimator, TransformerMixin
-from TaxiFareModel.utils import haversine_vectorized, minkowski_distance
-from TaxiFareModel.data import get_data, clean_df, DIST_ARGS, df_optimized
+from joblib import Parallel, delayed, effective_n_jobs
+from scipy import sparse
+from sklearn.base import BaseEstimator, TransformerMixin, clone
+from TaxiFareModel.utils import (
+    haversine_vectorized,
+    minkowski_distance,
+    calculate_direction,
+    time_features_vectorized,
+    geohash_vectorized,
+    geohash_to_str,
+    geohash_columns,
+    geo_features,
+    geo_feature_names,
+    GEO_FEATURE_GROUPS,
+    NYC_CENTER,
+)
+from TaxiFareModel import cache
+from TaxiFareModel.data import DIST_ARGS, df_optimized
+from TaxiFareModel.instrument import timed
 
 
 class DistanceTransformer(BaseEstimator, TransformerMixin):
     def __init__(self, distance_type="euclidian", **kwargs):
         self.distance_type = distance_type
 
+    @timed()
     def transform(self, X, y=None):
         assert isinstance(X, pd.DataFrame)
         if self.distance_type == "haversine":
@@ -23,41 +44,108 @@ class DistanceTransformer(BaseEstimator, TransformerMixin):
     def fit(self, X, y=None):
         return self
 
+
 class DataframeCleaner(BaseEstimator, TransformerMixin):
-    def __init__(self, verbose=False):
+    """Last step before the regressor. By default densifies the features
+    into a downcast DataFrame; with keep_sparse=True the features stay a CSR
+    matrix whose data buffer is cast to `dtype`. Explicit zeros are dropped
+    so that xgboost always sees zeros as missing entries"""
+
+    def __init__(self, verbose=False, keep_sparse=False, dtype="float32"):
         self.verbose = verbose
-        
+        self.keep_sparse = keep_sparse
+        self.dtype = dtype
+
+    @timed()
     def transform(self, X, y=None):
-        X = pd.DataFrame(X.toarray())
+        # models pickled before keep_sparse existed densify
+        if getattr(self, "keep_sparse", False):
+            X = X.tocsr() if sparse.issparse(X) else sparse.csr_matrix(X)
+            if self.dtype is not None:
+                X = X.astype(self.dtype, copy=False)
+            X.eliminate_zeros()
+            if self.verbose:
+                density = X.nnz / max(1, X.shape[0] * X.shape[1])
+                print(f"sparse features {X.shape} | density {density:.3f}")
+            return X
+        if sparse.issparse(X):
+            X = X.toarray()
+        X = pd.DataFrame(X)
         assert isinstance(X, pd.DataFrame)
         X = df_optimized(X)
         if self.verbose:
             print(X.head())
         return X
-    
+
     def fit(self, X, y=None):
         return self
 
+
 class TimeFeaturesEncoder(BaseEstimator, TransformerMixin):
     def __init__(self, time_column, time_zone_name="America/New_York"):
         self.time_column = time_column
         self.time_zone_name = time_zone_name
 
+    @timed()
     def transform(self, X, y=None):
         assert isinstance(X, pd.DataFrame)
-        X_ = X.copy()
-        X_.index = pd.to_datetime(X[self.time_column])
-        X_.index = X_.index.tz_convert(self.time_zone_name)
-        X_["dow"] = X_.index.weekday
-        X_["hour"] = X_.index.hour
-        X_["month"] = X_.index.month
-        X_["year"] = X_.index.year
+        dow, hour, month, year = time_features_vectorized(
+            X[self.time_column], self.time_zone_name
+        )
+        X_ = pd.DataFrame(
+            dict(dow=dow, hour=hour, month=month, year=year), index=X.index
+        )
         return X_[["dow", "hour", "month", "year"]]
 
     def fit(self, X, y=None):
         return self
 
 
+class TimeFeaturesOneHot(BaseEstimator, TransformerMixin):
+    """TimeFeaturesEncoder + OneHotEncoder in one step.
+
+    dow, hour and month have fixed categories (7, 24 and 12 columns), years
+    are the ones seen during fit, unseen years are left all zeros. The
+    local time parts come from time_features_vectorized and go straight
+    into a CSR matrix with 4 entries per row.
+    """
+
+    def __init__(self, time_column, time_zone_name="America/New_York"):
+        self.time_column = time_column
+        self.time_zone_name = time_zone_name
+
+    def fit(self, X, y=None):
+        year = time_features_vectorized(X[self.time_column], self.time_zone_name)[3]
+        self.years_ = np.unique(year)
+        return self
+
+    def partial_fit(self, X, y=None):
+        """Add the years of another chunk of the training data"""
+        if not hasattr(self, "years_"):
+            return self.fit(X)
+        year = time_features_vectorized(X[self.time_column], self.time_zone_name)[3]
+        self.years_ = np.union1d(self.years_, year)
+        return self
+
+    @timed()
+    def transform(self, X, y=None):
+        dow, hour, month, year = time_features_vectorized(
+            X[self.time_column], self.time_zone_name
+        )
+        n = len(dow)
+        pos = np.minimum(np.searchsorted(self.years_, year), len(self.years_) - 1)
+        known = self.years_[pos] == year
+        indices = np.stack([dow, 7 + hour, 31 + month - 1, 43 + pos], axis=1)
+        data = np.ones((n, 4))
+        data[:, 3] = known
+        X_ = sparse.csr_matrix(
+            (data.ravel(), indices.ravel(), np.arange(0, 4 * n + 1, 4)),
+            shape=(n, 43 + len(self.years_)),
+        )
+        X_.eliminate_zeros()
+        return X_
+
+
 class AddGeohash(BaseEstimator, TransformerMixin):
     def __init__(self, precision=6):
         self.precision = precision
@@ -65,31 +153,89 @@ class AddGeohash(BaseEstimator, TransformerMixin):
     def fit(self, X, y=None):
         return self
 
+    @timed()
     def transform(self, X, y=None):
-        print("geo")
         assert isinstance(X, pd.DataFrame)
-        X_ = X.copy()
-        X_["geohash_pickup"] = X_.apply(
-            lambda x: gh.encode(
-                x.pickup_latitude, x.pickup_longitude, precision=self.precision
-            ),
-            axis=1,
-        )
-        print("geo inbetween")
-        X_["geohash_dropoff"] = X_.apply(
-            lambda x: gh.encode(
-                x.dropoff_latitude, x.dropoff_longitude, precision=self.precision
-            ),
-            axis=1,
-        )
-        print(X_.head(1))
+        X_ = pd.DataFrame(index=X.index)
+        for point in ["pickup", "dropoff"]:
+            cells = geohash_vectorized(
+                X[f"{point}_latitude"], X[f"{point}_longitude"], self.precision
+            )
+            X_[f"geohash_{point}"] = geohash_to_str(cells, self.precision)
         return X_[["geohash_pickup", "geohash_dropoff"]]
 
 
+class GeohashEncoder(BaseEstimator, TransformerMixin):
+    """Sparse encoding of the pickup and dropoff geohash cells.
+
+    Cells are computed on the whole coordinate arrays (geohash_vectorized)
+    and written straight into a CSR matrix with one block of columns per
+    point. With hash_bits set, each cell is hashed into 2**hash_bits
+    columns (multiplicative hashing, no fit needed); with hash_bits=None
+    the cells seen during fit are one-hot encoded and unseen cells are
+    left all zeros.
+    """
+
+    def __init__(self, precision=6, hash_bits=8):
+        self.precision = precision
+        self.hash_bits = hash_bits
+
+    def _cells(self, X):
+        return [
+            geohash_vectorized(
+                X[f"{point}_latitude"], X[f"{point}_longitude"], self.precision
+            )
+            for point in ["pickup", "dropoff"]
+        ]
+
+    def fit(self, X, y=None):
+        if self.hash_bits is None:
+            self.categories_ = [np.unique(cells) for cells in self._cells(X)]
+            self.n_features_out_ = sum(len(c) for c in self.categories_)
+        else:
+            self.n_features_out_ = 2 << self.hash_bits
+        return self
+
+    def partial_fit(self, X, y=None):
+        """Add the cells of another chunk of the training data"""
+        if self.hash_bits is not None or not hasattr(self, "categories_"):
+            return self.fit(X)
+        self.categories_ = [
+            np.union1d(seen, cells)
+            for seen, cells in zip(self.categories_, self._cells(X))
+        ]
+        self.n_features_out_ = sum(len(c) for c in self.categories_)
+        return self
+
+    def _columns(self, j, cells):
+        if self.hash_bits is not None:
+            return geohash_columns(cells, hash_bits=self.hash_bits)
+        return geohash_columns(cells, categories=self.categories_[j])
+
+    @timed()
+    def transform(self, X, y=None):
+        assert isinstance(X, pd.DataFrame)
+        n = len(X)
+        indices, known, offset = [], [], 0
+        for j, cells in enumerate(self._cells(X)):
+            cols, found, n_features = self._columns(j, cells)
+            indices.append(cols + offset)
+            known.append(found)
+            offset += n_features
+        indices = np.stack(indices, axis=1).ravel()
+        known = np.stack(known, axis=1).ravel()
+        data = known.astype(np.float32)
+        indptr = np.arange(0, 2 * n + 1, 2)
+        X_ = sparse.csr_matrix((data, indices, indptr), shape=(n, offset))
+        X_.eliminate_zeros()
+        return X_
+
+
 class DistanceToCenter(BaseEstimator, TransformerMixin):
     def __init__(self, verbose=False):
         self.verbose = verbose
 
+    @timed()
     def transform(self, X, y=None):
         X_ = X.copy()
         nyc_center = (40.7141667, -74.0063889)
@@ -127,21 +273,9 @@ class Direction(BaseEstimator, TransformerMixin):
         self.end_lat = end_lat
         self.end_lon = end_lon
 
+    @timed()
     def transform(self, X, y=None):
         X_ = X.copy()
-
-        def calculate_direction(d_lon, d_lat):
-            result = np.zeros(len(d_lon))
-            l = np.sqrt(d_lon ** 2 + d_lat ** 2)
-            result[d_lon > 0] = (180 / np.pi) * np.arcsin(
-                d_lat[d_lon > 0] / l[d_lon > 0]
-            )
-            idx = (d_lon < 0) & (d_lat > 0)
-            result[idx] = 180 - (180 / np.pi) * np.arcsin(d_lat[idx] / l[idx])
-            idx = (d_lon < 0) & (d_lat < 0)
-            result[idx] = -180 - (180 / np.pi) * np.arcsin(d_lat[idx] / l[idx])
-            return result
-
         X_["delta_lon"] = X_[self.start_lon] - X_[self.end_lon]
         X_["delta_lat"] = X_[self.start_lat] - X_[self.end_lat]
         X_["direction"] = calculate_direction(X_.delta_lon, X_.delta_lat)
@@ -151,7 +285,209 @@ class Direction(BaseEstimator, TransformerMixin):
         return self
 
 
+class GeoFeatures(BaseEstimator, TransformerMixin):
+    """Fused DistanceTransformer + Direction + DistanceToCenter.
+
+    Reads the four coordinate arrays once and writes the requested features
+    into one preallocated float32 matrix, row chunk by row chunk (chunk_size
+    rows of float64 temporaries at a time), without DataFrame copies.
+    Columns, in order: distance, [delta_lon, delta_lat, direction],
+    [pickup_distance_to_center, dropoff_distance_to_center], keeping only
+    the groups listed in `features`. Values are those of the separate
+    transformers, rounded to float32.
+    """
+
+    FEATURE_GROUPS = GEO_FEATURE_GROUPS
+    NYC_CENTER = NYC_CENTER
+
+    def __init__(
+        self,
+        distance_type="euclidian",
+        features=("distance", "direction", "distance_to_center"),
+        chunk_size=65536,
+    ):
+        self.distance_type = distance_type
+        self.features = features
+        self.chunk_size = chunk_size
+
+    def fit(self, X, y=None):
+        return self
+
+    def get_feature_names(self):
+        return geo_feature_names(self.features)
+
+    def compute(self, lat_1, lon_1, lat_2, lon_2, out):
+        """fill `out` from float64 pickup / dropoff coordinate arrays"""
+        return geo_features(
+            lat_1, lon_1, lat_2, lon_2, out, self.distance_type, self.features
+        )
+
+    @timed()
+    def transform(self, X, y=None):
+        coords = [
+            np.asarray(X[DIST_ARGS[arg]])
+            for arg in ["start_lat", "start_lon", "end_lat", "end_lon"]
+        ]
+        n = len(coords[0])
+        out = np.empty((n, len(self.get_feature_names())), dtype=np.float32)
+        for start in range(0, n, self.chunk_size):
+            stop = min(start + self.chunk_size, n)
+            chunk = [c[start:stop].astype(np.float64) for c in coords]
+            self.compute(*chunk, out[start:stop])
+        return out
+
+
+def shareable_columns(X):
+    """Columns of X as plain numpy arrays that joblib can memory-map for its
+    workers: numbers and datetime64 as is, strings as fixed width bytes"""
+    columns = {}
+    for col in X.columns:
+        values = X[col]
+        if pd.api.types.is_datetime64_any_dtype(values):
+            index = pd.DatetimeIndex(values)
+            if index.tz is not None:
+                index = index.tz_convert("UTC").tz_localize(None)
+            columns[col] = index.values
+        elif pd.api.types.is_numeric_dtype(values):
+            columns[col] = values.to_numpy()
+        else:
+            columns[col] = values.to_numpy().astype("S")
+    return columns
+
+
+def _transform_rows(transformer, columns, start, stop):
+    X = pd.DataFrame({col: values[start:stop] for col, values in columns.items()})
+    return transformer.transform(X)
+
+
+class RowParallel(BaseEstimator, TransformerMixin):
+    """Splits the rows of X across n_jobs joblib workers for transform.
+
+    Meant for the stateless heads of the feature blocks (fit is delegated to
+    a clone of `transformer` on the whole data). Input columns are turned
+    into numpy arrays once and memory-mapped by joblib (arrays above
+    max_nbytes), so workers read them from shared pages instead of
+    receiving a pickled copy of the frame. Below min_rows, or with
+    n_jobs=None/1, transform runs in process.
+    """
+
+    def __init__(self, transformer, n_jobs=None, min_rows=100000, max_nbytes="1M"):
+        self.transformer = transformer
+        self.n_jobs = n_jobs
+        self.min_rows = min_rows
+        self.max_nbytes = max_nbytes
+
+    def fit(self, X, y=None):
+        self.transformer_ = clone(self.transformer).fit(X, y)
+        return self
+
+    def transform(self, X, y=None):
+        n_jobs = effective_n_jobs(self.n_jobs) if self.n_jobs else 1
+        if n_jobs == 1 or len(X) < self.min_rows:
+            return self.transformer_.transform(X)
+        columns = shareable_columns(X)
+        bounds = np.linspace(0, len(X), n_jobs + 1).astype(int)
+        parts = Parallel(n_jobs=n_jobs, max_nbytes=self.max_nbytes, mmap_mode="r")(
+            delayed(_transform_rows)(self.transformer_, columns, start, stop)
+            for start, stop in zip(bounds[:-1], bounds[1:])
+        )
+        if sparse.issparse(parts[0]):
+            return sparse.vstack(parts, format="csr")
+        if isinstance(parts[0], pd.DataFrame):
+            return pd.concat(parts).set_axis(X.index, axis=0)
+        return np.concatenate(parts)
+
+
+def data_fingerprint(X):
+    """Content hash of the data a transformer is fed (frame, series or array)"""
+    if X is None:
+        return None
+    if isinstance(X, (pd.DataFrame, pd.Series)):
+        rows = pd.util.hash_pandas_object(X, index=True).values
+        meta = [str(X.dtypes) if isinstance(X, pd.DataFrame) else str(X.dtype)]
+        if isinstance(X, pd.DataFrame):
+            meta.append(list(map(str, X.columns)))
+        return cache.fingerprint(meta, hashlib.sha256(rows.tobytes()).hexdigest())
+    return joblib.hash(X)
+
+
+def _code_fingerprint(estimator):
+    """Parameters and source code of an estimator and of its nested steps, so
+    that changing either invalidates the cached outputs"""
+    estimators = [estimator] + [
+        v for v in estimator.get_params(deep=True).values() if hasattr(v, "get_params")
+    ]
+    sources = []
+    for est in estimators:
+        try:
+            sources.append(inspect.getsource(type(est)))
+        except (OSError, TypeError):
+            sources.append(type(est).__qualname__)
+    return cache.fingerprint(repr(estimator), estimator.get_params(deep=True), sources)
+
+
+class CachedTransformer(BaseEstimator, TransformerMixin):
+    """Content addressed on-disk cache of a transformer's outputs.
+
+    fit_transform results (fitted transformer + output) are keyed by the
+    transformer parameters and code plus the fingerprint of X and y, so the
+    same block fitted on the same data anywhere (another estimator of a
+    grid, a later run) is loaded instead of recomputed. transform is never
+    cached: the wrapper is saved with the pipeline, and the api requests,
+    scoring chunks and out of core passes must not write to the cache. The
+    cache folder is trimmed back to max_bytes, least recently used first.
+    """
+
+    def __init__(self, transformer, cache_dir=None, max_bytes=None):
+        self.transformer = transformer
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+
+    def _folder(self):
+        return cache.namespace_dir("features", self.cache_dir)
+
+    def _load(self, key):
+        path = cache.cache_file("features", key, "joblib", cache_dir=self.cache_dir)
+        if not os.path.exists(path):
+            return path, None
+        try:
+            value = joblib.load(path)
+        except Exception:  # corrupted or incompatible entry, recompute it
+            return path, None
+        cache.touch(path)
+        return path, value
+
+    def _store(self, path, value):
+        cache.atomic_write(path, lambda tmp: joblib.dump(value, tmp))
+        cache.evict(self.max_bytes, cache_dir=self._folder(), keep=(path,))
+
+    def fit_transform(self, X, y=None, **fit_params):
+        self.fit_key_ = cache.fingerprint(
+            _code_fingerprint(self.transformer),
+            data_fingerprint(X),
+            data_fingerprint(y),
+        )
+        path, value = self._load(self.fit_key_)
+        if value is not None:
+            print(f"-> feature cache hit {type(self.transformer).__name__}")
+            self.transformer_, output = value
+            return output
+        self.transformer_ = clone(self.transformer)
+        output = self.transformer_.fit_transform(X, y, **fit_params)
+        self._store(path, (self.transformer_, output))
+        return output
+
+    def fit(self, X, y=None, **fit_params):
+        self.fit_transform(X, y, **fit_params)
+        return self
+
+    def transform(self, X, y=None):
+        return self.transformer_.transform(X)
+
+
 if __name__ == "__main__":
+    from TaxiFareModel.data import get_data, clean_df
+
     params = dict(
         nrows=1000,
         upload=False,
@@ -0,0 +1,92 @@
+"""Import time of the entry points, measured with python -X importtime in a
+fresh interpreter, and a guard against regressions:
+
+    python -m TaxiFareModel.importtime            # all entry points
+    python -m TaxiFareModel.importtime api.fast --budget-ms 1500
+
+Fails (exit code 1) when an entry point imports one of its forbidden heavy
+dependencies or when its import takes longer than its budget.
+"""
+import argparse
+import os
+import subprocess
+import sys
+
+# optional dependencies only the code paths that need them should import
+HEAVY = ["google.cloud", "mlflow", "xgboost", "category_encoders"]
+
+ENTRY_POINTS = {
+    # serving a compact artifact needs neither sklearn nor the model libs
+    "api.fast": dict(budget_ms=1500, forbidden=HEAVY + ["sklearn"]),
+    "TaxiFareModel.predict": dict(budget_ms=1000, forbidden=HEAVY + ["sklearn"]),
+    "TaxiFareModel.trainer": dict(budget_ms=3000, forbidden=HEAVY),
+}
+
+
+def measure(module):
+    """Returns the import time of module in ms and the cumulative time of
+    every module it imported {name: ms}"""
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [root, env.get("PYTHONPATH")]))
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        stderr=subprocess.PIPE,
+        stdout=subprocess.DEVNULL,
+        env=env,
+        universal_newlines=True,
+        check=True,
+    )
+    modules = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line[len("import time:") :].split("|")
+        if cumulative.strip().isdigit():
+            modules[name.strip()] = int(cumulative) / 1000
+    return modules.get(module, 0.0), modules
+
+
+def check(module, budget_ms=None, forbidden=(), repeat=3, top=10):
+    """Best of `repeat` fresh imports against the budget, prints the slowest
+    imported modules. Returns the list of failures"""
+    runs = [measure(module) for _ in range(repeat)]
+    total, modules = min(runs, key=lambda run: run[0])
+    failures = [
+        f"{module} imports {name}"
+        for name in forbidden
+        if any(m == name or m.startswith(name + ".") for m in modules)
+    ]
+    if budget_ms is not None and total > budget_ms:
+        failures.append(f"{module} takes {total:.0f}ms to import (budget {budget_ms}ms)")
+    print(f"{module}: {total:.0f}ms")
+    slowest = sorted(
+        ((ms, name) for name, ms in modules.items() if name != module), reverse=True
+    )
+    for ms, name in slowest[:top]:
+        print(f"  {ms:8.1f}ms  {name}")
+    return failures
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("modules", nargs="*", default=list(ENTRY_POINTS))
+    parser.add_argument("--budget-ms", type=float, default=None)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args(argv)
+    failures = []
+    for module in args.modules:
+        config = ENTRY_POINTS.get(module, {})
+        failures += check(
+            module,
+            budget_ms=args.budget_ms or config.get("budget_ms"),
+            forbidden=config.get("forbidden", HEAVY),
+            repeat=args.repeat,
+        )
+    for failure in failures:
+        print(f"FAIL {failure}")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,164 @@
+import functools
+import os
+import tempfile
+import time
+
+import numpy as np
+from scipy import sparse
+from sklearn.compose import ColumnTransformer
+from sklearn.pipeline import Pipeline
+from sklearn.preprocessing import OneHotEncoder
+
+from TaxiFareModel import cache
+from TaxiFareModel.boosting import booster_params, train_booster
+from TaxiFareModel.encoders import CachedTransformer, RowParallel
+
+TARGET = "fare_amount"
+
+
+def split_target(chunk):
+    return chunk.drop(TARGET, axis=1), chunk[TARGET].values.astype(np.float32)
+
+
+def _hstack(column_transformer, outputs):
+    """What ColumnTransformer.transform stacks from its blocks outputs"""
+    if column_transformer.sparse_output_:
+        return sparse.hstack([sparse.csr_matrix(out) for out in outputs]).tocsr()
+    return np.hstack(
+        [out.toarray() if sparse.issparse(out) else np.asarray(out) for out in outputs]
+    )
+
+
+def partial_fit_transform(estimator, X):
+    """Update the statistics of an already fitted feature step with another
+    chunk (StandardScaler means/variances, seen years, categories or cells)
+    and return the chunk transformed. Steps without partial_fit are
+    stateless here"""
+    if isinstance(estimator, Pipeline):
+        for _, step in estimator.steps:
+            X = partial_fit_transform(step, X)
+        return X
+    if isinstance(estimator, ColumnTransformer):
+        outputs = []
+        for name, transformer, columns in estimator.transformers_:
+            if name == "remainder" and transformer == "drop":
+                continue
+            if isinstance(transformer, str):  # passthrough blocks
+                for _, transformer, columns in estimator.transformers_:
+                    if not isinstance(transformer, str):
+                        partial_fit_transform(transformer, X[columns])
+                return estimator.transform(X)
+            outputs.append(partial_fit_transform(transformer, X[columns]))
+        return _hstack(estimator, outputs)
+    if isinstance(estimator, (CachedTransformer, RowParallel)):
+        return partial_fit_transform(estimator.transformer_, X)
+    if isinstance(estimator, OneHotEncoder):
+        # fitted on the first chunk, add the categories of the others (years)
+        values = np.asarray(X)
+        categories = [
+            np.union1d(known, values[:, i])
+            for i, known in enumerate(estimator.categories_)
+        ]
+        if any(len(a) != len(b) for a, b in zip(categories, estimator.categories_)):
+            estimator.set_params(categories=categories).fit(X)
+        return estimator.transform(X)
+    if hasattr(estimator, "partial_fit"):
+        estimator.partial_fit(X)
+    return estimator.transform(X)
+
+
+def fit_features_streaming(steps, chunks):
+    """First pass over the data: fit the feature steps on the first chunk
+    then update them chunk by chunk, only one chunk is in memory at a time"""
+    n_rows = 0
+    for i, chunk in enumerate(chunks()):
+        X, y = split_target(chunk)
+        if i == 0:
+            for step in steps:
+                X = step.fit_transform(X, y)
+        else:
+            for step in steps:
+                X = partial_fit_transform(step, X)
+        n_rows += len(chunk)
+    print(f"-> feature statistics fitted on {n_rows} rows")
+    return n_rows
+
+
+def transform_chunks(steps, chunks):
+    """Generator of (features, target) for every chunk of a new pass"""
+    for chunk in chunks():
+        X, y = split_target(chunk)
+        for step in steps:
+            X = step.transform(X)
+        yield X, y
+
+
+def train_partial_fit(model, steps, chunks, n_epochs=1):
+    """Train an estimator with partial_fit (SGDRegressor) over the chunks"""
+    for epoch in range(n_epochs):
+        tic = time.time()
+        n_rows = 0
+        for X, y in transform_chunks(steps, chunks):
+            model.partial_fit(X, y)
+            n_rows += X.shape[0]
+        print(f"-> epoch {epoch}: {n_rows} rows in {round(time.time() - tic, 2)}s")
+    return model
+
+
+@functools.lru_cache(maxsize=None)
+def _feature_chunk_iter_class():
+    import xgboost
+
+    class FeatureChunkIter(xgboost.DataIter):
+        """Feeds xgboost the transformed chunks one at a time. With a
+        cache_prefix xgboost pages the data to disk (external memory),
+        otherwise it only keeps the quantized matrix in memory"""
+
+        def __init__(self, steps, chunks, cache_prefix=None):
+            self.steps = steps
+            self.chunks = chunks
+            self._it = None
+            super().__init__(cache_prefix=cache_prefix)
+
+        def next(self, input_data):
+            if self._it is None:
+                self._it = transform_chunks(self.steps, self.chunks)
+            try:
+                X, y = next(self._it)
+            except StopIteration:
+                return False
+            input_data(data=X, label=y)
+            return True
+
+        def reset(self):
+            self._it = None
+
+    return FeatureChunkIter
+
+
+def feature_chunk_iter(steps, chunks, cache_prefix=None):
+    """xgboost.DataIter over the transformed chunks (xgboost is only
+    imported here, the partial_fit path does not need it)"""
+    return _feature_chunk_iter_class()(steps, chunks, cache_prefix=cache_prefix)
+
+
+def train_xgboost_streaming(model, steps, chunks, external_memory=True, cache_dir=None):
+    """Boost an XGBRegressor over the chunks through a DataIter, then attach
+    the booster to the (sklearn) model so that it predicts like a fitted one.
+    Iterator built matrices need the hist method, booster_params defaults to it.
+    External memory pages go to a folder of their own for this run, removed
+    once the booster is trained"""
+    import xgboost
+
+    if not external_memory:
+        it = feature_chunk_iter(steps, chunks)
+        dtrain = xgboost.QuantileDMatrix(it, max_bin=booster_params(model)["max_bin"])
+        return train_booster(model, dtrain)
+    folder = cache.namespace_dir("xgboost_pages", cache_dir)
+    os.makedirs(folder, exist_ok=True)
+    with tempfile.TemporaryDirectory(dir=folder, prefix=f"{os.getpid()}-") as pages:
+        it = feature_chunk_iter(steps, chunks, cache_prefix=os.path.join(pages, "train"))
+        dtrain = xgboost.DMatrix(it)
+        train_booster(model, dtrain)
+        del dtrain, it  # releases the pages before the folder is removed
+    return model
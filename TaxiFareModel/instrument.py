@@ -0,0 +1,310 @@
+"""Stage instrumentation: nested spans with wall time, CPU time, rows and
+memory, collected in a per-run registry.
+
+    @timed("load", rows=...)        # decorator
+    with span("fit", rows=len(X)):  # block
+
+A span records its wall and CPU (process) seconds, the rows it processed,
+the change of RSS and how much it raised the peak RSS of the process. Spans
+nest per thread ("train/fit/TimeFeaturesEncoder.transform"). The registry
+keeps totals per path and the last spans, it can be dumped as json, turned
+into MLflow metrics, or rendered in the Prometheus text format.
+
+TAXIFARE_INSTRUMENT=0 (or enable(False)) turns every span into a no-op.
+"""
+import collections
+import functools
+import json
+import os
+import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError:  # windows, the peak comes from psutil
+    resource = None
+
+ENABLED = os.environ.get("TAXIFARE_INSTRUMENT", "1") == "1"
+
+_process = None
+
+
+def enable(flag=True):
+    global ENABLED
+    ENABLED = flag
+
+
+def _rss():
+    global _process
+    if _process is None:
+        import psutil
+
+        _process = psutil.Process()
+    return _process.memory_info().rss
+
+
+def _peak_rss():
+    if resource is None:
+        _rss()
+        return getattr(_process.memory_info(), "peak_wset", 0)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def count_rows(result):
+    """Rows of a transform / loader result, None when it has no length"""
+    if isinstance(result, tuple) and result:
+        result = result[0]
+    shape = getattr(result, "shape", None)
+    if shape:
+        return int(shape[0])
+    try:
+        return len(result)
+    except TypeError:
+        return None
+
+
+class Registry(object):
+    """Totals per span path plus the last max_spans spans"""
+
+    FIELDS = ("wall_s", "cpu_s", "rows", "rss_mb", "peak_rss_mb")
+
+    def __init__(self, max_spans=10000):
+        self.spans = collections.deque(maxlen=max_spans)
+        self.totals = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def stack(self):
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def record(self, record):
+        with self._lock:
+            self.spans.append(record)
+            total = self.totals.get(record["path"])
+            if total is None:
+                total = self.totals[record["path"]] = dict(
+                    count=0, **{field: 0.0 for field in self.FIELDS}
+                )
+            total["count"] += 1
+            for field in self.FIELDS:
+                total[field] += record[field] or 0
+
+    def to_dict(self):
+        with self._lock:
+            return dict(
+                totals={path: dict(total) for path, total in self.totals.items()},
+                spans=list(self.spans),
+            )
+
+    def dump(self, path):
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+    def metrics(self, prefix="span"):
+        """Totals flattened into MLflow metric names, span/<path>.<field>"""
+        metrics = {}
+        for path, total in self.to_dict()["totals"].items():
+            for field in ("count",) + self.FIELDS:
+                metrics[f"{prefix}/{path}.{field}"] = round(total[field], 6)
+        return metrics
+
+    def reset(self):
+        with self._lock:
+            self.spans.clear()
+            self.totals.clear()
+
+
+_registry = Registry()
+
+
+def get_registry():
+    return _registry
+
+
+def new_registry(**kwargs):
+    """Start the registry of a new run, spans still open keep the old one"""
+    global _registry
+    _registry = Registry(**kwargs)
+    return _registry
+
+
+class Span(object):
+    __slots__ = (
+        "registry",
+        "name",
+        "rows",
+        "verbose",
+        "path",
+        "depth",
+        "_wall",
+        "_cpu",
+        "_rss",
+        "_peak",
+    )
+
+    def __init__(self, registry, name, rows=None, verbose=False):
+        self.registry = registry
+        self.name = name
+        self.rows = rows
+        self.verbose = verbose
+
+    def __enter__(self):
+        stack = self.registry.stack()
+        self.depth = len(stack)
+        self.path = f"{stack[-1].path}/{self.name}" if stack else self.name
+        stack.append(self)
+        self._rss, self._peak = _rss(), _peak_rss()
+        self._cpu = time.process_time()
+        self._wall = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        wall = time.perf_counter() - self._wall
+        cpu = time.process_time() - self._cpu
+        rss, peak = _rss(), _peak_rss()
+        stack = self.registry.stack()
+        if stack and stack[-1] is self:
+            stack.pop()
+        self.registry.record(
+            dict(
+                name=self.name,
+                path=self.path,
+                depth=self.depth,
+                start=time.time() - wall,
+                wall_s=wall,
+                cpu_s=cpu,
+                rows=self.rows,
+                rss_mb=(rss - self._rss) / 1024**2,
+                peak_rss_mb=(peak - self._peak) / 1024**2,
+                error=exc[0].__name__ if exc[0] is not None else None,
+            )
+        )
+        if self.verbose:
+            print(self.name, round(wall, 2))
+        return False
+
+
+class _NullSpan(object):
+    """What span() returns when disabled: rows can be set, nothing recorded"""
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def __setattr__(self, name, value):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+def span(name, rows=None, verbose=False):
+    if not ENABLED:
+        return _NULL_SPAN
+    return Span(_registry, name, rows, verbose)
+
+
+def timed(name=None, rows=None, verbose=False):
+    """Decorator recording every call as a span named name (the qualified
+    name of the function by default). rows(*args, **kwargs) gives the rows
+    processed, otherwise they are counted on the result. verbose prints the
+    wall time of every call"""
+
+    def decorator(method):
+        span_name = name or method.__qualname__
+
+        @functools.wraps(method)
+        def wrapper(*args, **kwargs):
+            if not ENABLED:
+                return method(*args, **kwargs)
+            with Span(_registry, span_name, verbose=verbose) as s:
+                result = method(*args, **kwargs)
+                s.rows = rows(*args, **kwargs) if rows else count_rows(result)
+            return result
+
+        return wrapper
+
+    return decorator
+
+
+class Histogram(object):
+    """Prometheus histogram (cumulative buckets, sum and count)"""
+
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+    def __init__(self, name, documentation, buckets=BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(buckets)
+        self._counts = collections.Counter()
+        self._sum = collections.Counter()
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._sum[key] += value
+            self._counts[key + (("le", "+Inf"),)] += 1
+            for bound in self.buckets:
+                if value <= bound:
+                    self._counts[key + (("le", str(bound)),)] += 1
+
+    def lines(self):
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} histogram",
+        ]
+        with self._lock:
+            for key, total in sorted(self._sum.items()):
+                for bound in [str(b) for b in self.buckets] + ["+Inf"]:
+                    count = self._counts[key + (("le", bound),)]
+                    labels = _labels(key + (("le", bound),))
+                    lines.append(f"{self.name}_bucket{labels} {count}")
+                lines.append(f"{self.name}_sum{_labels(key)} {total}")
+                count = self._counts[key + (("le", "+Inf"),)]
+                lines.append(f"{self.name}_count{_labels(key)} {count}")
+        return lines
+
+
+def _labels(pairs):
+    if not pairs:
+        return ""
+    body = ",".join(
+        '{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"'))
+        for k, v in pairs
+    )
+    return "{" + body + "}"
+
+
+def prometheus_text(histograms=(), counters=None, registry=None, prefix="taxifare"):
+    """Prometheus exposition of histograms, plain counters
+    {name: (documentation, {labels tuple: value})} and the span totals"""
+    lines = []
+    for histogram in histograms:
+        lines += histogram.lines()
+    for name, (documentation, values) in (counters or {}).items():
+        lines += [f"# HELP {name} {documentation}", f"# TYPE {name} counter"]
+        lines += [f"{name}{_labels(key)} {value}" for key, value in values.items()]
+    totals = (registry or _registry).to_dict()["totals"]
+    for field, unit, documentation in [
+        ("count", "total", "spans closed"),
+        ("wall_s", "seconds_total", "wall time spent in the span"),
+        ("cpu_s", "cpu_seconds_total", "process CPU time spent in the span"),
+        ("rows", "rows_total", "rows processed by the span"),
+    ]:
+        name = f"{prefix}_span_{unit}"
+        lines += [f"# HELP {name} {documentation}", f"# TYPE {name} counter"]
+        lines += [
+            f"{name}{_labels((('span', path),))} {total[field]}"
+            for path, total in totals.items()
+        ]
+    return "\n".join(lines) + "\n"
@@ -1,4 +1,5 @@
-from TaxiFareModel.data import get_data, clean_df, df_optimized
+from TaxiFareModel.data import get_clean_data, stream_data
+from TaxiFareModel.instrument import new_registry
 from TaxiFareModel.predict import generate_submission_csv
 from TaxiFareModel.trainer import Trainer
 import warnings
@@ -12,28 +13,62 @@ warnings.simplefilter(action="ignore", category=FutureWarning)
 params = dict(
     nrows=30000000,  # number of samples
     data_origin="gcp",  # Define the origin of the data "local", 'gcp', 'aws'
+    chunksize=1000000,  # stream the csv in cleaned chunks, None for a single read
+    sample=False,  # uniform random sample of nrows rows instead of the first ones
+    sample_seed=42,  # same sample across runs
+    memory_fraction=None,  # e.g. 0.5: nrows picked to fit in half the available memory
+    use_cache=True,  # reuse the cleaned data cached on disk by previous runs
+    out_of_core=False,  # stream the nrows through the pipeline chunk by chunk (xgboost, SGDRegressor)
+    eval_nrows=500000,  # out of core: first rows kept in memory for evaluation only
     is_4_kaggle=False,  # enable kaggle submit
     experiment="[Fed-up!]-Phi-TaxiFare",  # define experiment name for mlflo tracking
     #local=False,  # set to False to get data from aws
     final_model=True,
     optimize=True,
     estimator="xgboost",
+    xgb_fast_path=True,  # float32/sparse quantized matrix and native xgboost training
+    xgb_n_jobs=-1,  # xgboost threads
+    search=False,  # successive halving over the estimator's model_params before training
+    search_time_budget=3600,  # seconds, no new halving round is started past it
     mlflow=True,  # set to True to log params to mlflow
+    instrumentation_path="instrumentation.json",  # stage timings of the last run
     experiment_name="[Fed-up!]-Phi-TaxiFare",
     pipeline_memory=None,
+    random_state=42,  # same train/val split for every estimator of the grid
+    split_shuffle=True,  # False: the last 15% rows are the validation set, no copy (rows must be in random order)
+    keep_train_features=True,  # evaluate() reuses the features computed by train()
+    train_rmse_rows=None,  # e.g. 500000: train rmse estimated on that many random rows
+    feature_cache=True,  # compute each feature block once across the grid and runs
+    feature_cache_max_bytes=20 * 1024 ** 3,
     model_upload=False,  # for automatic upload to gcp
     distance_type="manhattan",
+    sparse_features=True,  # feed the regressor a CSR matrix instead of a dense frame
+    fast_time_features=True,  # one-hot time features straight from the raw strings
+    feateng_n_jobs=-1,  # feature engineering workers, None to run in process
+    feateng_parallel="rows",  # "rows" splits rows across workers, "blocks" runs blocks concurrently
     feateng=["distance_to_center", "direction", "distance", "time_features", "geohash"],
 )
 
+
+def train(t):
+    if params["out_of_core"]:
+        # the evaluation rows are skipped by the training stream
+        t.train_out_of_core(
+            lambda: stream_data(**dict(params, skiprows=params["eval_nrows"]))
+        )
+    else:
+        t.train()
+
+
 ####################
 # Get and clean data
 ####################
 if __name__ == "__main__":
     print("############   Loading Data   ############")
-    df = get_data(**params)
-    df = clean_df(df)
-    df = df_optimized(df)
+    if params["out_of_core"]:
+        df = get_clean_data(**dict(params, nrows=params["eval_nrows"]))
+    else:
+        df = get_clean_data(**params)
     y_train = df["fare_amount"]
     X_train = df.drop("fare_amount", axis=1)
     del df
@@ -48,9 +83,12 @@ if __name__ == "__main__":
         print("Auto-Kaggle-submit is challenge is active")
         t = Trainer(X=X_train, y=y_train, **params)
         del X_train, y_train
-        t.train()
+        if params["search"]:
+            t.search()
+        train(t)
         t.evaluate()
         t.save_model()
+        t.log_instrumentation(params["instrumentation_path"])
         generate_submission_csv()
 
     ####################
@@ -82,9 +120,14 @@ if __name__ == "__main__":
                 )
                 # Train and save model, locally and
                 t = Trainer(X=X_train, y=y_train, **params)
+                if params["search"]:
+                    print(colored("############  Searching params ############", "yellow"))
+                    t.search()
                 print(colored("############  Training model   ############", "red"))
-                t.train()
+                train(t)
                 print(colored("############  Evaluating model ############", "blue"))
                 t.evaluate()
                 print(colored("############   Saving model    ############", "green"))
                 t.save_model()
+                t.log_instrumentation(params["instrumentation_path"])
+                new_registry()  # the next estimator of the grid starts afresh
@@ -1,66 +1,94 @@
+import json
 import os
 from math import sqrt
 
-import joblib
 import pandas as pd
 
-from sklearn.metrics import mean_absolute_error, mean_squared_error
-from google.cloud import storage
-
+from TaxiFareModel.artifact import load_model
 
 PATH_TO_LOCAL_MODEL = "model.joblib"
+PATH_TO_LOCAL_ARTIFACT = "model.tfm"
 BUCKET_NAME = "wagon-ml-zastrow-566"
+TEST_PATH = "raw_data/test.csv"
 
 
 def get_test_data():
     """method to get the training data (or a portion of it) from google cloud bucket
     To predict we can either obtain predictions from train data or from test data"""
     # Add Client() here
-    path = "raw_data/test.csv"
-    df = pd.read_csv(path)
+    df = pd.read_csv(TEST_PATH)
     return df
 
 
 def get_model(path_to_joblib):
-    pipeline = joblib.load(path_to_joblib)
+    """Compact artifact (model.tfm) or pickled pipeline (model.joblib)"""
+    pipeline = load_model(path_to_joblib)
     return pipeline
 
 
-def download_model(model_directory="PipelineTest", bucket=BUCKET_NAME, rm=False):
+def manifest_location(storage_location):
+    """The json next to an uploaded model naming the file to serve"""
+    return os.path.splitext(storage_location)[0] + ".json"
+
+
+def download_model_file(bucket=BUCKET_NAME):
+    """Download the final model to a local file: the one named by the
+    manifest written at upload (the compact artifact when the model could be
+    compiled), the joblib file otherwise. Returns the local path"""
+    from google.cloud import storage
+
     client = storage.Client().bucket(bucket)
     storage_location = "models/taxifare/final_model.joblib"
     # storage_location = 'models/{}/versions/{}/{}'.format(
     #    MODEL_NAME,
     #    model_directory,
     #    'model.joblib')
+    manifest = client.blob(manifest_location(storage_location))
+    if manifest.exists():
+        storage_location = json.loads(manifest.download_as_bytes())["model"]
     blob = client.blob(storage_location)
-    blob.download_to_filename("model.joblib")
-    print("=> pipeline downloaded from storage")
-    model = joblib.load("model.joblib")
+    local_path = PATH_TO_LOCAL_MODEL
+    if storage_location.endswith(".tfm"):
+        local_path = PATH_TO_LOCAL_ARTIFACT
+    blob.download_to_filename(local_path)
+    print(f"=> pipeline downloaded from storage to {local_path}")
+    return local_path
+
+
+def download_model(model_directory="PipelineTest", bucket=BUCKET_NAME, rm=False):
+    """Download and load the final model"""
+    local_path = download_model_file(bucket)
+    model = load_model(local_path)
     if rm:
-        os.remove("model.joblib")
+        # an artifact stays mapped after its file is removed
+        os.remove(local_path)
     return model
 
 
 def evaluate_model(y, y_pred):
+    from sklearn.metrics import mean_absolute_error, mean_squared_error
+
     MAE = round(mean_absolute_error(y, y_pred), 2)
     RMSE = round(sqrt(mean_squared_error(y, y_pred)), 2)
     res = {"MAE": MAE, "RMSE": RMSE}
     return res
 
 
-def generate_submission_csv(kaggle_upload=False):
-    df_test = get_test_data()
-    # pipeline = joblib.load(PATH_TO_LOCAL_MODEL)
-    pipeline = download_model()
-    if "best_estimator_" in dir(pipeline):
-        y_pred = pipeline.best_estimator_.predict(df_test)
-    else:
-        y_pred = pipeline.predict(df_test)
-    df_test["fare_amount"] = y_pred
-    df_sample = df_test[["key", "fare_amount"]]
+def generate_submission_csv(kaggle_upload=False, n_jobs=-1, max_memory_mb=None):
+    """Score the test set in parallel chunks (see score.score_file) into the
+    kaggle format: key, fare_amount"""
+    from TaxiFareModel.score import score_file
+
+    model_path = download_model_file()
     name = f"predictions_test_ex.csv"
-    df_sample.to_csv(name, index=False)
+    score_file(
+        TEST_PATH,
+        name,
+        model_path,
+        n_jobs=n_jobs,
+        max_memory_mb=max_memory_mb,
+        output_columns=["key"],
+    )
     print("prediction saved under kaggle format")
     # Set kaggle_upload to False unless you install kaggle cli
     if kaggle_upload:
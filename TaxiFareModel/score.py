@@ -0,0 +1,196 @@
+"""Batch scoring of large trip files: the input CSV/Parquet is streamed in
+chunks, the chunks are scored by a pool of processes that each load the
+model once, and the fares are written as soon as the chunks before them are,
+so the output keeps the input order.
+
+    python -m TaxiFareModel.score raw_data/test.csv predictions.csv --model model.tfm
+"""
+import argparse
+import collections
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from joblib import effective_n_jobs
+
+from TaxiFareModel.artifact import load_model
+from TaxiFareModel.instrument import timed
+
+# the scoring of a chunk holds about this many copies of its input: the
+# pending chunk in the parent, its pickled copy, the worker's frame and features
+CHUNK_MEMORY_FACTOR = 4
+
+_model = None
+
+
+def _load_worker_model(model_path):
+    global _model
+    model = load_model(model_path)
+    # a fitted search object scores with its best estimator
+    _model = getattr(model, "best_estimator_", model)
+
+
+def _score_chunk(chunk):
+    return np.asarray(_model.predict(chunk), dtype=np.float64)
+
+
+def iter_chunks(path, chunksize=100000, columns=None):
+    """DataFrame chunks of a CSV or Parquet file (read by row groups batches)"""
+    if os.path.splitext(path)[1] in (".parquet", ".pq"):
+        import pyarrow.parquet as pq
+
+        parquet = pq.ParquetFile(path)
+        for batch in parquet.iter_batches(batch_size=chunksize, columns=columns):
+            yield batch.to_pandas()
+        return
+    yield from pd.read_csv(path, chunksize=chunksize, usecols=columns)
+
+
+class _Writer(object):
+    """Appends scored chunks to a CSV or Parquet file"""
+
+    def __init__(self, path):
+        self.path = path
+        self.parquet = os.path.splitext(path)[1] in (".parquet", ".pq")
+        self._writer = None
+        self._header = True
+
+    def write(self, df):
+        if self.parquet:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            if self._writer is None:
+                self._writer = pq.ParquetWriter(self.path, table.schema)
+            self._writer.write_table(table)
+            return
+        df.to_csv(
+            self.path,
+            mode="w" if self._header else "a",
+            header=self._header,
+            index=False,
+        )
+        self._header = False
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+
+
+def max_chunks_in_flight(chunk, n_workers, max_memory_mb=None):
+    """How many chunks can be read ahead and scored at once: two per worker
+    to keep them busy, fewer if that would exceed the memory cap"""
+    in_flight = 2 * n_workers
+    if max_memory_mb:
+        chunk_mb = chunk.memory_usage(index=True, deep=True).sum() / 1024**2
+        need_mb = chunk_mb * CHUNK_MEMORY_FACTOR
+        fits = int(max_memory_mb // need_mb)
+        if fits < 1:
+            print(
+                f"-> a chunk of {len(chunk)} rows needs ~{need_mb:.0f}MB, "
+                f"over the {max_memory_mb}MB cap: lower chunksize"
+            )
+        in_flight = max(1, min(in_flight, fits))
+    return in_flight
+
+
+@timed("score_file")
+def score_file(
+    input_path,
+    output_path,
+    model_path,
+    chunksize=100000,
+    n_jobs=-1,
+    max_memory_mb=None,
+    output_columns=("key",),
+    target="fare_amount",
+    progress_every=10,
+):
+    """Score input_path into output_path (csv or parquet) with the model
+    saved at model_path (.tfm artifact or .joblib pipeline). The output holds
+    output_columns (every input column if None) plus the target. max_memory_mb
+    bounds the chunks read ahead. Returns the number of rows scored"""
+    n_workers = effective_n_jobs(n_jobs)
+    chunks = iter_chunks(input_path, chunksize)
+    writer = _Writer(output_path)
+    pool = None
+    pending = collections.deque()
+    written = dict(rows=0, chunks=0)
+    tic = time.time()
+
+    def write(chunk, fares):
+        out = chunk if output_columns is None else chunk[list(output_columns)].copy()
+        out[target] = fares
+        writer.write(out)
+        written["rows"] += len(out)
+        written["chunks"] += 1
+        if written["chunks"] % progress_every == 0:
+            rate = written["rows"] / (time.time() - tic)
+            print(f"-> {written['rows']} rows scored | {rate:,.0f} rows/s")
+
+    try:
+        if n_workers == 1:
+            _load_worker_model(model_path)
+            for chunk in chunks:
+                write(chunk, _score_chunk(chunk))
+        else:
+            pool = ProcessPoolExecutor(
+                n_workers, initializer=_load_worker_model, initargs=(model_path,)
+            )
+            in_flight = None
+            for chunk in chunks:
+                if in_flight is None:
+                    in_flight = max_chunks_in_flight(chunk, n_workers, max_memory_mb)
+                pending.append((chunk, pool.submit(_score_chunk, chunk)))
+                # results are written in submission order, which is input order
+                while len(pending) >= in_flight:
+                    done, future = pending.popleft()
+                    write(done, future.result())
+            while pending:
+                done, future = pending.popleft()
+                write(done, future.result())
+    finally:
+        if pool is not None:
+            for _, future in pending:
+                future.cancel()
+            pool.shutdown()
+        writer.close()
+    rows = written["rows"]
+    seconds = time.time() - tic
+    print(
+        f"-> {rows} rows scored into {output_path} in {seconds:.1f}s "
+        f"({rows / max(seconds, 1e-9):,.0f} rows/s, {n_workers} workers)"
+    )
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("input")
+    parser.add_argument("output")
+    parser.add_argument("--model", default="model.tfm")
+    parser.add_argument("--chunksize", type=int, default=100000)
+    parser.add_argument("--n-jobs", type=int, default=-1)
+    parser.add_argument("--max-memory-mb", type=float, default=None)
+    parser.add_argument(
+        "--columns",
+        default="key",
+        help="comma separated input columns kept in the output, 'all' for every one",
+    )
+    args = parser.parse_args(argv)
+    score_file(
+        args.input,
+        args.output,
+        args.model,
+        chunksize=args.chunksize,
+        n_jobs=args.n_jobs,
+        max_memory_mb=args.max_memory_mb,
+        output_columns=None if args.columns == "all" else args.columns.split(","),
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,218 @@
+import math
+import time
+
+import numpy as np
+from joblib import Parallel, delayed, effective_n_jobs
+from sklearn.base import clone
+from sklearn.model_selection import ParameterSampler
+
+from TaxiFareModel.boosting import (
+    booster_params,
+    is_xgboost,
+    train_booster,
+    train_matrix,
+)
+from TaxiFareModel.utils import compute_rmse
+
+
+def _supports_early_stopping_param(model):
+    """xgboost >= 1.6 takes early_stopping_rounds as an estimator param,
+    older versions in fit"""
+    return "early_stopping_rounds" in model.get_params()
+
+
+def fit_candidate(
+    model,
+    params,
+    X_train,
+    y_train,
+    X_val,
+    y_val,
+    rows,
+    early_stopping_rounds=None,
+    deadline=None,
+):
+    """Fit one candidate on the first `rows` rows (of an already shuffled
+    training set) and score it on the validation set. None when the
+    deadline (time.time() value) has passed before it starts"""
+    tic = time.time()
+    if deadline is not None and tic > deadline:
+        return None
+    model = clone(model).set_params(**params)
+    X_fit, y_fit = X_train[:rows], y_train[:rows]
+    best_iteration = None
+    if early_stopping_rounds and hasattr(model, "get_booster"):
+        fit_params = dict(eval_set=[(X_val, y_val)], verbose=False)
+        if _supports_early_stopping_param(model):
+            model.set_params(early_stopping_rounds=early_stopping_rounds)
+        else:
+            fit_params["early_stopping_rounds"] = early_stopping_rounds
+        model.fit(X_fit, y_fit, **fit_params)
+        best_iteration = getattr(model, "best_iteration", None)
+    else:
+        model.fit(X_fit, y_fit)
+    rmse = float(compute_rmse(np.asarray(model.predict(X_val)), y_val))
+    return dict(
+        params=params,
+        rows=rows,
+        rmse=round(rmse, 4),
+        fit_seconds=round(time.time() - tic, 3),
+        best_iteration=best_iteration,
+    )
+
+
+def fit_booster_candidate(
+    model, params, dtrain, dval, y_val, rows, early_stopping_rounds=None, deadline=None
+):
+    """xgboost candidate trained with the native api on the quantized
+    matrices shared by all the candidates of the round (None past deadline)"""
+    tic = time.time()
+    if deadline is not None and tic > deadline:
+        return None
+    model = clone(model).set_params(**params)
+    train_booster(
+        model,
+        dtrain,
+        evals=[(dval, "val")],
+        early_stopping_rounds=early_stopping_rounds,
+    )
+    booster = model.get_booster()
+    best_iteration = getattr(booster, "best_iteration", None)
+    if early_stopping_rounds and best_iteration is not None:
+        y_pred = booster.predict(dval, iteration_range=(0, best_iteration + 1))
+    else:
+        best_iteration = None
+        y_pred = booster.predict(dval)
+    rmse = float(compute_rmse(y_pred, y_val))
+    return dict(
+        params=params,
+        rows=rows,
+        rmse=round(rmse, 4),
+        fit_seconds=round(time.time() - tic, 3),
+        best_iteration=best_iteration,
+    )
+
+
+def successive_halving(
+    model,
+    param_distributions,
+    X_train,
+    y_train,
+    X_val,
+    y_val,
+    n_candidates=16,
+    eta=3,
+    min_rows=1000,
+    time_budget=None,
+    row_budget=None,
+    n_jobs=-1,
+    early_stopping_rounds=None,
+    random_state=None,
+):
+    """
+    Successive halving over training rows: every round fits the surviving
+    candidates in parallel on eta times more rows than the previous one and
+    keeps the best 1/eta of them (validation rmse).
+    The features are computed once by the caller, joblib memory-maps them for
+    the worker processes; xgboost candidates share the quantized matrices of
+    the round instead. Stops before a round that would exceed
+    time_budget (seconds, projected from the previous round) or row_budget
+    (total rows fitted over all candidates). Within a round no candidate
+    starts past the time budget, a fit already running completes.
+    Returns the best candidate and the list of all evaluated candidates
+    """
+    tic = time.time()
+    deadline = tic + time_budget if time_budget is not None else None
+    n_train = X_train.shape[0]
+    candidates = list(
+        ParameterSampler(param_distributions, n_candidates, random_state=random_state)
+    )
+    n_rounds = max(1, int(math.floor(math.log(len(candidates), eta))) + 1)
+    y_train, y_val = np.asarray(y_train), np.asarray(y_val)
+    results, rows_used, best = [], 0, None
+    shared_matrices = is_xgboost(model)
+    shared_matrices &= "max_bin" not in param_distributions
+    for r in range(n_rounds):
+        rows = int(min(n_train, max(min_rows, n_train * eta ** (r - n_rounds + 1))))
+        if row_budget is not None and rows_used + rows * len(candidates) > row_budget:
+            print(f"-> search stopped before round {r}: row budget reached")
+            break
+        if time_budget is not None and results:
+            last = [res for res in results if res["round"] == r - 1]
+            rate = sum(res["fit_seconds"] for res in last) / sum(
+                res["rows"] for res in last
+            )
+            projected = (
+                rate
+                * rows
+                * len(candidates)
+                / max(1, min(len(candidates), effective_n_jobs(n_jobs)))
+            )
+            if time.time() - tic + projected > time_budget:
+                print(f"-> search stopped before round {r}: time budget reached")
+                break
+        if shared_matrices:
+            # bin the round's rows once, xgboost releases the gil so the
+            # candidates train in threads on the same matrices
+            max_bin = booster_params(model)["max_bin"]
+            dtrain = train_matrix(X_train[:rows], y_train[:rows], max_bin)
+            dval = train_matrix(X_val, y_val, max_bin, ref=dtrain)
+            round_results = Parallel(n_jobs=n_jobs, prefer="threads")(
+                delayed(fit_booster_candidate)(
+                    model,
+                    params,
+                    dtrain,
+                    dval,
+                    y_val,
+                    rows,
+                    early_stopping_rounds,
+                    deadline,
+                )
+                for params in candidates
+            )
+            del dtrain, dval
+        else:
+            round_results = Parallel(n_jobs=n_jobs, max_nbytes="1M", mmap_mode="r")(
+                delayed(fit_candidate)(
+                    model,
+                    params,
+                    X_train,
+                    y_train,
+                    X_val,
+                    y_val,
+                    rows,
+                    early_stopping_rounds,
+                    deadline,
+                )
+                for params in candidates
+            )
+        skipped = sum(res is None for res in round_results)
+        round_results = [res for res in round_results if res is not None]
+        if not round_results:
+            print(f"-> search stopped in round {r}: time budget reached")
+            break
+        rows_used += rows * len(round_results)
+        for res in round_results:
+            res["round"] = r
+        results.extend(round_results)
+        round_results.sort(key=lambda res: res["rmse"])
+        best = round_results[0]
+        print(
+            f"-> round {r}: {len(round_results)} candidates on {rows} rows, "
+            f"best rmse {best['rmse']}"
+        )
+        candidates = [
+            res["params"] for res in round_results[: max(1, len(candidates) // eta)]
+        ]
+        if skipped:
+            print(f"-> search stopped in round {r}: time budget reached")
+            break
+        if len(round_results) == 1:
+            break
+    return dict(
+        best_params=best["params"] if best else None,
+        best_rmse=best["rmse"] if best else None,
+        best_iteration=best["best_iteration"] if best else None,
+        results=results,
+        seconds=round(time.time() - tic, 3),
+    )
@@ -0,0 +1,285 @@
+"""Background MLflow logging: params and metrics are queued by the trainer
+and sent by a worker thread with log_batch, on a timer and at exit. When the
+tracking server cannot be reached the batches are spooled to local files and
+replayed by the next logger that connects, or by hand:
+
+    python -m TaxiFareModel.tracking replay
+"""
+
+import atexit
+import json
+import os
+import queue
+import sys
+import threading
+import time
+import uuid
+
+# not under the cache directory: cache eviction must never drop unsent runs
+SPOOL_DIR = os.environ.get(
+    "TAXIFARE_MLFLOW_SPOOL_DIR",
+    os.path.join(
+        os.path.expanduser("~"), ".local", "share", "taxifare", "mlflow_spool"
+    ),
+)
+# limits of a single log_batch request, params and metrics count as entities
+MAX_PARAMS_PER_BATCH = 100
+MAX_ENTITIES_PER_BATCH = 1000
+
+RETRYABLE_ERRORS = (
+    "INTERNAL_ERROR",
+    "TEMPORARILY_UNAVAILABLE",
+    "REQUEST_LIMIT_EXCEEDED",
+)
+
+_FLUSH = object()
+_CLOSE = object()
+
+
+def now_ms():
+    return int(time.time() * 1000)
+
+
+def get_client(tracking_uri):
+    from mlflow.tracking import MlflowClient
+
+    return MlflowClient(tracking_uri=tracking_uri)
+
+
+def get_experiment_id(client, experiment_name):
+    experiment = client.get_experiment_by_name(experiment_name)
+    if experiment is not None:
+        return experiment.experiment_id
+    return client.create_experiment(experiment_name)
+
+
+def log_batch(client, run_id, params, metrics):
+    """params {key: str}, metrics [(key, value, timestamp, step)], sent in as
+    many requests as the batch limits need"""
+    from mlflow.entities import Metric, Param
+
+    params = [Param(k, v) for k, v in params.items()]
+    metrics = [Metric(k, v, ts, step) for k, v, ts, step in metrics]
+    while params or metrics:
+        n_params = min(len(params), MAX_PARAMS_PER_BATCH)
+        n_metrics = MAX_ENTITIES_PER_BATCH - n_params
+        client.log_batch(run_id, params=params[:n_params], metrics=metrics[:n_metrics])
+        params = params[n_params:]
+        metrics = metrics[n_metrics:]
+
+
+def is_rejected(exc):
+    """Whether the store refused the batch (invalid or changed param
+    values...): sending it again later would fail the same way. Connection
+    failures and server side errors come as INTERNAL_ERROR or unavailable"""
+    code = getattr(exc, "error_code", None)
+    return code is not None and code not in RETRYABLE_ERRORS
+
+
+def replay_spool(spool_dir=None, tracking_uri=None, skip=()):
+    """Send the spooled batches (of tracking_uri only if given), creating the
+    runs that could not be created while offline. Returns the number of
+    replayed files, failed ones are kept for the next attempt"""
+    spool_dir = spool_dir or SPOOL_DIR
+    if not os.path.isdir(spool_dir):
+        return 0
+    replayed = 0
+    for name in sorted(os.listdir(spool_dir)):
+        path = os.path.join(spool_dir, name)
+        if not name.endswith(".jsonl") or path in skip:
+            continue
+        claimed = path + ".replay"
+        try:
+            # another process may be replaying the same file
+            os.rename(path, claimed)
+        except OSError:
+            continue
+        try:
+            with open(claimed) as f:
+                header, *batches = [json.loads(line) for line in f if line.strip()]
+            if tracking_uri is not None and header["tracking_uri"] != tracking_uri:
+                os.rename(claimed, path)
+                continue
+            client = get_client(header["tracking_uri"])
+            run_id = header["run_id"]
+            if run_id is None:
+                experiment_id = get_experiment_id(client, header["experiment_name"])
+                run_id = client.create_run(experiment_id).info.run_id
+            for batch in batches:
+                log_batch(client, run_id, batch["params"], batch["metrics"])
+        except Exception as exc:
+            print(f"-> mlflow spool {name} not replayed: {exc!r}", file=sys.stderr)
+            os.rename(claimed, path)
+            continue
+        os.remove(claimed)
+        replayed += 1
+    return replayed
+
+
+class MlflowLogger(object):
+    """Queue of params and metrics of one run, flushed by a daemon thread
+    every flush_interval seconds, on flush() and at exit.
+
+    The client, experiment and run are created by the worker, so neither the
+    import of mlflow nor the round trips to the server block training. After
+    the first failure the logger stays offline for the rest of the process
+    and spools its batches to spool_dir.
+    """
+
+    def __init__(
+        self,
+        tracking_uri,
+        experiment_name,
+        flush_interval=5.0,
+        spool_dir=None,
+        close_timeout=30.0,
+    ):
+        self.tracking_uri = tracking_uri
+        self.experiment_name = experiment_name
+        self.flush_interval = flush_interval
+        self.spool_dir = spool_dir or SPOOL_DIR
+        self.close_timeout = close_timeout
+        self.spool_path = os.path.join(self.spool_dir, f"{uuid.uuid4().hex}.jsonl")
+        self.client = None
+        self.run_id = None
+        self.offline = False
+        self.closed = False
+        self._params = {}  # logged so far in this run
+        self._queue = queue.Queue()
+        self._spool_lock = threading.Lock()
+        self._thread = threading.Thread(
+            target=self._work, name="mlflow-logger", daemon=True
+        )
+        self._thread.start()
+        atexit.register(self.close)
+
+    def log_param(self, key, value):
+        # mlflow stores params as strings, do not keep references to objects
+        self._queue.put(("param", key, str(value)))
+
+    def log_metric(self, key, value, step=0):
+        self._queue.put(("metric", key, float(value), now_ms(), step))
+
+    def flush(self, timeout=None):
+        """Block until everything logged so far was sent or spooled"""
+        if self.closed:
+            return True
+        done = threading.Event()
+        self._queue.put((_FLUSH, done))
+        return done.wait(timeout)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self._queue.put((_CLOSE,))
+        self._thread.join(self.close_timeout)
+        if self._thread.is_alive():
+            # stuck on the server: keep what is still queued for a replay
+            self._spool(self._drain([]))
+
+    def _drain(self, pending):
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                return pending
+            if item[0] is _FLUSH:
+                # closing: nobody should wait on a flush any more
+                item[1].set()
+            elif item[0] is not _CLOSE:
+                pending.append(item)
+
+    def _work(self):
+        pending = []
+        deadline = time.monotonic() + self.flush_interval
+        while True:
+            try:
+                item = self._queue.get(timeout=max(0, deadline - time.monotonic()))
+            except queue.Empty:
+                item = None
+            if item is not None and item[0] is _CLOSE:
+                self._send(self._drain(pending))
+                return
+            if item is not None and item[0] is _FLUSH:
+                self._send(pending)
+                pending = []
+                item[1].set()
+                continue
+            if item is not None:
+                pending.append(item)
+            if time.monotonic() >= deadline:
+                self._send(pending)
+                pending = []
+                deadline = time.monotonic() + self.flush_interval
+
+    def _connect(self):
+        self.client = get_client(self.tracking_uri)
+        experiment_id = get_experiment_id(self.client, self.experiment_name)
+        self.run_id = self.client.create_run(experiment_id).info.run_id
+        # the server is back: send what earlier runs could not
+        replay_spool(self.spool_dir, self.tracking_uri, skip=(self.spool_path,))
+
+    def _send(self, pending):
+        if not pending:
+            return
+        params, metrics = self._split(pending)
+        if not self.offline:
+            try:
+                if self.run_id is None:
+                    self._connect()
+                log_batch(self.client, self.run_id, params, metrics)
+                return
+            except Exception as exc:
+                if self.run_id is not None and is_rejected(exc):
+                    print(f"-> mlflow batch rejected: {exc!r}", file=sys.stderr)
+                    return
+                print(
+                    f"-> mlflow unreachable ({exc!r}), spooling to {self.spool_path}",
+                    file=sys.stderr,
+                )
+                self.offline = True
+        self._write_spool(params, metrics)
+
+    def _split(self, pending):
+        """Queued items as a batch. The params of a run cannot change: a new
+        value of an already logged key is dropped rather than failing the
+        whole batch"""
+        params, metrics = {}, []
+        for kind, key, *rest in pending:
+            if kind == "metric":
+                metrics.append((key, *rest))
+            elif key not in self._params:
+                self._params[key] = params[key] = rest[0]
+            elif self._params[key] != rest[0]:
+                print(
+                    f"-> mlflow param {key}={rest[0]} ignored, "
+                    f"already logged as {self._params[key]}",
+                    file=sys.stderr,
+                )
+        return params, metrics
+
+    def _spool(self, pending):
+        if pending:
+            self._write_spool(*self._split(pending))
+
+    def _write_spool(self, params, metrics):
+        with self._spool_lock:
+            os.makedirs(self.spool_dir, exist_ok=True)
+            lines = []
+            if not os.path.exists(self.spool_path):
+                header = dict(
+                    tracking_uri=self.tracking_uri,
+                    experiment_name=self.experiment_name,
+                    run_id=self.run_id,
+                )
+                lines.append(json.dumps(header))
+            lines.append(json.dumps(dict(params=params, metrics=metrics)))
+            with open(self.spool_path, "a") as f:
+                f.write("\n".join(lines) + "\n")
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] != ["replay"]:
+        sys.exit(__doc__)
+    print(f"{replay_spool()} spooled run(s) replayed")
@@ -1,42 +1,56 @@
+import json
+import os
 import time
 import warnings
 import multiprocessing
 
 
-import category_encoders as ce
 import joblib
-import mlflow
+from joblib import effective_n_jobs
+import numpy as np
 import pandas as pd
 
 from sklearn.compose import ColumnTransformer
 from sklearn.ensemble import GradientBoostingRegressor, RandomForestRegressor
 from sklearn.linear_model import Lasso, Ridge, LinearRegression
-from sklearn.model_selection import train_test_split, RandomizedSearchCV
-from sklearn.pipeline import Pipeline, make_pipeline
+from sklearn.pipeline import Pipeline
 from sklearn.preprocessing import OneHotEncoder, StandardScaler
 from sklearn.linear_model import SGDRegressor
 
 from TaxiFareModel.data import get_data, clean_df, DIST_ARGS
 from TaxiFareModel.encoders import (
     TimeFeaturesEncoder,
+    TimeFeaturesOneHot,
     DistanceTransformer,
-    AddGeohash,
+    GeohashEncoder,
     Direction,
     DistanceToCenter,
     DataframeCleaner,
+    GeoFeatures,
+    RowParallel,
+    CachedTransformer,
 )
-from TaxiFareModel.utils import compute_rmse, simple_time_tracker
+from TaxiFareModel.artifact import save_artifact
+from TaxiFareModel.predict import manifest_location
+from TaxiFareModel.boosting import (
+    booster_params,
+    cached_train_matrix,
+    is_xgboost,
+    train_booster,
+    train_matrix,
+)
+from TaxiFareModel.search import successive_halving
+from TaxiFareModel.tracking import MlflowLogger
+from TaxiFareModel.instrument import get_registry, span, timed
+from TaxiFareModel.utils import compute_rmse, split_indices, take_rows
 
-from mlflow.tracking import MlflowClient
 from memoized_property import memoized_property
 from psutil import virtual_memory
 from termcolor import colored
-from xgboost import XGBRegressor
-from tempfile import mkdtemp
-from google.cloud import storage
+from TaxiFareModel import cache
 
 
-MLFLOW_URI = "https://mlflow.lewagon.co/"
+MLFLOW_URI = os.environ.get("MLFLOW_TRACKING_URI", "https://mlflow.lewagon.co/")
 myname = "Phillip"
 EXPERIMENT_NAME = f"[Fed-up!] TaxifareModel_{myname}"
 BUCKET_NAME = "wagon-ml-zastrow-566"
@@ -44,6 +58,7 @@ BUCKET_TRAIN_DATA_PATH = "data/train_1k.csv"
 MODEL_NAME = "taxifare"
 MODEL_VERSION = "v1"
 STORAGE_LOCATION = "models/taxifare/model.joblib"
+ARTIFACT_PATH = "model.tfm"
 
 
 class Trainer(object):
@@ -53,6 +68,9 @@ class Trainer(object):
         y: pandas Series
         """
         self.pipeline = None
+        self.dtrain = None  # xgboost training matrix kept by the fast path
+        self.F_train = None  # training features kept by train() for evaluate()
+        self.out_of_core = False  # trained on streamed chunks, not on X
         self.kwargs = kwargs
         self.local = kwargs.get("local", False)  # if True training is done locally
         self.mlflow = kwargs.get("mlflow", False)  # if True log info to nlflow
@@ -68,9 +86,19 @@ class Trainer(object):
         del X, y
         self.split = self.kwargs.get("split", True)  # cf doc above
         if self.split:
-            self.X_train, self.X_val, self.y_train, self.y_val = train_test_split(
-                self.X_train, self.y_train, test_size=0.15
+            # the shuffled split copies X once (in random order); with
+            # split_shuffle=False the tail of X is held out and both parts
+            # are views, for rows that are already in random order
+            train_rows, val_rows = split_indices(
+                self.X_train.shape[0],
+                test_size=0.15,
+                random_state=self.kwargs.get("random_state"),
+                shuffle=self.kwargs.get("split_shuffle", True),
             )
+            self.X_val = take_rows(self.X_train, val_rows)
+            self.y_val = take_rows(self.y_train, val_rows)
+            self.X_train = take_rows(self.X_train, train_rows)
+            self.y_train = take_rows(self.y_train, train_rows)
         self.nrows = self.X_train.shape[0]  # nb of rows to train on
         self.log_kwargs_params()
         self.log_machine_specs()
@@ -91,11 +119,15 @@ class Trainer(object):
         elif estimator == "RandomForest":
             model = RandomForestRegressor()
             self.model_params = {  
-                "max_features": ["auto", "sqrt"]
+                "max_features": [1.0, "sqrt"]
             }
         elif estimator == "xgboost":
+            from xgboost import XGBRegressor
+
             model = XGBRegressor(objective='reg:squarederror', 
-                                 n_jobs=-1, 
+                                 n_jobs=self.kwargs.get("xgb_n_jobs", -1),
+                                 tree_method="hist",
+                                 max_bin=self.kwargs.get("xgb_max_bin", 256),
                                  max_depth=10, 
                                  learning_rate=0.05,
                                  gamma=3)
@@ -116,13 +148,18 @@ class Trainer(object):
         dist = self.kwargs.get("distance_type", "euclidian")
         feateng_steps = self.kwargs.get("feateng", ["distance", "time_features"])
         if memory:
-            memory = mkdtemp()
-        time_pipe = Pipeline(
-            [
-                ("time_enc", TimeFeaturesEncoder("pickup_datetime")),
-                ("ohe", OneHotEncoder(handle_unknown="ignore")),
-            ]
-        )
+            # a folder to reuse across runs, True for the default cache folder
+            if not isinstance(memory, str):
+                memory = os.path.join(cache.CACHE_DIR, "pipeline_memory")
+        if self.kwargs.get("fast_time_features", False):
+            time_pipe = Pipeline([("time_ohe", TimeFeaturesOneHot("pickup_datetime"))])
+        else:
+            time_pipe = Pipeline(
+                [
+                    ("time_enc", TimeFeaturesEncoder("pickup_datetime")),
+                    ("ohe", OneHotEncoder(handle_unknown="ignore")),
+                ]
+            )
         dist_pipe = Pipeline(
             [
                 ("dist_trans", DistanceTransformer(distance_type=dist, **DIST_ARGS)),
@@ -133,7 +170,15 @@ class Trainer(object):
             [("distance_center", DistanceToCenter()), ("stdscaler", StandardScaler())]
         )
         geohash_pipe = Pipeline(
-            [("deohash_add", AddGeohash()), ("hash_encode", ce.HashingEncoder())]
+            [
+                (
+                    "geohash_enc",
+                    GeohashEncoder(
+                        precision=self.kwargs.get("geohash_precision", 6),
+                        hash_bits=self.kwargs.get("geohash_hash_bits", 8),
+                    ),
+                )
+            ]
         )
         direction_pipe = Pipeline(
             [("direction_add", Direction()), ("stdscaler", StandardScaler())]
@@ -141,47 +186,279 @@ class Trainer(object):
         feateng_blocks = [
             ("distance", dist_pipe, list(DIST_ARGS.values())),
             ("time_features", time_pipe, ["pickup_datetime"]),
-            #("geohash", geohash_pipe, list(DIST_ARGS.values())),
+            ("geohash", geohash_pipe, list(DIST_ARGS.values())),
             ("direction", direction_pipe, list(DIST_ARGS.values())),
             ("distance_to_center", center_pipe, list(DIST_ARGS.values())),
         ]
-        for bloc in feateng_blocks:
-            if bloc[0] not in feateng_steps:
-                feateng_blocks.remove(bloc)
+        feateng_blocks = [bloc for bloc in feateng_blocks if bloc[0] in feateng_steps]
+        if self.kwargs.get("fused_geo", False):
+            # one pass over the coordinates for all the geo blocks
+            geo_steps = [
+                step
+                for step in ["distance", "direction", "distance_to_center"]
+                if step in feateng_steps
+            ]
+            if geo_steps:
+                geo_pipe = Pipeline(
+                    [
+                        ("geo_features", GeoFeatures(distance_type=dist, features=geo_steps)),
+                        ("stdscaler", StandardScaler()),
+                    ]
+                )
+                feateng_blocks = [("geo", geo_pipe, list(DIST_ARGS.values()))] + [
+                    bloc for bloc in feateng_blocks if bloc[0] not in geo_steps
+                ]
+
+        # parallel feature engineering: "blocks" runs the blocks concurrently,
+        # "rows" splits the rows of each block head across the workers
+        n_jobs = self.kwargs.get("feateng_n_jobs", None)
+        parallel = self.kwargs.get("feateng_parallel", "rows")
+        if n_jobs not in (None, 1) and parallel == "rows":
+            for _, pipe, _ in feateng_blocks:
+                name, head = pipe.steps[0]
+                pipe.steps[0] = (name, RowParallel(head, n_jobs=n_jobs))
 
+        if self.kwargs.get("feature_cache", False):
+            # reuse block outputs across runs and estimators fitted on the same data
+            feateng_blocks = [
+                (
+                    name,
+                    CachedTransformer(
+                        pipe,
+                        cache_dir=self.kwargs.get("feature_cache_dir"),
+                        max_bytes=self.kwargs.get("feature_cache_max_bytes"),
+                    ),
+                    cols,
+                )
+                for name, pipe, cols in feateng_blocks
+            ]
+
+        # keep the feature matrix sparse up to the regressor
+        keep_sparse = self.kwargs.get("sparse_features", False)
         features_encoder = ColumnTransformer(
-            feateng_blocks, n_jobs=None, remainder="drop"
+            feateng_blocks,
+            n_jobs=n_jobs if parallel == "blocks" else None,
+            remainder="drop",
+            sparse_threshold=1.0 if keep_sparse else 0.3,
         )
         self.pipeline = Pipeline(
             steps=[
                 ("features", features_encoder), 
-                ("df_clener", DataframeCleaner(verbose=False)),
+                ("df_clener", DataframeCleaner(verbose=False, keep_sparse=keep_sparse)),
                 ("rgs", self.get_estimator())],
             memory=memory,
         )
 
-    @simple_time_tracker
+    @timed("train", rows=lambda self: self.nrows, verbose=True)
     def train(self):
         tic = time.time()
         self.set_pipeline()
-        self.pipeline.fit(self.X_train, self.y_train)
+        self.dtrain = None
+        self.F_train = None
+        self.out_of_core = False
+        with span("fit", rows=self.nrows):
+            if self.kwargs.get("xgb_fast_path", True) and is_xgboost(
+                self.pipeline.steps[-1][1]
+            ):
+                self.train_xgboost()
+            elif self.pipeline.memory is None:
+                self.fit_pipeline()
+            else:
+                self.pipeline.fit(self.X_train, self.y_train)
         # mlflow logs
         self.mlflow_log_metric("train_time", int(time.time() - tic))
 
+    def fit_pipeline(self):
+        """pipeline.fit step by step, keeping the training features in
+        self.F_train so that evaluate() only runs the regressor on them
+        (keep_train_features=False frees them right away)"""
+        F_train = self.X_train
+        for _, step in self.pipeline.steps[:-1]:
+            F_train = step.fit_transform(F_train, self.y_train)
+        self.pipeline.steps[-1][1].fit(F_train, self.y_train)
+        if self.kwargs.get("keep_train_features", True):
+            self.F_train = F_train
+
+    def train_xgboost(self):
+        """xgboost fast path: the float32 (or sparse) features go straight to
+        a quantized matrix and the native api, the matrix is kept so that
+        evaluate() does not recompute the training features. With
+        feature_cache the fitted steps and the float32 features are stored
+        on disk, see cached_train_matrix"""
+        steps = [step for _, step in self.pipeline.steps[:-1]]
+        model = self.pipeline.steps[-1][1]
+        if self.kwargs.get("feature_cache", False):
+            steps, self.dtrain = cached_train_matrix(
+                steps,
+                self.X_train,
+                self.y_train,
+                cache_dir=self.kwargs.get("feature_cache_dir"),
+                max_bytes=self.kwargs.get("feature_cache_max_bytes"),
+            )
+            self.pipeline.steps[:-1] = [
+                (name, step) for (name, _), step in zip(self.pipeline.steps, steps)
+            ]
+        else:
+            F_train = self.X_train
+            for step in steps:
+                F_train = step.fit_transform(F_train, self.y_train)
+            max_bin = booster_params(model)["max_bin"]
+            self.dtrain = train_matrix(F_train, self.y_train, max_bin)
+            del F_train
+        train_booster(model, self.dtrain)
+
+    @timed("train_out_of_core", rows=lambda self, chunks: self.nrows, verbose=True)
+    def train_out_of_core(self, chunks):
+        """Train on data that does not fit in memory. `chunks` is a callable
+        returning a new iterator of cleaned DataFrame chunks (with the
+        fare_amount column), e.g. lambda: stream_data(**params). A first pass
+        fits the feature statistics, then the estimator learns chunk by chunk
+        (partial_fit) or xgboost builds its matrix from the chunks.
+        X and y given to the Trainer are only used by evaluate(), which logs
+        their rmse as rmse_eval rather than rmse_train"""
+        from TaxiFareModel.incremental import (
+            fit_features_streaming,
+            train_partial_fit,
+            train_xgboost_streaming,
+        )
+
+        tic = time.time()
+        self.set_pipeline()
+        self.dtrain = None
+        self.F_train = None
+        self.out_of_core = True
+        steps = [step for _, step in self.pipeline.steps[:-1]]
+        model = self.pipeline.steps[-1][1]
+        n_rows = fit_features_streaming(steps, chunks)
+        if hasattr(model, "partial_fit"):
+            train_partial_fit(
+                model, steps, chunks, n_epochs=self.kwargs.get("n_epochs", 1)
+            )
+        elif is_xgboost(model):
+            train_xgboost_streaming(
+                model,
+                steps,
+                chunks,
+                external_memory=self.kwargs.get("xgb_external_memory", True),
+                cache_dir=self.kwargs.get("feature_cache_dir"),
+            )
+        else:
+            raise ValueError(
+                f"{model.__class__.__name__} cannot be trained out of core, "
+                "use SGDRegressor or xgboost"
+            )
+        self.nrows = n_rows
+        self.mlflow_log_param("out_of_core_rows", n_rows)
+        self.mlflow_log_metric("train_time", int(time.time() - tic))
+
+    @timed("search", rows=lambda self: self.nrows, verbose=True)
+    def search(self):
+        """Budgeted successive halving over self.model_params, the features
+        are computed once and shared by all candidates. The best params are
+        kept in kwargs["estimator_params"] for the next train()"""
+        self.set_pipeline()
+        if not self.model_params:
+            raise ValueError(f"no search space for {self.kwargs.get('estimator')}")
+        steps = [step for _, step in self.pipeline.steps[:-1]]
+        model = self.pipeline.steps[-1][1]
+        F_train = self.X_train
+        for step in steps:
+            F_train = step.fit_transform(F_train, self.y_train)
+        if self.split:
+            F_val, y_val = self.X_val, self.y_val
+            for step in steps:
+                F_val = step.transform(F_val)
+            F_fit, y_fit = F_train, self.y_train
+        else:
+            # X_train is not shuffled without a split, hold out its tail
+            n_val = max(1, int(0.15 * F_train.shape[0]))
+            if F_train.shape[0] - n_val < 1:
+                raise ValueError(f"{F_train.shape[0]} rows are too few to search")
+            F_fit, y_fit = F_train[:-n_val], self.y_train[:-n_val]
+            F_val, y_val = F_train[-n_val:], self.y_train[-n_val:]
+        n_jobs = effective_n_jobs(self.kwargs.get("search_n_jobs", -1))
+        if "n_jobs" in model.get_params():
+            # share the cores between the candidates fitted concurrently
+            model.set_params(n_jobs=max(1, multiprocessing.cpu_count() // n_jobs))
+        report = successive_halving(
+            model,
+            self.model_params,
+            F_fit,
+            y_fit,
+            F_val,
+            y_val,
+            n_candidates=self.kwargs.get("search_candidates", 16),
+            eta=self.kwargs.get("search_eta", 3),
+            min_rows=self.kwargs.get("search_min_rows", 1000),
+            time_budget=self.kwargs.get("search_time_budget"),
+            row_budget=self.kwargs.get("search_row_budget"),
+            n_jobs=n_jobs,
+            early_stopping_rounds=self.kwargs.get("early_stopping_rounds", 10),
+            random_state=self.kwargs.get("random_state"),
+        )
+        for res in report["results"]:
+            print(
+                colored(
+                    f"round {res['round']} rows {res['rows']} rmse {res['rmse']} "
+                    f"in {res['fit_seconds']}s: {res['params']}",
+                    "yellow",
+                )
+            )
+        if report["best_params"] is None:
+            print(colored("no candidate fitted within the search budget", "yellow"))
+            return report
+        best_params = dict(report["best_params"])
+        if report["best_iteration"] is not None and "n_estimators" in best_params:
+            # early stopping found how many rounds are actually useful
+            best_params["n_estimators"] = report["best_iteration"] + 1
+        print(colored(f"best params: {best_params} rmse {report['best_rmse']}", "green"))
+        for k, v in best_params.items():
+            self.mlflow_log_param(f"best_{k}", v)
+        self.mlflow_log_metric("search_rmse_val", report["best_rmse"])
+        self.mlflow_log_metric("search_time", report["seconds"])
+        self.kwargs["estimator_params"] = {
+            **self.kwargs.get("estimator_params", {}),
+            **best_params,
+        }
+        return report
+
+    @timed("evaluate", rows=lambda self: self.nrows)
     def evaluate(self):
-        rmse_train = self.compute_rmse(self.X_train, self.y_train)
-        self.mlflow_log_metric("rmse_train", rmse_train)
+        # out of core the model never saw X: its rmse is not a training one
+        name = "eval" if self.out_of_core else "train"
+        rmse_train = self.compute_rmse_train()
+        self.mlflow_log_metric(f"rmse_{name}", rmse_train)
         if self.split:
             rmse_val = self.compute_rmse(self.X_val, self.y_val, show=True)
             self.mlflow_log_metric("rmse_val", rmse_val)
             print(
                 colored(
-                    "rmse train: {} || rmse val: {}".format(rmse_train, rmse_val),
+                    "rmse {}: {} || rmse val: {}".format(name, rmse_train, rmse_val),
                     "blue",
                 )
             )
         else:
-            print(colored("rmse train: {}".format(rmse_train), "blue"))
+            print(colored("rmse {}: {}".format(name, rmse_train), "blue"))
+
+    def compute_rmse_train(self):
+        """rmse on the training rows, from the features computed by train()
+        when it kept them. train_rmse_rows=n estimates it on n random rows"""
+        n_rows = self.kwargs.get("train_rmse_rows")
+        n_train = len(self.y_train)  # out of core self.nrows were streamed
+        rows = slice(None)
+        if n_rows and n_rows < n_train:
+            rng = np.random.default_rng(self.kwargs.get("random_state"))
+            rows = np.sort(rng.choice(n_train, n_rows, replace=False))
+        y_train = np.asarray(self.y_train)[rows]
+        model = self.pipeline.steps[-1][1]
+        if self.dtrain is not None and isinstance(rows, slice):
+            y_pred = model.get_booster().predict(self.dtrain)
+        elif self.F_train is not None:
+            y_pred = model.predict(take_rows(self.F_train, rows))
+            self.F_train = None  # only needed once, give the memory back
+        else:
+            return self.compute_rmse(take_rows(self.X_train, rows), y_train)
+        return round(compute_rmse(y_pred, y_train), 3)
 
     def compute_rmse(self, X_test, y_test, show=False):
         if self.pipeline is None:
@@ -194,8 +471,10 @@ class Trainer(object):
         rmse = compute_rmse(y_pred, y_test)
         return round(rmse, 3)
 
+    @timed("save")
     def save_model(self):
-        """Save the model into a .joblib format"""
+        """Save the model into a .joblib format, and into the compact
+        model.tfm artifact when the pipeline can be compiled"""
         if self.final_model:
             self.storage_loc = "models/taxifare/final_model.joblib"
         else:
@@ -203,6 +482,13 @@ class Trainer(object):
         joblib.dump(self.pipeline, "model.joblib")
         print(self.model_upload)
         print(colored("model.joblib saved locally", "green"))
+        try:
+            save_artifact(self.pipeline, ARTIFACT_PATH)
+            print(colored(f"{ARTIFACT_PATH} saved locally", "green"))
+        except NotImplementedError as e:
+            print(colored(f"no compact artifact for this pipeline: {e}", "yellow"))
+            if os.path.exists(ARTIFACT_PATH):  # from a previous model
+                os.remove(ARTIFACT_PATH)
         if self.model_upload:
             print("uploading to gcp")
             self.upload_model_to_gcp()
@@ -211,36 +497,57 @@ class Trainer(object):
             )
 
     def upload_model_to_gcp(self):
+        from google.cloud import storage
+
         client = storage.Client()
         bucket = client.bucket(BUCKET_NAME)
         blob = bucket.blob(self.storage_loc)
         blob.upload_from_filename("model.joblib")
+        current = self.storage_loc
+        artifact_blob = bucket.blob(os.path.splitext(self.storage_loc)[0] + ".tfm")
+        if os.path.exists(ARTIFACT_PATH):
+            artifact_blob.upload_from_filename(ARTIFACT_PATH)
+            current = artifact_blob.name
+        elif artifact_blob.exists():  # from a previous model
+            artifact_blob.delete()
+        # written last, names the file the api must serve
+        manifest = {"model": current, "joblib": self.storage_loc}
+        bucket.blob(manifest_location(self.storage_loc)).upload_from_string(
+            json.dumps(manifest), content_type="application/json"
+        )
 
     @memoized_property
-    def mlflow_client(self):
-        mlflow.set_tracking_uri(MLFLOW_URI)
-        return MlflowClient()
-
-    @memoized_property
-    def mlflow_experiment_id(self):
-        try:
-            return self.mlflow_client.create_experiment(self.experiment_name)
-        except BaseException:
-            return self.mlflow_client.get_experiment_by_name(
-                self.experiment_name
-            ).experiment_id
-
-    @memoized_property
-    def mlflow_run(self):
-        return self.mlflow_client.create_run(self.mlflow_experiment_id)
+    def mlflow_logger(self):
+        """Params and metrics are batched and sent by a background thread,
+        mlflow_uri can point to a local store (file:///tmp/mlruns)"""
+        return MlflowLogger(
+            self.kwargs.get("mlflow_uri", MLFLOW_URI),
+            self.experiment_name,
+            flush_interval=self.kwargs.get("mlflow_flush_interval", 5),
+            spool_dir=self.kwargs.get("mlflow_spool_dir"),
+        )
 
     def mlflow_log_param(self, key, value):
         if self.mlflow:
-            self.mlflow_client.log_param(self.mlflow_run.info.run_id, key, value)
+            self.mlflow_logger.log_param(key, value)
 
     def mlflow_log_metric(self, key, value):
         if self.mlflow:
-            self.mlflow_client.log_metric(self.mlflow_run.info.run_id, key, value)
+            self.mlflow_logger.log_metric(key, value)
+
+    def mlflow_flush(self, timeout=None):
+        """Wait until everything logged was sent (or spooled)"""
+        if self.mlflow:
+            self.mlflow_logger.flush(timeout)
+
+    def log_instrumentation(self, path=None):
+        """Span totals of the run (wall, cpu, rows, memory) as mlflow
+        metrics, sent in the same batch, and dumped as json to path"""
+        registry = get_registry()
+        for key, value in registry.metrics().items():
+            self.mlflow_log_metric(key, value)
+        if path:
+            registry.dump(path)
 
     def log_estimator_params(self):
         reg = self.get_estimator()
@@ -1,6 +1,25 @@
-import time
+from functools import lru_cache
 
 import numpy as np
+import pandas as pd
+
+
+def haversine_distance(lat_1, lon_1, lat_2, lon_2):
+    """
+    Great circle distance in kms between arrays of points
+    (specified in decimal degrees)
+    """
+    lat_1_rad, lon_1_rad = np.radians(lat_1), np.radians(lon_1)
+    lat_2_rad, lon_2_rad = np.radians(lat_2), np.radians(lon_2)
+    dlon = lon_2_rad - lon_1_rad
+    dlat = lat_2_rad - lat_1_rad
+
+    a = (
+        np.sin(dlat / 2.0) ** 2
+        + np.cos(lat_1_rad) * np.cos(lat_2_rad) * np.sin(dlon / 2.0) ** 2
+    )
+    c = 2 * np.arcsin(np.sqrt(a))
+    return 6371 * c
 
 
 def haversine_vectorized(
@@ -16,22 +35,16 @@ def haversine_vectorized(
     Vectorized version of the haversine distance for pandas df
     Computes distance in kms
     """
-
-    lat_1_rad, lon_1_rad = np.radians(df[start_lat].astype(float)), np.radians(
-        df[start_lon].astype(float)
+    return haversine_distance(
+        df[start_lat].astype(float),
+        df[start_lon].astype(float),
+        df[end_lat].astype(float),
+        df[end_lon].astype(float),
     )
-    lat_2_rad, lon_2_rad = np.radians(df[end_lat].astype(float)), np.radians(
-        df[end_lon].astype(float)
-    )
-    dlon = lon_2_rad - lon_1_rad
-    dlat = lat_2_rad - lat_1_rad
 
-    a = (
-        np.sin(dlat / 2.0) ** 2
-        + np.cos(lat_1_rad) * np.cos(lat_2_rad) * np.sin(dlon / 2.0) ** 2
-    )
-    c = 2 * np.arcsin(np.sqrt(a))
-    return 6371 * c
+
+def minkowski_arrays(lat_1, lon_1, lat_2, lon_2, p):
+    return ((abs(lon_2 - lon_1) ** p) + (abs(lat_2 - lat_1)) ** p) ** (1 / p)
 
 
 def minkowski_distance(
@@ -42,32 +55,252 @@ def minkowski_distance(
     end_lat="dropoff_latitude",
     end_lon="dropoff_longitude",
 ):
-    x1 = df[start_lon]
-    x2 = df[end_lon]
-    y1 = df[start_lat]
-    y2 = df[end_lat]
-    return ((abs(x2 - x1) ** p) + (abs(y2 - y1)) ** p) ** (1 / p)
+    return minkowski_arrays(df[start_lat], df[start_lon], df[end_lat], df[end_lon], p)
 
 
-def compute_rmse(y_pred, y_true):
-    return np.sqrt(((y_pred - y_true) ** 2).mean())
+def calculate_direction(d_lon, d_lat):
+    """heading in degrees of a (d_lon, d_lat) displacement"""
+    d_lon, d_lat = np.asarray(d_lon), np.asarray(d_lat)
+    result = np.zeros(len(d_lon))
+    l = np.sqrt(d_lon**2 + d_lat**2)
+    result[d_lon > 0] = (180 / np.pi) * np.arcsin(d_lat[d_lon > 0] / l[d_lon > 0])
+    idx = (d_lon < 0) & (d_lat > 0)
+    result[idx] = 180 - (180 / np.pi) * np.arcsin(d_lat[idx] / l[idx])
+    idx = (d_lon < 0) & (d_lat < 0)
+    result[idx] = -180 - (180 / np.pi) * np.arcsin(d_lat[idx] / l[idx])
+    return result
+
+
+NYC_CENTER = (40.7141667, -74.0063889)
+
+# columns of geo_features, by group and in output order
+GEO_FEATURE_GROUPS = {
+    "distance": ["distance"],
+    "direction": ["delta_lon", "delta_lat", "direction"],
+    "distance_to_center": [
+        "pickup_distance_to_center",
+        "dropoff_distance_to_center",
+    ],
+}
+
+
+def geo_feature_names(features):
+    return [
+        name
+        for group in GEO_FEATURE_GROUPS
+        if group in features
+        for name in GEO_FEATURE_GROUPS[group]
+    ]
+
+
+def geo_features(lat_1, lon_1, lat_2, lon_2, out, distance_type, features):
+    """fill `out` with the geo feature groups listed in `features` from
+    float64 pickup / dropoff coordinate arrays"""
+    j = 0
+    if "distance" in features:
+        if distance_type == "haversine":
+            out[:, j] = haversine_distance(lat_1, lon_1, lat_2, lon_2)
+        elif distance_type == "euclidian":
+            out[:, j] = minkowski_arrays(lat_1, lon_1, lat_2, lon_2, p=2)
+        elif distance_type == "manhattan":
+            out[:, j] = minkowski_arrays(lat_1, lon_1, lat_2, lon_2, p=1)
+        else:
+            raise ValueError(f"unknown distance_type {distance_type}")
+        j += 1
+    if "direction" in features:
+        delta_lon = lon_1 - lon_2
+        delta_lat = lat_1 - lat_2
+        out[:, j] = delta_lon
+        out[:, j + 1] = delta_lat
+        out[:, j + 2] = calculate_direction(delta_lon, delta_lat)
+        j += 3
+    if "distance_to_center" in features:
+        lat, lon = NYC_CENTER
+        out[:, j] = haversine_distance(lat, lon, lat_1, lon_1)
+        out[:, j + 1] = haversine_distance(lat, lon, lat_2, lon_2)
+    return out
 
 
-################
-#  DECORATORS  #
-################
+GEOHASH_ALPHABET = np.frombuffer(b"0123456789bcdefghjkmnpqrstuvwxyz", dtype=np.uint8)
 
 
-def simple_time_tracker(method):
-    def timed(*args, **kw):
-        ts = time.time()
-        result = method(*args, **kw)
-        te = time.time()
-        if "log_time" in kw:
-            name = kw.get("log_name", method.__name__.upper())
-            kw["log_time"][name] = int(te - ts)
+def geohash_vectorized(lat, lon, precision=6):
+    """
+    Geohash cells of whole coordinate arrays as int64 ids (5 bits per
+    character, precision <= 12). Coordinates are quantized on the geohash
+    grid and their bits interleaved, longitude first, which gives the same
+    cells as the usual bisection algorithm
+    """
+    n_bits = 5 * precision
+    lon_bits, lat_bits = (n_bits + 1) // 2, n_bits // 2
+    lat = np.asarray(lat, dtype=np.float64)
+    lon = np.asarray(lon, dtype=np.float64)
+    lat_q = np.floor((lat + 90.0) / 180.0 * (1 << lat_bits)).astype(np.int64)
+    lon_q = np.floor((lon + 180.0) / 360.0 * (1 << lon_bits)).astype(np.int64)
+    lat_q = np.clip(lat_q, 0, (1 << lat_bits) - 1)
+    lon_q = np.clip(lon_q, 0, (1 << lon_bits) - 1)
+    cells = np.zeros(lat_q.shape, dtype=np.int64)
+    for i in range(n_bits):
+        # even positions (from the most significant bit) take longitude bits
+        if i % 2 == 0:
+            bit = (lon_q >> (lon_bits - 1 - i // 2)) & 1
         else:
-            print(method.__name__, round(te - ts, 2))
-        return result
+            bit = (lat_q >> (lat_bits - 1 - i // 2)) & 1
+        cells = (cells << 1) | bit
+    return cells
+
+
+def geohash_columns(cells, hash_bits=None, categories=None):
+    """Column of each geohash cell in its one-hot block: multiplicative hash
+    into 2**hash_bits columns, or position in the sorted fitted categories.
+    Returns columns, known mask and block width"""
+    if hash_bits is not None:
+        hashed = cells.astype(np.uint64) * np.uint64(0x9E3779B97F4A7C15)
+        cols = (hashed >> np.uint64(64 - hash_bits)).astype(np.int64)
+        return cols, np.ones(len(cells), dtype=bool), 1 << hash_bits
+    pos = np.minimum(np.searchsorted(categories, cells), len(categories) - 1)
+    return pos, categories[pos] == cells, len(categories)
+
+
+def geohash_to_str(cells, precision=6):
+    """base32 strings of int64 geohash cells, e.g. for pygeohash compat"""
+    cells = np.asarray(cells, dtype=np.int64)
+    shifts = 5 * np.arange(precision - 1, -1, -1)
+    chars = GEOHASH_ALPHABET[(cells[:, None] >> shifts) & 31]
+    return np.ascontiguousarray(chars).view(f"S{precision}").ravel().astype(str)
+
+
+def days_from_civil(year, month, day):
+    """days since 1970-01-01 of proleptic gregorian dates (int arrays)"""
+    year = year - (month <= 2)
+    era = year // 400
+    yoe = year - era * 400
+    doy = (153 * np.where(month > 2, month - 3, month + 9) + 2) // 5 + day - 1
+    doe = yoe * 365 + yoe // 4 - yoe // 100 + doy
+    return era * 146097 + doe - 719468
+
+
+def civil_from_days(days):
+    """inverse of days_from_civil, returns (year, month, day) arrays"""
+    z = days + 719468
+    era = z // 146097
+    doe = z - era * 146097
+    yoe = (doe - doe // 1460 + doe // 36524 - doe // 146096) // 365
+    doy = doe - (365 * yoe + yoe // 4 - yoe // 100)
+    mp = (5 * doy + 2) // 153
+    day = doy - (153 * mp + 2) // 5 + 1
+    month = np.where(mp < 10, mp + 3, mp - 9)
+    return yoe + era * 400 + (month <= 2), month, day
+
+
+def utc_seconds(values):
+    """
+    Seconds since epoch of pickup datetimes. Strings in the fixed Kaggle
+    layout "YYYY-mm-dd HH:MM:SS UTC" are decoded straight from their bytes,
+    anything else (other layouts, datetime64 columns) goes through pandas
+    """
+    if pd.api.types.is_datetime64_any_dtype(values):
+        index = pd.DatetimeIndex(values)
+        if index.tz is not None:
+            index = index.tz_convert("UTC").tz_localize(None)
+        return index.values.astype("datetime64[s]").astype(np.int64)
+    # a string longer than the layout still has a character at index 23
+    try:
+        raw = np.asarray(values).astype("S24")
+    except UnicodeEncodeError:  # non ascii strings, compare code points
+        raw = np.asarray(values).astype("U24")
+    b = raw.view(np.uint8 if raw.dtype.kind == "S" else np.uint32)
+    b = b.reshape(len(raw), 24)
+
+    def number(start, stop):
+        out = np.zeros(len(raw), dtype=np.int64)
+        for i in range(start, stop):
+            out = out * 10 + (b[:, i].astype(np.int64) - 48)
+        return out
+
+    digits = b[:, [0, 1, 2, 3, 5, 6, 8, 9, 11, 12, 14, 15, 17, 18]]
+    ok = ((digits >= 48) & (digits <= 57)).all(axis=1)
+    ok &= (b[:, 4] == 45) & (b[:, 7] == 45) & (b[:, 10] == 32)
+    ok &= (b[:, 13] == 58) & (b[:, 16] == 58) & (b[:, 23] == 0)
+    suffix = b[:, 19:23]
+    utc = np.array([ord(c) for c in " UTC"], dtype=b.dtype)
+    ok &= (suffix == utc).all(axis=1) | (suffix == 0).all(axis=1)
+    year, month, day = number(0, 4), number(5, 7), number(8, 10)
+    hour, minute, second = number(11, 13), number(14, 16), number(17, 19)
+    days = days_from_civil(year, month, day)
+    # out of range fields (month 13, February 30, hour 24...) go to pandas
+    y, m, d = civil_from_days(days)
+    ok &= (y == year) & (m == month) & (d == day)
+    ok &= (hour < 24) & (minute < 60) & (second < 60)
+    seconds = days * 86400 + hour * 3600 + minute * 60 + second
+    if not ok.all():
+        bad = np.flatnonzero(~ok)
+        rest = pd.Series(np.asarray(values)[bad])
+        try:
+            parsed = pd.to_datetime(rest, utc=True)
+        except ValueError:  # pandas >= 2 infers one layout from the first row
+            parsed = pd.to_datetime(
+                pd.Series([pd.to_datetime(v, utc=True) for v in rest]), utc=True
+            )
+        seconds[bad] = utc_seconds(parsed)
+    return seconds
+
+
+@lru_cache(maxsize=32)
+def utc_offset_table(time_zone_name, first_year, last_year):
+    """
+    DST transition table of a time zone between two years: the utc seconds at
+    which the offset changes and the offset (in seconds) from that instant on.
+    Built once from an hourly grid, assumes transitions on utc hour boundaries
+    """
+    grid = pd.date_range(
+        f"{first_year - 1}-12-31", f"{last_year + 1}-01-02", freq="h", tz="UTC"
+    )
+    local = grid.tz_convert(time_zone_name).tz_localize(None)
+    offsets = (local - grid.tz_localize(None)).total_seconds().astype(np.int64)
+    offsets = np.asarray(offsets)
+    seconds = grid.tz_localize(None).values.astype("datetime64[s]").astype(np.int64)
+    change = np.flatnonzero(np.diff(offsets)) + 1
+    starts = np.concatenate([[np.iinfo(np.int64).min], seconds[change]])
+    return starts, np.concatenate([offsets[:1], offsets[change]])
+
+
+def time_features_vectorized(values, time_zone_name="America/New_York"):
+    """dow, hour, month, year (local time) of pickup datetimes, as int arrays"""
+    seconds = utc_seconds(values)
+    if len(seconds) == 0:
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty, empty, empty
+    first_year = int(civil_from_days(seconds.min() // 86400)[0])
+    last_year = int(civil_from_days(seconds.max() // 86400)[0])
+    starts, offsets = utc_offset_table(time_zone_name, first_year, last_year)
+    local = seconds + offsets[np.searchsorted(starts, seconds, side="right") - 1]
+    days = local // 86400
+    year, month, _ = civil_from_days(days)
+    dow = (days + 3) % 7  # 1970-01-01 was a thursday, monday is 0
+    hour = (local - days * 86400) // 3600
+    return dow, hour, month, year
+
+
+def compute_rmse(y_pred, y_true):
+    return np.sqrt(((y_pred - y_true) ** 2).mean())
+
+
+def split_indices(n, test_size=0.15, random_state=None, shuffle=True):
+    """Rows of a train / validation split of n rows. Shuffled: the training
+    rows in random order (successive halving fits on their prefixes) and the
+    sorted validation rows, take_rows gathers a copy of each part once.
+    Otherwise two slices, the validation rows being the tail, which
+    take_rows turns into views of the data without any copy"""
+    n_val = int(np.ceil(test_size * n))
+    if not shuffle:
+        return slice(0, n - n_val), slice(n - n_val, n)
+    rows = np.random.default_rng(random_state).permutation(n)
+    return rows[n_val:], np.sort(rows[:n_val])
+
 
-    return timed
+def take_rows(data, rows):
+    """rows (slice or positions) of a DataFrame, Series, array or sparse matrix"""
+    if isinstance(data, (pd.DataFrame, pd.Series)):
+        return data.iloc[rows] if isinstance(rows, slice) else data.take(rows)
+    return data[rows]
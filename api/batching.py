@@ -0,0 +1,124 @@
+import asyncio
+import time
+
+
+class MicroBatcher(object):
+    """Coalesces concurrent single-trip requests into one batched predict.
+
+    Callers `await submit(row)` and get back their own prediction. A single
+    background task pops the first waiting row, keeps collecting until
+    `max_batch_size` rows are queued or `max_wait_ms` elapsed, then runs
+    `predict_fn(rows)` once in the default executor so the event loop keeps
+    accepting requests while the batch is scored.
+    """
+
+    def __init__(self, predict_fn, max_batch_size=64, max_wait_ms=2.0):
+        self.predict_fn = predict_fn
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_wait = max(0.0, float(max_wait_ms)) / 1000
+        self._queue = None
+        self._task = None
+        # batch size histogram with power of two upper bounds
+        self.buckets = []
+        bound = 1
+        while bound < self.max_batch_size:
+            self.buckets.append(bound)
+            bound *= 2
+        self.buckets.append(self.max_batch_size)
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.histogram = {b: 0 for b in self.buckets}
+        self.n_batches = 0
+        self.n_rows = 0
+        self.n_full = 0
+        self.n_timeout = 0
+        self.predict_seconds = 0.0
+
+    async def start(self):
+        if self._task is None:
+            self._queue = asyncio.Queue()
+            self._task = asyncio.get_event_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def submit(self, row):
+        future = asyncio.get_event_loop().create_future()
+        self._queue.put_nowait((row, future))
+        return await future
+
+    async def _collect(self):
+        batch = [await self._queue.get()]
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            if not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+                continue
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    def _record(self, size, seconds):
+        self.n_batches += 1
+        self.n_rows += size
+        self.predict_seconds += seconds
+        if size >= self.max_batch_size:
+            self.n_full += 1
+        else:
+            self.n_timeout += 1
+        for bound in self.buckets:
+            if size <= bound:
+                self.histogram[bound] += 1
+                break
+
+    async def _run(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            batch = await self._collect()
+            # drop callers that went away while waiting
+            batch = [(row, fut) for row, fut in batch if not fut.done()]
+            if not batch:
+                continue
+            rows = [row for row, _ in batch]
+            tic = time.time()
+            try:
+                preds = await loop.run_in_executor(None, self.predict_fn, rows)
+            except Exception as e:
+                for _, fut in batch:
+                    if not fut.done():
+                        fut.set_exception(e)
+                continue
+            finally:
+                self._record(len(batch), time.time() - tic)
+            for (_, fut), pred in zip(batch, preds):
+                if not fut.done():
+                    fut.set_result(pred)
+
+    def stats(self):
+        return {
+            "max_batch_size": self.max_batch_size,
+            "max_wait_ms": self.max_wait * 1000,
+            "batches": self.n_batches,
+            "rows": self.n_rows,
+            "mean_batch_size": round(self.n_rows / self.n_batches, 2)
+            if self.n_batches
+            else 0,
+            "flushed_full": self.n_full,
+            "flushed_on_timeout": self.n_timeout,
+            "predict_seconds": round(self.predict_seconds, 4),
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+            "batch_size_histogram": {f"le_{b}": c for b, c in self.histogram.items()},
+        }
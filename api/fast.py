@@ -1,10 +1,254 @@
-from fastapi import FastAPI
+import hashlib
+import io
+import json
+import os
+import threading
+import time
+
+import numpy as np
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
-from TaxiFareModel.predict import download_model
+from starlette.concurrency import run_in_threadpool
+from api.batching import MicroBatcher
+from api.prediction_cache import PredictionCache
+from TaxiFareModel import artifact, instrument
+from TaxiFareModel.compiled import compile_pipeline
 import pandas as pd
-import joblib
 
 
+MODEL_PATH = os.environ.get("TAXIFARE_MODEL_PATH", "model.joblib")
+# seconds between two checks of the model file, 0 disables hot-swapping
+MODEL_RELOAD_INTERVAL = float(os.environ.get("TAXIFARE_MODEL_RELOAD_INTERVAL", 5))
+# coalesce concurrent /predict_fare/ calls into batched predictions
+MICRO_BATCHING = os.environ.get("TAXIFARE_MICRO_BATCHING", "0") == "1"
+MICRO_BATCH_SIZE = int(os.environ.get("TAXIFARE_MICRO_BATCH_SIZE", 64))
+MICRO_BATCH_WAIT_MS = float(os.environ.get("TAXIFARE_MICRO_BATCH_WAIT_MS", 2))
+# score with the compiled numpy path instead of the sklearn graph when possible
+COMPILED_SCORER = os.environ.get("TAXIFARE_COMPILED_SCORER", "0") == "1"
+# serve repeated /predict_fare/ quotes (same cells, same hour) from memory
+PREDICTION_CACHE = os.environ.get("TAXIFARE_PREDICTION_CACHE", "0") == "1"
+PREDICTION_CACHE_MAX_BYTES = int(
+    os.environ.get("TAXIFARE_PREDICTION_CACHE_MAX_BYTES", 64 * 1024**2)
+)
+PREDICTION_CACHE_TTL = float(os.environ.get("TAXIFARE_PREDICTION_CACHE_TTL", 3600))
+# geohash precision of the quantized coordinates, "exact" to disable
+PREDICTION_CACHE_PRECISION = os.environ.get("TAXIFARE_PREDICTION_CACHE_PRECISION", "8")
+# stage spans inside the pipeline (every encoder transform reads the process
+# memory twice), off unless asked for: /metrics keeps the request latencies
+API_SPANS = os.environ.get("TAXIFARE_API_SPANS", "0") == "1"
+instrument.enable(API_SPANS)
+
+
+class ModelHolder(object):
+    """Keeps the fitted pipeline resident in memory and swaps it when the
+    artifact on disk changes (mtime first, then content hash). The path can
+    be a pickled model.joblib or a compact model.tfm artifact.
+
+    The loaded pipeline and its metadata live in a single dict that is
+    replaced as a whole, so a request grabbing `holder.current` keeps using
+    the same pipeline until it returns, even if a reload happens meanwhile.
+    """
+
+    def __init__(self, path=MODEL_PATH):
+        self.path = path
+        self.current = None
+        self._stat = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def load(self):
+        """Read, hash and unpickle the artifact, then publish it"""
+        with self._lock:
+            stat = os.stat(self.path)
+            with open(self.path, "rb") as f:
+                content = f.read()
+            version = hashlib.sha256(content).hexdigest()
+            self._stat = (stat.st_mtime_ns, stat.st_size)
+            if self.current is not None and self.current["version"] == version:
+                return False
+            tic = time.time()
+            if content.startswith(artifact.MAGIC):
+                # compact artifact: already a compiled scorer, mapped from disk
+                pipeline, scorer = None, artifact.load_artifact(self.path)
+            else:
+                import joblib  # unpickling pulls in sklearn and the model libs
+
+                pipeline, scorer = joblib.load(io.BytesIO(content)), None
+            if COMPILED_SCORER and scorer is None:
+                try:
+                    scorer = compile_pipeline(pipeline)
+                except NotImplementedError as e:
+                    print(f"-> cannot compile pipeline, using it as is: {e}")
+            self.current = dict(
+                pipeline=pipeline,
+                scorer=scorer,
+                format="artifact" if pipeline is None else "joblib",
+                version=version,
+                path=self.path,
+                loaded_at=time.time(),
+                load_seconds=round(time.time() - tic, 4),
+                file_mtime=stat.st_mtime,
+            )
+            print(f"-> model {version[:12]} loaded from {self.path}")
+            return True
+
+    def maybe_reload(self):
+        """Reload only if the file stat changed and its hash differs"""
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return False
+        if (stat.st_mtime_ns, stat.st_size) == self._stat:
+            return False
+        try:
+            return self.load()
+        except Exception as e:  # keep serving the previous model
+            print(f"-> model reload failed, keeping current one: {e}")
+            return False
+
+    def _watch(self, interval):
+        while not self._stop.wait(interval):
+            self.maybe_reload()
+
+    def start_watching(self, interval=MODEL_RELOAD_INTERVAL):
+        if interval <= 0 or self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._watch, args=(interval,), daemon=True
+        )
+        self._thread.start()
+
+    def stop_watching(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def info(self):
+        current = self.current
+        if current is None:
+            return {"loaded": False, "path": self.path}
+        return {
+            "loaded": True,
+            "path": current["path"],
+            "version": current["version"],
+            "loaded_at": current["loaded_at"],
+            "load_seconds": current["load_seconds"],
+            "file_mtime": current["file_mtime"],
+            "compiled": current["scorer"] is not None,
+            "format": current["format"],
+        }
+
+
+model_holder = ModelHolder()
+
+TRIP_COLUMNS = [
+    "pickup_datetime",
+    "pickup_longitude",
+    "pickup_latitude",
+    "dropoff_longitude",
+    "dropoff_latitude",
+    "passenger_count",
+]
+
+
+class InvalidTrips(ValueError):
+    """Well formed body whose trips are not JSON objects (422)"""
+
+
+def _trip_records(records):
+    for i, row in enumerate(records):
+        if not isinstance(row, dict):
+            raise InvalidTrips(f"trip {i} is not a JSON object")
+    return pd.DataFrame.from_records(records)
+
+
+def parse_trips_body(body, content_type=""):
+    """Turn a request body into a DataFrame of raw trips.
+    Accepts a JSON array of trip objects, NDJSON (one trip per line) or a
+    columnar JSON object mapping each column to a list of values"""
+    if "ndjson" in content_type or "jsonlines" in content_type:
+        records = [json.loads(line) for line in body.splitlines() if line.strip()]
+        return _trip_records(records)
+    payload = json.loads(body)
+    if isinstance(payload, dict):
+        return pd.DataFrame(payload)
+    if isinstance(payload, list):
+        return _trip_records(payload)
+    raise ValueError("body must be a JSON array, NDJSON or a columnar object")
+
+
+def validate_trips(df):
+    """Coerce the trip columns in bulk and collect per-row errors.
+    Returns the typed frame and a dict {row position: error message}"""
+    n = len(df)
+    errors = {}
+    X = pd.DataFrame(index=pd.RangeIndex(n))
+    X["key"] = df["key"].values if "key" in df else np.arange(n).astype(str)
+    for col in TRIP_COLUMNS:
+        if col not in df:
+            for i in range(n):
+                errors.setdefault(i, []).append(f"missing {col}")
+            X[col] = np.nan
+            continue
+        values = df[col].values
+        if col == "pickup_datetime":
+            parsed = pd.to_datetime(pd.Series(values), errors="coerce", utc=True)
+            X[col] = values
+        else:
+            parsed = pd.to_numeric(pd.Series(values), errors="coerce")
+            X[col] = parsed.values
+        for i in np.flatnonzero(parsed.isna().values):
+            errors.setdefault(int(i), []).append(f"invalid {col}")
+    if n and "passenger_count" in df:
+        bad = np.flatnonzero(
+            ~X["passenger_count"].between(0, 8).values
+            & X["passenger_count"].notna().values
+        )
+        for i in bad:
+            errors.setdefault(int(i), []).append("passenger_count out of range")
+        count = X["passenger_count"].values
+        # 1.7 passengers would otherwise be scored as 1
+        for i in np.flatnonzero(np.isfinite(count) & (count != np.floor(count))):
+            errors.setdefault(int(i), []).append("passenger_count not an integer")
+    errors = {i: ", ".join(msgs) for i, msgs in errors.items()}
+    return X, errors
+
+
+def predict_rows(rows, current=None):
+    """Score a list of already typed trip dicts with one predict call, with
+    the given model_holder.current (the one loaded now by default)"""
+    current = current or model_holder.current
+    if current["scorer"] is not None:
+        cols = {c: [row[c] for row in rows] for c in TRIP_COLUMNS}
+        return [float(p) for p in current["scorer"].predict(cols)]
+    pipeline = current["pipeline"]
+    return [float(p) for p in pipeline.predict(pd.DataFrame.from_records(rows))]
+
+
+batcher = MicroBatcher(
+    predict_rows, max_batch_size=MICRO_BATCH_SIZE, max_wait_ms=MICRO_BATCH_WAIT_MS
+)
+
+prediction_cache = PredictionCache(
+    max_bytes=PREDICTION_CACHE_MAX_BYTES,
+    ttl=PREDICTION_CACHE_TTL,
+    precision=None
+    if PREDICTION_CACHE_PRECISION == "exact"
+    else int(PREDICTION_CACHE_PRECISION),
+)
+
+FARE_LATENCY = instrument.Histogram(
+    "taxifare_predict_fare_latency_seconds",
+    "latency of /predict_fare/ by source of the fare (cache or model)",
+)
+
+
+def observe_fare(tic, source):
+    FARE_LATENCY.observe(time.perf_counter() - tic, source=source)
 
 
 app = FastAPI()
@@ -17,12 +261,73 @@ app.add_middleware(
     allow_headers=["*"],  # Allows all headers
 )
 
+
+@app.on_event("startup")
+async def load_model():
+    model_holder.load()
+    model_holder.start_watching()
+    if MICRO_BATCHING:
+        await batcher.start()
+
+
+@app.on_event("shutdown")
+async def stop_model_watch():
+    model_holder.stop_watching()
+    await batcher.stop()
+
+
 @app.get("/")
 def index():
     return {"greeting": "Hello world"}
 
+
+@app.get("/health")
+def health():
+    return {"status": "ok" if model_holder.current else "no model"}
+
+
+@app.get("/model")
+def model_info():
+    return model_holder.info()
+
+
+@app.get("/batching")
+def batching_stats():
+    return {"enabled": MICRO_BATCHING, **batcher.stats()}
+
+
+@app.get("/prediction_cache")
+def prediction_cache_stats():
+    return {"enabled": PREDICTION_CACHE, **prediction_cache.stats()}
+
+
+@app.get("/metrics")
+def metrics():
+    """Prometheus metrics: /predict_fare/ latencies, prediction cache events
+    and the span totals of the process (pickled pipeline transforms)"""
+    stats = prediction_cache.stats()
+    counters = {
+        "taxifare_prediction_cache_events_total": (
+            "prediction cache hits, misses, evictions and expirations",
+            {
+                (("event", event),): stats[field]
+                for event, field in [
+                    ("hit", "hits"),
+                    ("miss", "misses"),
+                    ("eviction", "evictions"),
+                    ("expiration", "expirations"),
+                ]
+            },
+        )
+    }
+    return PlainTextResponse(
+        instrument.prometheus_text([FARE_LATENCY], counters),
+        media_type="text/plain; version=0.0.4",
+    )
+
+
 @app.get("/predict_fare/")
-def create_fare(
+async def create_fare(
     key,
     pickup_datetime,
     pickup_longitude,
@@ -31,7 +336,7 @@ def create_fare(
     dropoff_latitude,
     passenger_count
     ):
-    
+
     # key = "2013-07-06 17:18:00.000000119"
     # pickup_datetime = "2013-07-06 17:18:00 UTC"
     # pickup_longitude = "-73.950655"
@@ -41,19 +346,63 @@ def create_fare(
     # passenger_count = "1"
 
     # build X ⚠️ beware to the order of the parameters ⚠️
-    
-    print(pickup_longitude)
-    X = pd.DataFrame(dict(
-        key=[key],
-        pickup_datetime=[pickup_datetime],
-        pickup_longitude=[float(pickup_longitude)],
-        pickup_latitude=[float(pickup_latitude)],
-        dropoff_longitude=[float(dropoff_longitude)],
-        dropoff_latitude=[float(dropoff_latitude)],
-        passenger_count=[int(passenger_count)]))
-        
-    pipeline = joblib.load("model.joblib")
-    #pipline = download_model()
-    pred = pipeline.predict(X)
-    fare_amount = float(pred[0])
-    return {"fare_amount" : fare_amount}
\ No newline at end of file
+
+    row = dict(
+        key=key,
+        pickup_datetime=pickup_datetime,
+        pickup_longitude=float(pickup_longitude),
+        pickup_latitude=float(pickup_latitude),
+        dropoff_longitude=float(dropoff_longitude),
+        dropoff_latitude=float(dropoff_latitude),
+        passenger_count=int(passenger_count))
+
+    tic = time.perf_counter()
+    # read once: the cache key and the prediction must come from one model
+    current = model_holder.current
+    cache_key = None
+    if PREDICTION_CACHE:
+        cache_key = prediction_cache.key(current["version"], row)
+        fare_amount = prediction_cache.get(cache_key)
+        if fare_amount is not None:
+            observe_fare(tic, "cache")
+            return {"fare_amount": fare_amount}
+
+    if MICRO_BATCHING:
+        fare_amount = await batcher.submit(row)
+        if model_holder.current is not current:
+            cache_key = None  # swapped meanwhile, the batch may have used the new model
+    else:
+        #pipline = download_model()
+        fare_amount = (await run_in_threadpool(predict_rows, [row], current))[0]
+    if cache_key is not None:
+        prediction_cache.put(cache_key, fare_amount)
+    observe_fare(tic, "model")
+    return {"fare_amount" : fare_amount}
+
+
+@app.post("/predict_fares")
+async def create_fares(request: Request):
+    """Batch version of /predict_fare/, scores all valid trips in a single
+    pipeline.predict call and returns fares in input order"""
+    body = await request.body()
+    try:
+        df = parse_trips_body(body, request.headers.get("content-type", ""))
+    except InvalidTrips as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    X, errors = validate_trips(df)
+    valid = np.ones(len(X), dtype=bool)
+    valid[list(errors)] = False
+    fares = np.full(len(X), np.nan)
+    if valid.any():
+        # grab the model once, a concurrent hot-swap won't affect this batch
+        current = model_holder.current
+        predict = (current["scorer"] or current["pipeline"]).predict
+        X_valid = X[valid].reset_index(drop=True)
+        X_valid["passenger_count"] = X_valid["passenger_count"].astype(int)
+        fares[valid] = await run_in_threadpool(predict, X_valid)
+    return {
+        "fare_amount": [float(f) if ok else None for f, ok in zip(fares, valid)],
+        "errors": [{"row": i, "error": errors[i]} for i in sorted(errors)],
+    }
@@ -0,0 +1,134 @@
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from TaxiFareModel.compiled import parse_pickup_datetime
+from TaxiFareModel.utils import geohash_vectorized
+
+# bookkeeping of one OrderedDict entry (node, hash slot, expiry float)
+ENTRY_OVERHEAD = 160
+
+
+class PredictionCache(object):
+    """In-process LRU cache of fares with a time to live and a memory cap.
+
+    A quote is keyed by the model version, the pickup and dropoff geohash
+    cells at `precision` (None keeps the exact coordinates) and the local
+    (year, month, dow, hour) of the pickup, which is all the time features
+    look at. Trips within the same cells and hour share a fare, so re-quotes
+    of the same booking never reach the model. Least recently used entries
+    are evicted beyond max_bytes, expired ones when they are read.
+    """
+
+    def __init__(
+        self,
+        max_bytes=64 * 1024**2,
+        ttl=3600.0,
+        precision=8,
+        time_zone_name="America/New_York",
+    ):
+        self.max_bytes = int(max_bytes)
+        self.ttl = float(ttl) if ttl else None
+        self.precision = precision
+        self.time_zone_name = time_zone_name
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._version = None
+        self.nbytes = 0
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def key(self, version, row):
+        """Cache key of a typed trip dict, None if it cannot be bucketed"""
+        try:
+            dow, hour, month, year = parse_pickup_datetime(
+                row["pickup_datetime"], self.time_zone_name
+            )
+        except (ValueError, TypeError):
+            return None
+        when = (int(year[0]), int(month[0]), int(dow[0]), int(hour[0]))
+        points = []
+        for point in ["pickup", "dropoff"]:
+            lat, lon = row[f"{point}_latitude"], row[f"{point}_longitude"]
+            if self.precision is None:
+                points.append((float(lat), float(lon)))
+            else:
+                cell = geohash_vectorized(
+                    np.array([lat]), np.array([lon]), self.precision
+                )
+                points.append(int(cell[0]))
+        return (version,) + tuple(points) + when
+
+    @staticmethod
+    def _entry_size(key):
+        size = sys.getsizeof(key) + sum(sys.getsizeof(part) for part in key)
+        return size + sys.getsizeof(0.0) + ENTRY_OVERHEAD
+
+    def get(self, key):
+        if key is None:
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            value, expires, size = entry
+            if expires is not None and expires < time.monotonic():
+                del self._entries[key]
+                self.nbytes -= size
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        if key is None:
+            return
+        with self._lock:
+            if key[0] != self._version:
+                # a new model was loaded, the previous fares are stale
+                self._clear()
+                self._version = key[0]
+            if key in self._entries:
+                self.nbytes -= self._entries.pop(key)[2]
+            size = self._entry_size(key)
+            expires = time.monotonic() + self.ttl if self.ttl else None
+            self._entries[key] = (value, expires, size)
+            self.nbytes += size
+            while self.nbytes > self.max_bytes and self._entries:
+                _, (_, _, evicted) = self._entries.popitem(last=False)
+                self.nbytes -= evicted
+                self.evictions += 1
+
+    def _clear(self):
+        self._entries.clear()
+        self.nbytes = 0
+
+    def clear(self):
+        with self._lock:
+            self._clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self.nbytes,
+            "max_bytes": self.max_bytes,
+            "ttl": self.ttl,
+            "precision": self.precision,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
@@ -0,0 +1,347 @@
+"""Benchmarks of the data, feature and model stages on synthetic trips (no
+download needed), at several sizes, against a stored baseline:
+
+    python -m benchmarks.benchmark --output benchmarks/baseline.json
+    python -m benchmarks.benchmark --baseline benchmarks/baseline.json
+
+Run from the repository root, the suite is not installed with the package.
+Every stage reports its best wall time over --repeat runs, its throughput
+and the peak memory it allocated (tracemalloc, in a separate untimed run).
+Fails (exit code 1) when a stage is slower or bigger than the baseline by
+more than --threshold.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+from TaxiFareModel.data import (
+    DATETIME_FORMAT,
+    DIST_ARGS,
+    clean_df,
+    df_optimized,
+    get_data,
+)
+
+SIZES = [1000, 10000, 100000]
+# Trainer defaults, --feateng benchmarks other blocks
+FEATENG = ["distance", "time_features"]
+# differences below these are noise, never regressions
+MIN_SECONDS = 0.002
+MIN_MB = 1.0
+
+
+def synthetic_trips(n, seed=0, outliers=0.05):
+    """Deterministic trips with the Kaggle train schema: pickups around
+    Manhattan, gamma distributed trip lengths, a fare growing with the
+    distance, and a share of rows the cleaning must reject (missing or zero
+    coordinates, outside the NYC boxes, bad fares or passenger counts)"""
+    rng = np.random.default_rng(seed)
+    seconds = rng.integers(0, int(6.5 * 365 * 86400), n)
+    when = pd.to_datetime(np.datetime64("2009-01-01", "s") + seconds)
+    pickup_datetime = when.strftime(DATETIME_FORMAT)
+    key = [f"{d[:19]}.{i % 10**7:07d}" for i, d in enumerate(pickup_datetime)]
+    pickup_lat = rng.normal(40.752, 0.03, n)
+    pickup_lon = rng.normal(-73.979, 0.025, n)
+    km = rng.gamma(2.0, 1.6, n)
+    angle = rng.uniform(0, 2 * np.pi, n)
+    dropoff_lat = pickup_lat + km * np.cos(angle) / 111.0
+    dropoff_lon = pickup_lon + km * np.sin(angle) / (111.0 * np.cos(np.radians(40.75)))
+    fare = np.round(np.maximum(2.5 + 2.0 * km + rng.normal(0, 1.5, n), 2.5), 2)
+    passenger_count = rng.choice(
+        np.arange(1, 7), n, p=[0.7, 0.14, 0.05, 0.03, 0.05, 0.03]
+    )
+    df = pd.DataFrame(
+        {
+            "key": key,
+            "fare_amount": fare,
+            "pickup_datetime": pickup_datetime,
+            "pickup_longitude": pickup_lon,
+            "pickup_latitude": pickup_lat,
+            "dropoff_longitude": dropoff_lon,
+            "dropoff_latitude": dropoff_lat,
+            "passenger_count": passenger_count,
+        }
+    )
+    bad = np.flatnonzero(rng.random(n) < outliers)
+    kinds = rng.integers(0, 6, len(bad))
+    for kind, column, value in [
+        (0, "dropoff_latitude", np.nan),
+        (1, "pickup_latitude", 0.0),
+        (2, "dropoff_longitude", -75.5),  # outside the boxes
+        (3, "pickup_latitude", 43.1),
+        (4, "fare_amount", -5.0),
+        (5, "passenger_count", 9),
+    ]:
+        rows = bad[kinds == kind]
+        df.loc[rows, column] = value
+        if kind == 1:
+            df.loc[rows, "pickup_longitude"] = 0.0
+    return df
+
+
+def _coordinates(ctx):
+    return ctx["clean"][list(DIST_ARGS.values())].copy()
+
+
+def _pickup_time(ctx):
+    return ctx["clean"][["pickup_datetime"]].copy()
+
+
+def _encoders():
+    from TaxiFareModel import encoders
+
+    coords = [
+        ("DistanceTransformer", lambda: encoders.DistanceTransformer(**DIST_ARGS)),
+        ("AddGeohash", encoders.AddGeohash),
+        ("GeohashEncoder", encoders.GeohashEncoder),
+        ("DistanceToCenter", encoders.DistanceToCenter),
+        ("Direction", encoders.Direction),
+        ("GeoFeatures", encoders.GeoFeatures),
+    ]
+    times = [
+        (
+            "TimeFeaturesEncoder",
+            lambda: encoders.TimeFeaturesEncoder("pickup_datetime"),
+        ),
+        ("TimeFeaturesOneHot", lambda: encoders.TimeFeaturesOneHot("pickup_datetime")),
+    ]
+    stages = [(name, make, _coordinates) for name, make in coords]
+    stages += [(name, make, _pickup_time) for name, make in times]
+    # the last step before the regressor sees the stacked feature matrix
+    features = lambda ctx: np.random.default_rng(0).random((len(ctx["clean"]), 16))
+    stages.append(("DataframeCleaner", encoders.DataframeCleaner, features))
+    return stages
+
+
+def _trainer(ctx):
+    from TaxiFareModel.trainer import Trainer
+
+    X = ctx["clean"].drop(columns="fare_amount")
+    y = ctx["clean"]["fare_amount"]
+    return Trainer(
+        X,
+        y,
+        estimator=ctx["estimator"],
+        feateng=ctx["feateng"],
+        random_state=0,
+        mlflow=False,
+    )
+
+
+def _trained(ctx):
+    if "trainer" not in ctx:
+        ctx["trainer"] = _trainer(ctx)
+        ctx["trainer"].train()
+    return ctx["trainer"]
+
+
+def _stage_csv_load(ctx):
+    return lambda: get_data(nrows=None, data_origin="local", path=ctx["csv"])
+
+
+def _stage_clean_df(ctx):
+    return lambda: clean_df(ctx["raw"], verbose=False)
+
+
+def _stage_df_optimized(ctx):
+    df = ctx["clean"].copy()
+    return lambda: df_optimized(df, verbose=False)
+
+
+def _stage_train(ctx):
+    trainer = _trainer(ctx)
+    return trainer.train
+
+
+def _stage_evaluate(ctx):
+    # evaluate() uses up the training features kept by train(), retrain
+    trainer = _trainer(ctx)
+    trainer.train()
+    return trainer.evaluate
+
+
+def _stage_predict_single(ctx):
+    pipeline = _trained(ctx).pipeline
+    rows = [row for _, row in ctx["clean"].head(ctx["single_rows"]).iterrows()]
+    frames = [row.to_frame().T.astype(ctx["clean"].dtypes) for row in rows]
+
+    def run():
+        for frame in frames:
+            pipeline.predict(frame)
+
+    return run
+
+
+def _stage_predict_batch(ctx):
+    pipeline = _trained(ctx).pipeline
+    X = ctx["clean"].drop(columns="fare_amount")
+    return lambda: pipeline.predict(X)
+
+
+def stages():
+    """[(name, factory(ctx) -> zero argument callable, rows(ctx))]. The
+    factory does the setup, only the callable it returns is measured"""
+    n_rows = lambda key: lambda ctx: len(ctx[key])
+    result = [
+        ("csv_load", _stage_csv_load, n_rows("raw")),
+        ("clean_df", _stage_clean_df, n_rows("raw")),
+        ("df_optimized", _stage_df_optimized, n_rows("clean")),
+    ]
+    for name, make, inputs in _encoders():
+        factory = lambda ctx, make=make, inputs=inputs: (
+            lambda X=inputs(ctx): make().fit_transform(X)
+        )
+        result.append((f"encoder.{name}", factory, n_rows("clean")))
+    result += [
+        ("trainer.train", _stage_train, n_rows("clean")),
+        ("trainer.evaluate", _stage_evaluate, n_rows("clean")),
+        ("predict.single", _stage_predict_single, lambda ctx: ctx["single_rows"]),
+        ("predict.batch", _stage_predict_batch, n_rows("clean")),
+    ]
+    return result
+
+
+def measure(factory, ctx, repeat=3):
+    """Best wall time of `repeat` runs and the peak traced memory (MB) of one
+    more run, the setup done by factory is excluded from both"""
+    run = factory(ctx)
+    tracemalloc.start()
+    try:
+        run()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    best = float("inf")
+    for _ in range(repeat):
+        run = factory(ctx)
+        tic = time.perf_counter()
+        run()
+        best = min(best, time.perf_counter() - tic)
+    return best, peak / 1024**2
+
+
+def run_benchmarks(
+    sizes=None, repeat=3, only=None, estimator="Lasso", feateng=None, seed=0
+):
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in sizes or SIZES:
+            csv = os.path.join(tmp, f"trips_{size}.csv")
+            synthetic_trips(size, seed=seed).to_csv(csv, index=False)
+            raw = get_data(nrows=None, data_origin="local", path=csv)
+            ctx = dict(
+                csv=csv,
+                raw=raw,
+                clean=clean_df(raw, verbose=False),
+                estimator=estimator,
+                feateng=feateng or FEATENG,
+                single_rows=min(size, 50),
+            )
+            for name, factory, rows in stages():
+                if only and not any(name.startswith(prefix) for prefix in only):
+                    continue
+                # the stages print their own progress, keep the report readable
+                with contextlib.redirect_stdout(io.StringIO()):
+                    seconds, peak_mb = measure(factory, ctx, repeat)
+                n = rows(ctx)
+                result = dict(
+                    stage=name,
+                    size=size,
+                    rows=n,
+                    seconds=round(seconds, 6),
+                    rows_per_s=round(n / seconds, 1) if seconds else None,
+                    peak_mb=round(peak_mb, 3),
+                )
+                print(
+                    f"{name:32} {size:>9} {seconds * 1000:10.2f}ms "
+                    f"{result['rows_per_s'] or 0:14,.0f} rows/s {peak_mb:9.2f}MB"
+                )
+                results.append(result)
+    return results
+
+
+def environment():
+    import sklearn
+
+    return dict(
+        python=platform.python_version(),
+        platform=platform.platform(),
+        cpus=os.cpu_count(),
+        numpy=np.__version__,
+        pandas=pd.__version__,
+        sklearn=sklearn.__version__,
+        date=time.strftime("%Y-%m-%d %H:%M:%S"),
+    )
+
+
+def compare(results, baseline, threshold=0.2):
+    """Regressions against the baseline results: a stage of the same size
+    slower or using more memory by more than threshold (0.2 = 20%)"""
+    previous = {(r["stage"], r["size"]): r for r in baseline}
+    failures = []
+    for result in results:
+        before = previous.get((result["stage"], result["size"]))
+        if before is None:
+            continue
+        for field, floor, unit in [
+            ("seconds", MIN_SECONDS, "s"),
+            ("peak_mb", MIN_MB, "MB"),
+        ]:
+            old, new = before[field], result[field]
+            if new > old * (1 + threshold) and new - old > floor:
+                failures.append(
+                    f"{result['stage']}@{result['size']} {field}: "
+                    f"{old:.4g}{unit} -> {new:.4g}{unit} (+{(new / old - 1) * 100:.0f}%)"
+                )
+    return failures
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", default=",".join(map(str, SIZES)))
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--stages", default=None, help="comma separated prefixes")
+    parser.add_argument("--estimator", default="Lasso")
+    parser.add_argument("--feateng", default=",".join(FEATENG))
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=None, help="json file of the results")
+    parser.add_argument("--baseline", default=None)
+    parser.add_argument("--threshold", type=float, default=0.2)
+    args = parser.parse_args(argv)
+    results = run_benchmarks(
+        sizes=[int(size) for size in args.sizes.split(",")],
+        repeat=args.repeat,
+        only=args.stages.split(",") if args.stages else None,
+        estimator=args.estimator,
+        feateng=args.feateng.split(","),
+        seed=args.seed,
+    )
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, "w") as f:
+            json.dump(dict(environment=environment(), results=results), f, indent=2)
+        print(f"-> results saved to {args.output}")
+    if not args.baseline:
+        return 0
+    if not os.path.exists(args.baseline):
+        print(f"-> no baseline at {args.baseline}, nothing to compare")
+        return 0
+    with open(args.baseline) as f:
+        failures = compare(results, json.load(f)["results"], args.threshold)
+    for failure in failures:
+        print(f"FAIL {failure}")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
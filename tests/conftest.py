@@ -0,0 +1,39 @@
+import pytest
+
+from benchmarks.benchmark import synthetic_trips
+from TaxiFareModel.data import clean_df
+
+# utc pickups around the America/New_York DST changes: 2013-03-10 07:00 UTC
+# (02:00 EST -> 03:00 EDT) and 2013-11-03 06:00 UTC (02:00 EDT -> 01:00 EST)
+DST_TIMES = [
+    "2013-03-10 06:59:59 UTC",
+    "2013-03-10 07:00:00 UTC",
+    "2013-03-10 07:30:00 UTC",
+    "2013-11-03 05:30:00 UTC",
+    "2013-11-03 05:59:59 UTC",
+    "2013-11-03 06:00:00 UTC",
+    "2013-11-03 06:30:00 UTC",
+    "2012-12-31 23:59:59 UTC",
+    "2013-01-01 04:59:59 UTC",
+    "2013-01-01 05:00:00 UTC",
+    "2012-02-29 12:00:00 UTC",
+]
+
+
+@pytest.fixture(scope="session")
+def raw_trips():
+    """Kaggle schema trips, including rows the cleaning rejects"""
+    return synthetic_trips(600, seed=0)
+
+
+@pytest.fixture(scope="session")
+def trips(raw_trips):
+    """Clean trips whose pickups also cover the DST transitions"""
+    df = clean_df(raw_trips, verbose=False).reset_index(drop=True)
+    df.loc[: len(DST_TIMES) - 1, "pickup_datetime"] = DST_TIMES
+    return df
+
+
+@pytest.fixture(scope="session")
+def X_y(trips):
+    return trips.drop(columns="fare_amount"), trips["fare_amount"]
@@ -0,0 +1,213 @@
+import json
+import os
+import time
+
+import joblib
+import numpy as np
+import pytest
+from fastapi.testclient import TestClient
+
+from api import fast
+from api.prediction_cache import PredictionCache
+from TaxiFareModel.trainer import Trainer
+
+
+def fitted_pipeline(X, y, estimator="Ridge"):
+    trainer = Trainer(
+        X,
+        y,
+        mlflow=False,
+        split=False,
+        estimator=estimator,
+        feateng=["distance", "time_features", "direction"],
+    )
+    trainer.train()
+    return trainer.pipeline
+
+
+@pytest.fixture(scope="module")
+def pipeline(X_y):
+    return fitted_pipeline(*X_y)
+
+
+@pytest.fixture
+def client(pipeline, tmp_path, monkeypatch):
+    path = str(tmp_path / "model.joblib")
+    joblib.dump(pipeline, path)
+    monkeypatch.setattr(fast, "model_holder", fast.ModelHolder(path))
+    monkeypatch.setattr(fast, "MODEL_RELOAD_INTERVAL", 0)
+    with TestClient(fast.app) as client:
+        yield client
+
+
+def trip_records(X, n):
+    records = X.head(n).to_dict(orient="records")
+    for record in records:
+        record["pickup_datetime"] = str(record["pickup_datetime"])
+    return records
+
+
+def test_predict_fares_matches_pipeline(client, pipeline, X_y):
+    X, _ = X_y
+    records = trip_records(X, 20)
+    response = client.post("/predict_fares", json=records)
+    assert response.status_code == 200
+    body = response.json()
+    assert body["errors"] == []
+    np.testing.assert_allclose(body["fare_amount"], pipeline.predict(X.head(20)))
+
+    # same trips as NDJSON and as columns
+    ndjson = "\n".join(json.dumps(record) for record in records)
+    response = client.post(
+        "/predict_fares",
+        content=ndjson,
+        headers={"content-type": "application/x-ndjson"},
+    )
+    assert response.json() == body
+    columns = {col: [r[col] for r in records] for col in records[0]}
+    assert client.post("/predict_fares", json=columns).json() == body
+
+
+def test_predict_fares_row_errors(client, pipeline, X_y):
+    X, _ = X_y
+    records = trip_records(X, 6)
+    records[1]["pickup_latitude"] = "north"
+    records[2]["passenger_count"] = 1.7
+    records[3]["passenger_count"] = 12
+    del records[4]["pickup_datetime"]
+    body = client.post("/predict_fares", json=records).json()
+    assert body["errors"] == [
+        {"row": 1, "error": "invalid pickup_latitude"},
+        {"row": 2, "error": "passenger_count not an integer"},
+        {"row": 3, "error": "passenger_count out of range"},
+        {"row": 4, "error": "invalid pickup_datetime"},
+    ]
+    fares = body["fare_amount"]
+    assert fares[1:5] == [None] * 4
+    expected = pipeline.predict(X.iloc[[0, 5]])
+    np.testing.assert_allclose([fares[0], fares[5]], expected)
+
+
+@pytest.mark.parametrize(
+    "body, status",
+    [
+        ("[1, 2]", 422),
+        ('[{"pickup_datetime": "2013-07-06 17:18:00 UTC"}, "trip"]', 422),
+        ("not json", 400),
+        ('"a string"', 400),
+    ],
+)
+def test_predict_fares_bad_body(client, body, status):
+    response = client.post(
+        "/predict_fares", content=body, headers={"content-type": "application/json"}
+    )
+    assert response.status_code == status
+
+
+def bump_mtime(path):
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+
+
+def test_hot_swap_on_new_model(client, X_y):
+    X, y = X_y
+    holder = fast.model_holder
+    before = client.get("/model").json()
+    # same content, newer mtime: hashed again but not reloaded
+    bump_mtime(holder.path)
+    assert not holder.maybe_reload()
+    assert client.get("/model").json()["version"] == before["version"]
+
+    other = fitted_pipeline(X, y, estimator="Lasso")
+    joblib.dump(other, holder.path)
+    bump_mtime(holder.path)
+    assert holder.maybe_reload()
+    after = client.get("/model").json()
+    assert after["version"] != before["version"]
+    fares = client.post("/predict_fares", json=trip_records(X, 5)).json()
+    np.testing.assert_allclose(fares["fare_amount"], other.predict(X.head(5)))
+
+
+def test_broken_model_keeps_serving(client):
+    holder = fast.model_holder
+    version = holder.current["version"]
+    with open(holder.path, "wb") as f:
+        f.write(b"not a pickle")
+    assert not holder.maybe_reload()
+    assert holder.current["version"] == version
+    assert client.get("/health").json() == {"status": "ok"}
+
+
+def test_watcher_swaps_model(client, X_y):
+    X, y = X_y
+    holder = fast.model_holder
+    version = holder.current["version"]
+    holder.start_watching(interval=0.05)
+    try:
+        joblib.dump(fitted_pipeline(X, y, estimator="Lasso"), holder.path)
+        bump_mtime(holder.path)
+        deadline = time.time() + 10
+        while holder.current["version"] == version and time.time() < deadline:
+            time.sleep(0.05)
+    finally:
+        holder.stop_watching()
+    assert holder.current["version"] != version
+
+
+def fare_params(X, i):
+    params = {k: str(v) for k, v in trip_records(X, i + 1)[i].items()}
+    params["passenger_count"] = str(int(float(params["passenger_count"])))
+    return params
+
+
+@pytest.fixture
+def cache(monkeypatch):
+    cache = PredictionCache()
+    monkeypatch.setattr(fast, "PREDICTION_CACHE", True)
+    monkeypatch.setattr(fast, "prediction_cache", cache)
+    return cache
+
+
+def test_prediction_cache_hit(client, cache, pipeline, X_y):
+    X, _ = X_y
+    first = client.get("/predict_fare/", params=fare_params(X, 0)).json()
+    assert first["fare_amount"] == pytest.approx(pipeline.predict(X.head(1))[0])
+    assert client.get("/predict_fare/", params=fare_params(X, 0)).json() == first
+    stats = client.get("/prediction_cache").json()
+    assert (stats["hits"], stats["misses"], stats["entries"]) == (1, 1, 1)
+    assert 'taxifare_prediction_cache_events_total{event="hit"} 1' in (
+        client.get("/metrics").text
+    )
+
+
+def test_prediction_cache_new_model_version(client, cache, X_y):
+    X, y = X_y
+    client.get("/predict_fare/", params=fare_params(X, 0))
+    other = fitted_pipeline(X, y, estimator="Lasso")
+    joblib.dump(other, fast.model_holder.path)
+    bump_mtime(fast.model_holder.path)
+    assert fast.model_holder.maybe_reload()
+    fare = client.get("/predict_fare/", params=fare_params(X, 0)).json()
+    assert fare["fare_amount"] == pytest.approx(other.predict(X.head(1))[0])
+    stats = cache.stats()
+    # the old model's fare was dropped with its version
+    assert (stats["hits"], stats["misses"], stats["entries"]) == (0, 2, 1)
+
+
+def test_prediction_cache_buckets_ttl_and_size(X_y):
+    X, _ = X_y
+    row = trip_records(X, 1)[0]
+    cache = PredictionCache(precision=8, ttl=0.05)
+    key = cache.key("v1", row)
+    # a few meters away, a few minutes later: same cells, same hour
+    near = dict(row, pickup_latitude=row["pickup_latitude"] + 1e-6)
+    assert cache.key("v1", near) == key
+    assert cache.key("v2", row) != key
+    cache.put(key, 12.5)
+    assert cache.get(key) == 12.5
+    time.sleep(0.1)
+    assert cache.get(key) is None and cache.expirations == 1
+
+    cache = PredictionCache(max_bytes=1, precision=None)
+    cache.put(cache.key("v1", row), 12.5)
+    assert cache.stats()["entries"] == 0 and cache.evictions == 1
@@ -0,0 +1,69 @@
+import os
+import stat
+
+import joblib
+import numpy as np
+import pytest
+
+from TaxiFareModel.artifact import load_artifact, save_artifact
+from TaxiFareModel.compiled import compile_pipeline
+from TaxiFareModel.trainer import Trainer
+
+FEATENG = ["distance", "time_features", "direction", "distance_to_center", "geohash"]
+
+
+def fitted_pipeline(X, y, **kwargs):
+    params = dict(mlflow=False, split=False, feateng=FEATENG, random_state=0)
+    params.update(kwargs)
+    trainer = Trainer(X, y, **params)
+    if params.get("estimator") == "xgboost":
+        trainer.kwargs["estimator_params"] = dict(n_estimators=20)
+    trainer.train()
+    return trainer.pipeline
+
+
+@pytest.mark.parametrize(
+    "kwargs",
+    [
+        dict(estimator="Ridge"),
+        dict(estimator="Lasso", distance_type="haversine"),
+        dict(estimator="Ridge", fast_time_features=True, fused_geo=True),
+        dict(estimator="xgboost"),
+        dict(estimator="xgboost", sparse_features=True, fast_time_features=True),
+    ],
+)
+def test_compiled_matches_pipeline(X_y, kwargs):
+    X, y = X_y
+    pipeline = fitted_pipeline(X, y, **kwargs)
+    compiled = compile_pipeline(pipeline)
+    expected = pipeline.predict(X)
+    np.testing.assert_allclose(compiled.predict(X), expected, rtol=1e-5, atol=1e-4)
+
+
+def test_predict_one_matches_batch(X_y):
+    X, y = X_y
+    compiled = compile_pipeline(fitted_pipeline(X, y, estimator="Ridge"))
+    batch = compiled.predict(X.head(5))
+    for i, row in enumerate(X.head(5).itertuples()):
+        one = compiled.predict_one(
+            row.pickup_datetime,
+            row.pickup_longitude,
+            row.pickup_latitude,
+            row.dropoff_longitude,
+            row.dropoff_latitude,
+        )
+        assert one == pytest.approx(batch[i], rel=1e-6)
+
+
+def test_artifact_matches_pipeline(X_y, tmp_path):
+    X, y = X_y
+    pipeline = fitted_pipeline(X, y, estimator="Ridge")
+    path = str(tmp_path / "model.tfm")
+    save_artifact(pipeline, path)
+    np.testing.assert_allclose(
+        load_artifact(path).predict(X), pipeline.predict(X), rtol=1e-5, atol=1e-4
+    )
+    # readable by the api under another user, like model.joblib
+    joblib.dump(pipeline, str(tmp_path / "model.joblib"))
+    mode = stat.S_IMODE(os.stat(path).st_mode)
+    assert mode == stat.S_IMODE(os.stat(str(tmp_path / "model.joblib")).st_mode)
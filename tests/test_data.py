@@ -0,0 +1,155 @@
+import pandas as pd
+import pytest
+
+from TaxiFareModel.data import (
+    TRAIN_DTYPES,
+    clean_df,
+    get_clean_data,
+    get_data,
+    sample_csv,
+    stream_data,
+)
+
+
+@pytest.fixture
+def train_csv(raw_trips, tmp_path):
+    path = tmp_path / "train.csv"
+    raw_trips.to_csv(path, index=False)
+    return str(path)
+
+
+def single_read(path, nrows=None):
+    """What the chunked read must give: the whole file typed and cleaned"""
+    df = pd.read_csv(path, nrows=nrows, dtype=TRAIN_DTYPES)
+    df = clean_df(df, verbose=False)
+    df["passenger_count"] = df["passenger_count"].astype("uint8")
+    df["pickup_datetime"] = pd.to_datetime(
+        df["pickup_datetime"], format="%Y-%m-%d %H:%M:%S UTC", utc=True
+    )
+    return df.reset_index(drop=True)
+
+
+@pytest.mark.parametrize("chunksize", [1, 97, 10000])
+def test_chunked_read_matches_single_read(train_csv, chunksize):
+    df = get_data(nrows=None, data_origin="local", path=train_csv, chunksize=chunksize)
+    pd.testing.assert_frame_equal(df.reset_index(drop=True), single_read(train_csv))
+
+
+def test_chunked_read_nrows(train_csv):
+    df = get_data(nrows=250, data_origin="local", path=train_csv, chunksize=60)
+    pd.testing.assert_frame_equal(
+        df.reset_index(drop=True), single_read(train_csv, nrows=250)
+    )
+
+
+def test_stream_data_skips_rows(train_csv):
+    chunks = list(
+        stream_data(data_origin="local", path=train_csv, chunksize=100, skiprows=200)
+    )
+    assert all(len(chunk) <= 100 for chunk in chunks)
+    expected = single_read(train_csv)
+    tail = clean_df(pd.read_csv(train_csv).iloc[200:], verbose=False)
+    streamed = pd.concat(chunks)
+    assert len(streamed) == len(tail)
+    assert streamed["key"].tolist() == tail["key"].tolist()
+    assert set(streamed["key"]) <= set(expected["key"])
+
+
+def test_clean_data_cache(train_csv, tmp_path):
+    kwargs = dict(data_origin="local", path=train_csv, cache_dir=str(tmp_path / "c"))
+    first = get_clean_data(nrows=None, **kwargs)
+    second = get_clean_data(nrows=None, **kwargs)
+    pd.testing.assert_frame_equal(
+        first.reset_index(drop=True), second.reset_index(drop=True)
+    )
+    assert len(list((tmp_path / "c" / "clean_data").iterdir())) == 1
+
+
+def chained_filters(df):
+    """clean_df before the rules were fused into one mask"""
+    df = df.dropna(how="any", axis="rows")
+    df = df[(df.dropoff_latitude != 0) | (df.dropoff_longitude != 0)]
+    df = df[(df.pickup_latitude != 0) | (df.pickup_longitude != 0)]
+    if "fare_amount" in list(df):
+        df = df[df.fare_amount.between(0, 4000)]
+    df = df[df.passenger_count < 8]
+    df = df[df.passenger_count >= 0]
+    df = df[df["pickup_latitude"].between(left=40, right=42)]
+    df = df[df["pickup_longitude"].between(left=-74.3, right=-72.9)]
+    df = df[df["dropoff_latitude"].between(left=40, right=42)]
+    df = df[df["dropoff_longitude"].between(left=-74, right=-72.9)]
+    return df
+
+
+@pytest.fixture
+def boundary_trips(raw_trips):
+    """Trips on and just past every bound of the cleaning rules"""
+    df = raw_trips.head(40).copy().reset_index(drop=True)
+    edits = [
+        ("pickup_latitude", [40.0, 42.0, 39.9999, 42.0001]),
+        ("pickup_longitude", [-74.3, -72.9, -74.3001, -72.8999]),
+        ("dropoff_latitude", [40.0, 42.0, 39.9999, 42.0001]),
+        ("dropoff_longitude", [-74.0, -72.9, -74.0001, -72.8999]),
+        ("fare_amount", [0.0, 4000.0, -0.01, 4000.01]),
+        ("passenger_count", [0, 7, 8, -1]),
+    ]
+    row = 0
+    for column, values in edits:
+        for value in values:
+            df.loc[row, column] = value
+            row += 1
+    df.loc[row, ["pickup_latitude", "pickup_longitude"]] = 0.0
+    df.loc[row + 1, ["dropoff_latitude", "dropoff_longitude"]] = 0.0
+    df.loc[row + 2, "dropoff_latitude"] = 0.0  # one zero only is kept
+    df.loc[row + 3, "key"] = None
+    return df
+
+
+@pytest.mark.parametrize("frame", ["raw_trips", "boundary_trips"])
+def test_fused_mask_matches_chained_filters(frame, request):
+    df = request.getfixturevalue(frame)
+    cleaned, report = clean_df(df, verbose=False, report=True)
+    expected = chained_filters(df)
+    pd.testing.assert_frame_equal(cleaned, expected)
+    assert report["rows_in"] == len(df)
+    assert report["rows_out"] == len(expected)
+    assert sum(report["rejected"].values()) == len(df) - len(expected)
+
+
+def test_fused_mask_without_fare(raw_trips):
+    test_set = raw_trips.drop(columns="fare_amount")
+    cleaned, report = clean_df(test_set, verbose=False, report=True)
+    pd.testing.assert_frame_equal(cleaned, chained_filters(test_set))
+    assert "fare_amount" not in report["rejected"]
+
+
+@pytest.fixture
+def uneven_csv(tmp_path):
+    """1000 long lines, then short and long lines alternating: every line
+    is shorter than the ones the sampler measures first"""
+    lines = ["row,kind,pad"]
+    lines += [f"{i},long,{'x' * 60}" for i in range(1000)]
+    for i in range(1000, 21000):
+        lines.append(f"{i},short," if i % 2 else f"{i},long,{'x' * 60}")
+    path = tmp_path / "uneven.csv"
+    path.write_text("\n".join(lines) + "\n")
+    return str(path)
+
+
+def test_seek_sample_is_uniform(uneven_csv):
+    sample = sample_csv(uneven_csv, 2000, seed=0, method="seek")
+    assert len(sample) == 2000
+    assert sample["row"].is_unique and sample["row"].is_monotonic_increasing
+    # 10000 short lines out of 21000
+    assert (sample["kind"] == "short").mean() == pytest.approx(10 / 21, abs=0.04)
+    # nor biased towards either end of the file
+    assert (sample["row"] < 10500).mean() == pytest.approx(0.5, abs=0.04)
+
+
+@pytest.mark.parametrize("method", ["seek", "reservoir"])
+def test_sample_same_seed_same_rows(uneven_csv, method):
+    first = sample_csv(uneven_csv, 500, seed=1, method=method)
+    pd.testing.assert_frame_equal(
+        first, sample_csv(uneven_csv, 500, seed=1, method=method)
+    )
+    assert not first.equals(sample_csv(uneven_csv, 500, seed=2, method=method))
@@ -0,0 +1,137 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+from scipy import sparse
+from sklearn.base import clone
+from sklearn.pipeline import Pipeline
+from sklearn.preprocessing import OneHotEncoder
+
+from TaxiFareModel.data import DIST_ARGS
+from TaxiFareModel.encoders import (
+    CachedTransformer,
+    Direction,
+    DistanceToCenter,
+    DistanceTransformer,
+    GeoFeatures,
+    GeohashEncoder,
+    RowParallel,
+    TimeFeaturesEncoder,
+    TimeFeaturesOneHot,
+)
+
+FEATURE_STEPS = {
+    "distance": lambda distance_type: DistanceTransformer(distance_type, **DIST_ARGS),
+    "direction": lambda distance_type: Direction(),
+    "distance_to_center": lambda distance_type: DistanceToCenter(),
+}
+
+
+@pytest.fixture(scope="module")
+def coords(raw_trips):
+    """Trip coordinates plus trips at the nyc box edges, zero length trips
+    and trips crossing the center"""
+    df = raw_trips[list(DIST_ARGS.values())].dropna().reset_index(drop=True)
+    edges = pd.DataFrame(
+        {
+            "pickup_latitude": [40.0, 42.0, 40.7141667, 40.7580, 41.0],
+            "pickup_longitude": [-74.3, -72.9, -74.0063889, -73.9855, -73.5],
+            "dropoff_latitude": [42.0, 40.0, 40.7141667, 40.7580, 40.5],
+            "dropoff_longitude": [-72.9, -74.0, -74.0063889, -73.9855, -74.2],
+        }
+    )
+    return pd.concat([df, edges], ignore_index=True)
+
+
+@pytest.mark.parametrize("distance_type", ["euclidian", "manhattan", "haversine"])
+@pytest.mark.parametrize(
+    "features",
+    [
+        ("distance", "direction", "distance_to_center"),
+        ("distance",),
+        ("direction", "distance_to_center"),
+    ],
+)
+def test_geo_features_match_separate_transformers(coords, distance_type, features):
+    fused = GeoFeatures(distance_type, features=features, chunk_size=100)
+    out = fused.fit_transform(coords)
+    expected = np.hstack(
+        [
+            np.asarray(FEATURE_STEPS[step](distance_type).transform(coords.copy()))
+            for step in features
+        ]
+    )
+    assert out.dtype == np.float32
+    assert out.shape == expected.shape
+    np.testing.assert_array_equal(out, expected.astype(np.float32))
+
+
+@pytest.mark.parametrize(
+    "head, columns",
+    [
+        (GeoFeatures(), list(DIST_ARGS.values())),
+        (Direction(), list(DIST_ARGS.values())),
+        (GeohashEncoder(precision=6, hash_bits=8), list(DIST_ARGS.values())),
+        (TimeFeaturesEncoder("pickup_datetime"), ["pickup_datetime"]),
+        (TimeFeaturesOneHot("pickup_datetime"), ["pickup_datetime"]),
+    ],
+)
+@pytest.mark.parametrize("parse_dates", [False, True])
+def test_row_parallel_matches_serial(trips, head, columns, parse_dates):
+    X = trips[columns].copy()
+    if parse_dates and "pickup_datetime" in columns:
+        X["pickup_datetime"] = pd.to_datetime(X["pickup_datetime"], utc=True)
+    serial = clone(head).fit(X).transform(X)
+    parallel = RowParallel(head, n_jobs=3, min_rows=0).fit(X).transform(X)
+    assert type(parallel) is type(serial)
+    if sparse.issparse(serial):
+        serial, parallel = serial.toarray(), parallel.toarray()
+    if isinstance(serial, pd.DataFrame):
+        pd.testing.assert_frame_equal(parallel, serial)
+    else:
+        np.testing.assert_array_equal(parallel, serial)
+
+
+def time_block():
+    return Pipeline(
+        [
+            ("time_enc", TimeFeaturesEncoder("pickup_datetime")),
+            ("ohe", OneHotEncoder(handle_unknown="ignore")),
+        ]
+    )
+
+
+def test_cached_transformer_hit_on_second_fit(X_y, tmp_path, capsys):
+    X, y = X_y
+    expected = time_block().fit_transform(X, y)
+    first = CachedTransformer(time_block(), cache_dir=str(tmp_path))
+    out = first.fit_transform(X, y)
+    assert "feature cache hit" not in capsys.readouterr().out
+    entries = os.listdir(tmp_path / "features")
+    assert len(entries) == 1
+
+    second = CachedTransformer(time_block(), cache_dir=str(tmp_path))
+    cached = second.fit_transform(X, y)
+    assert "feature cache hit" in capsys.readouterr().out
+    for output in [out, cached]:
+        np.testing.assert_array_equal(output.toarray(), expected.toarray())
+    np.testing.assert_array_equal(
+        second.transform(X.head(50)).toarray(), expected[:50].toarray()
+    )
+    # transform never writes to the cache
+    assert os.listdir(tmp_path / "features") == entries
+
+
+def test_cached_transformer_misses(X_y, tmp_path, capsys):
+    X, y = X_y
+    CachedTransformer(time_block(), cache_dir=str(tmp_path)).fit(X, y)
+    # other rows, other params of the block
+    CachedTransformer(time_block(), cache_dir=str(tmp_path)).fit(X.head(100), y)
+    other = time_block().set_params(time_enc__time_zone_name="UTC")
+    CachedTransformer(other, cache_dir=str(tmp_path)).fit(X, y)
+    assert "feature cache hit" not in capsys.readouterr().out
+    assert len(os.listdir(tmp_path / "features")) == 3
+    # a 1 byte cache only keeps the entry just written
+    CachedTransformer(other, cache_dir=str(tmp_path), max_bytes=1).fit(X.head(50))
+    assert len(os.listdir(tmp_path / "features")) == 1
@@ -0,0 +1,40 @@
+import pytest
+
+from TaxiFareModel.trainer import Trainer
+
+FEATENG = ["distance", "time_features", "direction"]
+
+
+@pytest.mark.parametrize(
+    "estimator, estimator_params",
+    [
+        ("RandomForest", dict(n_estimators=5, max_depth=4)),
+        ("xgboost", dict(n_estimators=5)),
+    ],
+)
+def test_search(X_y, estimator, estimator_params):
+    X, y = X_y
+    trainer = Trainer(
+        X,
+        y,
+        mlflow=False,
+        feateng=FEATENG,
+        estimator=estimator,
+        estimator_params=estimator_params,
+        search_candidates=2,
+        search_eta=2,
+        search_min_rows=100,
+        search_n_jobs=1,
+        early_stopping_rounds=None,
+        random_state=0,
+    )
+    report = trainer.search()
+    assert report["best_params"] is not None
+    rows = [res["rows"] for res in report["results"]]
+    assert rows == sorted(rows) and rows[-1] == trainer.nrows
+    best_params = {
+        k: trainer.kwargs["estimator_params"][k] for k in report["best_params"]
+    }
+    assert best_params == report["best_params"]
+    trainer.train()
+    trainer.evaluate()
@@ -0,0 +1,99 @@
+import json
+import os
+
+import pytest
+
+from TaxiFareModel.tracking import (
+    MAX_ENTITIES_PER_BATCH,
+    MAX_PARAMS_PER_BATCH,
+    MlflowLogger,
+    get_client,
+    log_batch,
+    replay_spool,
+)
+
+EXPERIMENT = "[test] taxifare"
+
+
+@pytest.fixture
+def local_store(tmp_path, monkeypatch):
+    monkeypatch.setenv("MLFLOW_ALLOW_FILE_STORE", "true")
+    return f"file://{tmp_path}/mlruns"
+
+
+def only_run(tracking_uri):
+    client = get_client(tracking_uri)
+    experiment = client.get_experiment_by_name(EXPERIMENT)
+    (run,) = client.search_runs([experiment.experiment_id])
+    return client, run
+
+
+def log_run(logger):
+    logger.log_param("model", "ridge")
+    logger.log_param("alpha", 0.5)
+    logger.log_param("model", "lasso")  # params of a run cannot change
+    for step, rmse in enumerate([5.0, 4.5, 4.2]):
+        logger.log_metric("rmse", rmse, step=step)
+
+
+def assert_run_logged(tracking_uri):
+    client, run = only_run(tracking_uri)
+    assert run.data.params == {"model": "ridge", "alpha": "0.5"}
+    history = client.get_metric_history(run.info.run_id, "rmse")
+    assert [(m.step, m.value) for m in history] == [(0, 5.0), (1, 4.5), (2, 4.2)]
+
+
+def test_logger_local_store(local_store, tmp_path):
+    logger = MlflowLogger(local_store, EXPERIMENT, spool_dir=str(tmp_path / "spool"))
+    log_run(logger)
+    assert logger.flush(timeout=60)
+    logger.close()
+    assert not logger.offline
+    assert not os.path.exists(logger.spool_path)
+    assert_run_logged(local_store)
+
+
+def test_offline_logger_spools_and_replays(local_store, tmp_path, monkeypatch):
+    monkeypatch.setenv("MLFLOW_HTTP_REQUEST_MAX_RETRIES", "0")
+    monkeypatch.setenv("MLFLOW_HTTP_REQUEST_TIMEOUT", "2")
+    spool_dir = str(tmp_path / "spool")
+    logger = MlflowLogger("http://127.0.0.1:9", EXPERIMENT, spool_dir=spool_dir)
+    log_run(logger)
+    logger.close()
+    assert logger.offline
+
+    with open(logger.spool_path) as f:
+        header, *batches = [json.loads(line) for line in f]
+    assert header["run_id"] is None
+    assert batches[0]["params"] == {"model": "ridge", "alpha": "0.5"}
+
+    # the same spool, as if the server had come back at the local store
+    header["tracking_uri"] = local_store
+    with open(logger.spool_path, "w") as f:
+        f.write("\n".join(json.dumps(line) for line in [header, *batches]) + "\n")
+    assert replay_spool(spool_dir, tracking_uri="http://elsewhere") == 0
+    assert replay_spool(spool_dir, tracking_uri=local_store) == 1
+    assert os.listdir(spool_dir) == []
+    assert_run_logged(local_store)
+
+
+class FakeClient(object):
+    def __init__(self):
+        self.batches = []
+
+    def log_batch(self, run_id, params, metrics):
+        self.batches.append((params, metrics))
+
+
+def test_log_batch_limits():
+    client = FakeClient()
+    params = {f"p{i}": str(i) for i in range(250)}
+    metrics = [("rmse", float(i), 0, i) for i in range(2500)]
+    log_batch(client, "run", params, metrics)
+    for batch_params, batch_metrics in client.batches:
+        assert len(batch_params) <= MAX_PARAMS_PER_BATCH
+        assert len(batch_params) + len(batch_metrics) <= MAX_ENTITIES_PER_BATCH
+    sent_params = [p for batch, _ in client.batches for p in batch]
+    sent_metrics = [m for _, batch in client.batches for m in batch]
+    assert {p.key: p.value for p in sent_params} == params
+    assert [m.step for m in sent_metrics] == list(range(2500))
@@ -0,0 +1,68 @@
+import os
+
+import numpy as np
+import pytest
+
+from TaxiFareModel.data import stream_data
+from TaxiFareModel.trainer import Trainer
+
+
+@pytest.fixture
+def train_csv(raw_trips, tmp_path):
+    path = tmp_path / "train.csv"
+    raw_trips.to_csv(path, index=False)
+    return str(path)
+
+
+@pytest.mark.parametrize("estimator", ["SGDRegressor", "xgboost"])
+def test_evaluate_after_out_of_core(X_y, train_csv, estimator, monkeypatch):
+    X, y = X_y
+    # a small evaluation frame, the model learns from the streamed file
+    trainer = Trainer(
+        X.head(100),
+        y.head(100),
+        mlflow=False,
+        split=False,
+        estimator=estimator,
+        feateng=["distance", "time_features"],
+        train_rmse_rows=50,
+        xgb_external_memory=False,
+        random_state=0,
+    )
+    trainer.train_out_of_core(
+        lambda: stream_data(data_origin="local", path=train_csv, chunksize=150)
+    )
+    assert trainer.nrows > len(trainer.y_train)
+    logged = {}
+    monkeypatch.setattr(trainer, "mlflow_log_metric", logged.__setitem__)
+    trainer.evaluate()
+    assert list(logged) == ["rmse_eval"]
+
+    trainer.train()
+    logged.clear()
+    trainer.evaluate()
+    assert list(logged) == ["rmse_train"]
+
+
+def test_xgboost_matrix_cache(X_y, tmp_path, capsys):
+    X, y = X_y
+    params = dict(
+        mlflow=False,
+        split=False,
+        estimator="xgboost",
+        estimator_params=dict(n_estimators=5),
+        feateng=["distance", "time_features"],
+        feature_cache=True,
+        feature_cache_dir=str(tmp_path),
+        feature_cache_max_bytes=1,
+    )
+    first = Trainer(X, y, **params)
+    first.train()
+    second = Trainer(X, y, **params)
+    second.train()
+    assert "xgboost matrix cache hit" in capsys.readouterr().out
+    np.testing.assert_allclose(second.pipeline.predict(X), first.pipeline.predict(X))
+    entries = sorted(os.listdir(tmp_path / "xgboost"))
+    # other data: the 1 byte limit only keeps the newest entry
+    Trainer(X.head(200), y.head(200), **params).train()
+    assert set(os.listdir(tmp_path / "xgboost")).isdisjoint(entries)
@@ -0,0 +1,97 @@
+import numpy as np
+import pandas as pd
+import pygeohash as gh
+import pytest
+
+from TaxiFareModel.utils import (
+    geohash_to_str,
+    geohash_vectorized,
+    time_features_vectorized,
+    utc_seconds,
+)
+from tests.conftest import DST_TIMES
+
+# layouts the byte decoding leaves to pandas
+FALLBACK_TIMES = [
+    "2013-03-10T07:00:00Z",
+    "2013-11-03 06:00:00+00:00",
+    "2013-11-03 01:30:00 -0500",
+    "2014-6-1 12:00:00 UTC",
+]
+
+# poles, antimeridian, equator / greenwich and the edges of the nyc box the
+# cleaning keeps (lat 40-42, lon -74.3 to -72.9)
+BOUNDARY_COORDS = [
+    (90.0, 180.0),
+    (-90.0, -180.0),
+    (90.0, -180.0),
+    (-90.0, 180.0),
+    (0.0, 0.0),
+    (0.0, -180.0),
+    (45.0, 90.0),
+    (40.0, -74.3),
+    (42.0, -72.9),
+    (40.0, -72.9),
+    (42.0, -74.3),
+    (40.7580, -73.9855),
+]
+
+
+@pytest.mark.parametrize("precision", [1, 5, 6, 8, 12])
+def test_geohash_matches_pygeohash(raw_trips, precision):
+    lat = np.concatenate(
+        [
+            raw_trips["pickup_latitude"].to_numpy(),
+            raw_trips["dropoff_latitude"].to_numpy(),
+            [c[0] for c in BOUNDARY_COORDS],
+        ]
+    )
+    lon = np.concatenate(
+        [
+            raw_trips["pickup_longitude"].to_numpy(),
+            raw_trips["dropoff_longitude"].to_numpy(),
+            [c[1] for c in BOUNDARY_COORDS],
+        ]
+    )
+    keep = (np.abs(lat) <= 90) & (np.abs(lon) <= 180)
+    lat, lon = lat[keep], lon[keep]
+
+    cells = geohash_vectorized(lat, lon, precision)
+    expected = [gh.encode(a, o, precision=precision) for a, o in zip(lat, lon)]
+    assert list(geohash_to_str(cells, precision)) == expected
+
+
+def pickup_times(raw_trips):
+    return pd.Series(list(raw_trips["pickup_datetime"]) + DST_TIMES + FALLBACK_TIMES)
+
+
+def test_utc_seconds_matches_pandas(raw_trips):
+    times = pickup_times(raw_trips)
+    parsed = pd.to_datetime(times, utc=True, format="mixed")
+    expected = (parsed - pd.Timestamp(0, tz="UTC")) // pd.Timedelta(seconds=1)
+    assert (utc_seconds(times) == expected).all()
+    assert (utc_seconds(parsed) == expected).all()
+    assert (utc_seconds(parsed.dt.tz_localize(None)) == expected).all()
+
+
+@pytest.mark.parametrize("bad", ["2013-02-30 12:00:00 UTC", "2013-01-01 24:00:00 UTC"])
+def test_utc_seconds_rejects_invalid_dates(bad):
+    with pytest.raises(ValueError):
+        utc_seconds(pd.Series(DST_TIMES + [bad]))
+
+
+def test_time_features_match_pandas(raw_trips):
+    times = pickup_times(raw_trips)
+    local = pd.to_datetime(times, utc=True, format="mixed").dt.tz_convert(
+        "America/New_York"
+    )
+    dow, hour, month, year = time_features_vectorized(times)
+    assert (dow == local.dt.dayofweek).all()
+    assert (hour == local.dt.hour).all()
+    assert (month == local.dt.month).all()
+    assert (year == local.dt.year).all()
+
+
+def test_time_features_empty():
+    for feature in time_features_vectorized(pd.Series([], dtype=object)):
+        assert len(feature) == 0